@@ -0,0 +1,552 @@
+"""cold storage for old chat messages
+
+messages older than a configured age are moved out of the messages table
+into one sqlite file per month, so the hot table and its indexes only hold
+recent history. a segment stores a room's messages in blocks of a few
+hundred, each block one zlib compressed json array, and indexes the blocks
+by their first and last (datetime, id) key. reading a page of old history
+decompresses the one or two blocks it falls in.
+
+segments partition messages by month so they never overlap. blocks within
+a segment can, when a message older than the last run turns up late, and
+reads merge them. a segment also lists the ids it holds, so moving a
+message again after an interrupted move is a no-op, and indexes the text
+in its own fts5 table for search.py, which scans the blocks instead when
+it runs without fts5. a message whose move was interrupted is in the
+archive and the table until the move is run again, readers drop the
+duplicate. archive.json says what the archive holds, readers on every
+worker reload it when it changes.
+"""
+
+import heapq
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from . import message_views
+from .sql_models import db, Message
+
+Key = Tuple[float, int]
+
+STATE_FILE = "archive.json"
+
+_SEGMENT_DDL = (
+    """CREATE TABLE IF NOT EXISTS blocks (
+        room_id INTEGER NOT NULL,
+        first_datetime REAL NOT NULL,
+        first_id INTEGER NOT NULL,
+        last_datetime REAL NOT NULL,
+        last_id INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_blocks_first ON blocks "
+    "(room_id, first_datetime, first_id)",
+    "CREATE INDEX IF NOT EXISTS ix_blocks_last ON blocks "
+    "(room_id, last_datetime, last_id)",
+    "CREATE TABLE IF NOT EXISTS ids (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL)",
+)
+
+# full text index of a segment, rowid is the message id. the text is
+# stored uncompressed a second time so search can rank and snippet it
+SEARCH_TABLE = "messages_fts"
+_SEARCH_DDL = f"""CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(
+    text, room_id UNINDEXED, user_id UNINDEXED, datetime UNINDEXED,
+    tokenize='unicode61 remove_diacritics 2'
+)"""
+
+# records inside a block, the room is the block's
+_FIELDS = ("id", "text", "datetime", "user_id")
+
+
+def month_of(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m")
+
+
+def _month_bound(key: Key) -> str:
+    "the month of a key from a client, which may be far outside any month"
+    try:
+        return month_of(key[0])
+    except (OverflowError, OSError, ValueError):
+        return "9999-12" if key[0] > 0 else "0000-01"
+
+
+def _key(message: dict) -> Key:
+    return message["datetime"], message["id"]
+
+
+@lru_cache(maxsize=None)
+def fts5_available() -> bool:
+    connection = sqlite3.connect(":memory:")
+    try:
+        options = {option for (option,) in connection.execute("PRAGMA compile_options")}
+    finally:
+        connection.close()
+    return "ENABLE_FTS5" in options
+
+
+def _descending(key: Key) -> Key:
+    return -key[0], -key[1]
+
+
+def _ascending(key: Key) -> Key:
+    return key
+
+
+class MessageArchive:
+    """monthly segments of archived messages under directory
+
+    one process writes, any number read
+    """
+
+    def __init__(self, directory: str, block_size: int = 256, level: int = 6):
+        self.directory = Path(directory)
+        self.block_size = block_size
+        self.level = level
+        self._state = {"watermark": None, "rooms": [], "segments": [], "messages": 0}
+        self._rooms = frozenset()
+        self._state_mtime = None
+        self._lock = threading.Lock()
+
+    @property
+    def _state_path(self) -> Path:
+        return self.directory / STATE_FILE
+
+    def _segment_path(self, month: str) -> Path:
+        return self.directory / f"messages-{month}.db"
+
+    def refresh(self):
+        "reload archive.json if the writer changed it, costs one stat otherwise"
+        try:
+            mtime = self._state_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self._state_mtime:
+            return
+        with self._lock:
+            with open(self._state_path, encoding="utf-8") as file:
+                self._state = json.load(file)
+            self._rooms = frozenset(self._state["rooms"])
+            self._state_mtime = mtime
+
+    @property
+    def watermark(self) -> Optional[float]:
+        "every archived message is from this timestamp or earlier, None if empty"
+        self.refresh()
+        return self._state["watermark"]
+
+    @property
+    def stats(self) -> dict:
+        self.refresh()
+        segments = [self._segment_path(month) for month in self._state["segments"]]
+        return {
+            "messages": self._state["messages"],
+            "segments": len(segments),
+            "bytes": sum(path.stat().st_size for path in segments if path.exists()),
+            "watermark": self._state["watermark"],
+        }
+
+    def holds(self, room_id: int) -> bool:
+        "whether any of the room's messages are archived"
+        self.refresh()
+        return room_id in self._rooms
+
+    def segments(
+        self, since: Optional[float] = None, until: Optional[float] = None
+    ) -> List[Path]:
+        "paths of the segments that can hold messages from since until until"
+        self.refresh()
+        months = self._state["segments"]
+        if since is not None:
+            months = [month for month in months if month >= _month_bound((since, 0))]
+        if until is not None:
+            months = [month for month in months if month <= _month_bound((until, 0))]
+        paths = [self._segment_path(month) for month in months]
+        return [path for path in paths if path.exists()]
+
+    def post_counts(self) -> Counter:
+        "archived messages per user id"
+        self.index_segments()
+        counts = Counter()
+        for path in self.segments():
+            connection = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+            try:
+                counts.update(
+                    dict(
+                        connection.execute(
+                            "SELECT user_id, count(*) FROM ids GROUP BY user_id"
+                        )
+                    )
+                )
+            finally:
+                connection.close()
+        return counts
+
+    def scan(
+        self,
+        match: Callable[[str], bool],
+        user_id: Optional[int] = None,
+        room_id: Optional[int] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        limit: Optional[int] = None,
+    ) -> List[dict]:
+        """archived messages whose text match accepts, newest first
+
+        for searching without the fts5 index. every block in the time range
+        is decompressed, a month at a time from the newest until limit
+        messages are found
+        """
+        conditions, params = [], []
+        for condition, value in (
+            ("room_id = ?", room_id),
+            ("last_datetime >= ?", since),
+            ("first_datetime < ?", until),
+        ):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = "SELECT room_id, data FROM blocks"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        results = []
+        for path in reversed(self.segments(since, until)):
+            connection = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+            try:
+                blocks = connection.execute(query, params).fetchall()
+            finally:
+                connection.close()
+            found = []
+            for block_room, data in blocks:
+                for record in json.loads(zlib.decompress(data)):
+                    row = dict(zip(_FIELDS, record), room_id=block_room)
+                    if (
+                        (user_id is not None and row["user_id"] != user_id)
+                        or (since is not None and row["datetime"] < since)
+                        or (until is not None and row["datetime"] >= until)
+                        or not match(row["text"] or "")
+                    ):
+                        continue
+                    found.append(row)
+            # segments don't overlap, blocks within one can
+            found.sort(key=_key, reverse=True)
+            results += found
+            if limit is not None and len(results) >= limit:
+                return results[:limit]
+        return results
+
+    def before(self, room_id: int, key: Optional[Key]) -> Iterator[dict]:
+        "the room's archived messages below key, newest first, read lazily"
+        self.refresh()
+        if room_id not in self._rooms:
+            return
+        months = self._state["segments"]
+        if key is not None:
+            months = [month for month in months if month <= _month_bound(key)]
+        for month in reversed(months):
+            yield from self._read(month, room_id, key, descending=True)
+
+    def after(self, room_id: int, key: Optional[Key]) -> Iterator[dict]:
+        "the room's archived messages above key, oldest first, read lazily"
+        self.refresh()
+        if room_id not in self._rooms:
+            return
+        months = self._state["segments"]
+        if key is not None:
+            months = [month for month in months if month >= _month_bound(key)]
+        for month in months:
+            yield from self._read(month, room_id, key, descending=False)
+
+    def _read(
+        self, month: str, room_id: int, key: Optional[Key], descending: bool
+    ) -> Iterator[dict]:
+        path = self._segment_path(month)
+        if not path.exists():
+            return
+        connection = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            # blocks in the order their first row could come out, only the
+            # ones with a row past key
+            if descending:
+                columns, order = "last_datetime, last_id", "DESC"
+                bound = "(first_datetime, first_id) < (?, ?)"
+            else:
+                columns, order = "first_datetime, first_id", "ASC"
+                bound = "(last_datetime, last_id) > (?, ?)"
+            query = f"SELECT {columns}, data FROM blocks WHERE room_id = ?"
+            params: list = [room_id]
+            if key is not None:
+                query += f" AND {bound}"
+                params += key
+            first, second = columns.split(", ")
+            query += f" ORDER BY {first} {order}, {second} {order}"
+            blocks = connection.execute(query, params)
+            yield from self._merge_blocks(blocks, room_id, key, descending)
+        finally:
+            connection.close()
+
+    def _merge_blocks(
+        self, blocks, room_id: int, key: Optional[Key], descending: bool
+    ) -> Iterator[dict]:
+        """rows of possibly overlapping blocks in order
+
+        a block is only decompressed once the merge reaches the key its
+        first row would come out at, so a page usually opens one or two
+        """
+        order = _descending if descending else _ascending
+        counter = itertools.count()
+        heap = []
+
+        def push(rows: Iterator[dict]):
+            for row in rows:
+                heapq.heappush(heap, (order(_key(row)), next(counter), row, rows))
+                return
+
+        pending = next(blocks, None)
+        while True:
+            while pending is not None and (
+                not heap or order((pending[0], pending[1])) <= heap[0][0]
+            ):
+                push(self._decode(pending[2], room_id, key, descending))
+                pending = next(blocks, None)
+            if not heap:
+                return
+            _, _, row, rows = heapq.heappop(heap)
+            yield row
+            push(rows)
+
+    def _decode(
+        self, data: bytes, room_id: int, key: Optional[Key], descending: bool
+    ) -> Iterator[dict]:
+        records = json.loads(zlib.decompress(data))
+        if descending:
+            records.reverse()
+        for record in records:
+            row = dict(zip(_FIELDS, record), room_id=room_id)
+            if key is not None and (
+                _key(row) >= key if descending else _key(row) <= key
+            ):
+                continue
+            yield row
+
+    def write(self, messages: Iterable[dict]) -> int:
+        """add messages to their segments, returns how many were written
+
+        messages already archived are skipped. every segment touched is
+        committed before archive.json mentions it, so readers never look
+        for blocks that aren't there yet
+        """
+        groups: Dict[str, Dict[int, List[dict]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        count = 0
+        newest = None
+        for message in messages:
+            groups[month_of(message["datetime"])][message["room_id"]].append(message)
+            if newest is None or message["datetime"] > newest:
+                newest = message["datetime"]
+            count += 1
+        if not count:
+            return 0
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        written = 0
+        totals = dict()
+        for month, rooms in groups.items():
+            connection, searchable = self._open_segment(month)
+            try:
+                with connection:
+                    rooms = self._unarchived(connection, rooms)
+                    connection.executemany(
+                        "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            block
+                            for room_id, rows in rooms.items()
+                            for block in self._blocks(room_id, rows)
+                        ),
+                    )
+                    rows = [row for rows in rooms.values() for row in rows]
+                    self._index(connection, rows, searchable)
+                    written += len(rows)
+                totals[month] = self._count(connection)
+            finally:
+                connection.close()
+
+        self.refresh()
+        with self._lock:
+            state = dict(self._state)
+        watermark = state["watermark"]
+        state["watermark"] = newest if watermark is None else max(watermark, newest)
+        state["rooms"] = sorted(
+            set(state["rooms"]).union(
+                room_id for rooms in groups.values() for room_id in rooms
+            )
+        )
+        state["segments"] = sorted(set(state["segments"]).union(groups))
+        # counted from the segments, a write that was interrupted before
+        # archive.json was updated is still counted once
+        counts = dict(state.get("counts") or {}, **totals)
+        for month in state["segments"]:
+            if month not in counts:
+                connection = self._open_segment(month)[0]
+                try:
+                    counts[month] = self._count(connection)
+                finally:
+                    connection.close()
+        state["counts"] = counts
+        state["messages"] = sum(counts.values())
+        temporary = self._state_path.with_suffix(".tmp")
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, self._state_path)
+        self.refresh()
+        return written
+
+    def index_segments(self):
+        "list the ids and index the text of segments written before either was"
+        self.refresh()
+        for month in self._state["segments"]:
+            if self._segment_path(month).exists():
+                self._open_segment(month)[0].close()
+
+    def _open_segment(self, month: str) -> Tuple[sqlite3.Connection, bool]:
+        """connection to a segment for writing, and whether it has SEARCH_TABLE
+
+        segments from before the ids or search table existed get them,
+        filled in from their blocks
+        """
+        connection = sqlite3.connect(self._segment_path(month))
+        with connection:
+            tables = {
+                name
+                for (name,) in connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table'"
+                )
+            }
+            for statement in _SEGMENT_DDL:
+                connection.execute(statement)
+            new_search = SEARCH_TABLE not in tables and fts5_available()
+            if new_search:
+                connection.execute(_SEARCH_DDL)
+            if "blocks" in tables and ("ids" not in tables or new_search):
+                self._reindex(connection, "ids" not in tables, new_search)
+        return connection, SEARCH_TABLE in tables or new_search
+
+    def _reindex(self, connection: sqlite3.Connection, ids: bool, search: bool):
+        seen = set()
+        blocks = connection.execute("SELECT room_id, data FROM blocks").fetchall()
+        for room_id, data in blocks:
+            rows = []
+            for row in self._decode(data, room_id, None, descending=False):
+                if row["id"] not in seen:
+                    seen.add(row["id"])
+                    rows.append(row)
+            self._index(connection, rows, search, ids=ids)
+
+    @staticmethod
+    def _count(connection: sqlite3.Connection) -> int:
+        return connection.execute("SELECT count(*) FROM ids").fetchone()[0]
+
+    @staticmethod
+    def _unarchived(
+        connection: sqlite3.Connection, rooms: Dict[int, List[dict]]
+    ) -> Dict[int, List[dict]]:
+        "rooms without the messages the segment already holds"
+        ids = [row["id"] for rows in rooms.values() for row in rows]
+        held = set()
+        # below sqlite's limit on bound parameters
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            held.update(
+                message_id
+                for (message_id,) in connection.execute(
+                    f"SELECT id FROM ids WHERE id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+            )
+        if not held:
+            return rooms
+        rooms = {
+            room_id: [row for row in rows if row["id"] not in held]
+            for room_id, rows in rooms.items()
+        }
+        return {room_id: rows for room_id, rows in rooms.items() if rows}
+
+    @staticmethod
+    def _index(
+        connection: sqlite3.Connection,
+        rows: List[dict],
+        searchable: bool,
+        ids: bool = True,
+    ):
+        if ids:
+            connection.executemany(
+                "INSERT INTO ids VALUES (?, ?)",
+                ((row["id"], row["user_id"]) for row in rows),
+            )
+        if searchable:
+            connection.executemany(
+                f"INSERT INTO {SEARCH_TABLE} "
+                "(rowid, text, room_id, user_id, datetime) VALUES (?, ?, ?, ?, ?)",
+                (
+                    (
+                        row["id"],
+                        row["text"],
+                        row["room_id"],
+                        row["user_id"],
+                        row["datetime"],
+                    )
+                    for row in rows
+                ),
+            )
+
+    def _blocks(self, room_id: int, rows: List[dict]):
+        rows.sort(key=_key)
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start : start + self.block_size]
+            records = [[row[field] for field in _FIELDS] for row in block]
+            data = zlib.compress(
+                json.dumps(records, separators=(",", ":")).encode(), self.level
+            )
+            first, last = _key(block[0]), _key(block[-1])
+            yield (room_id, *first, *last, len(block), data)
+
+
+def archive_older_than(
+    archive: MessageArchive, cutoff: datetime, max_rows: int = 50_000
+) -> int:
+    """move up to max_rows of the oldest messages before cutoff to archive
+
+    returns how many were moved, fewer than max_rows once none are left.
+    the newest message always stays, the message writer numbers new
+    messages from the highest id in the table
+    """
+    newest_id = db.session.query(db.func.max(Message.id)).scalar()
+    if newest_id is None:
+        return 0
+    rows = message_views.to_json_list(
+        message_views.message_query()
+        .filter(Message.datetime < cutoff, Message.id != newest_id)
+        .order_by(Message.datetime, Message.id)
+        .limit(max_rows)
+    )
+    archive.write(rows)
+    ids = [row["id"] for row in rows]
+    # below sqlite's limit on bound parameters
+    for start in range(0, len(ids), 500):
+        db.session.execute(
+            Message.__table__.delete().where(Message.id.in_(ids[start : start + 500]))
+        )
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,185 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+from typing import Dict, List, Optional, Tuple
+
+ASSET_URL_PREFIX = "/assets/"
+MANIFEST_NAME = "manifest.json"
+ASSET_EXTENSIONS = (".js", ".css")
+
+# encodings in order of preference, with the suffix of their precompressed file
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# static and dynamic imports of relative modules, eg. from './modules/x.js'
+IMPORT_PATTERN = re.compile(
+    r"""((?:\bfrom|\bimport)\s*\(?\s*)(['"])(\.{1,2}/[^'"]+)\2"""
+)
+
+
+def hashed_name(name: str, content: bytes) -> str:
+    "js/space2.js -> js/space2.1a2b3c4d5e6f.js"
+    root, ext = posixpath.splitext(name)
+    return f"{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+
+
+def compress(content: bytes) -> Dict[str, bytes]:
+    """precompressed variants of content by encoding
+
+    brotli is only produced when the brotli package is installed
+    """
+    # mtime=0 so rebuilding unchanged files gives identical output
+    variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        return variants
+    variants["br"] = brotli.compress(content, quality=11)
+    return variants
+
+
+class AssetBuilder:
+    """copies static assets to content hashed names for far future caching
+
+    relative imports between js modules are rewritten to the hashed name
+    of their target, so a module's hash covers everything it imports and
+    changing one module busts the cache of every module that imports it
+    """
+
+    def __init__(self, source: str, output: str):
+        self.source = source
+        self.output = output
+        self.manifest: Dict[str, str] = dict()
+        self._building: List[str] = []
+
+    def build(self) -> Dict[str, str]:
+        "build every asset under source, returns the manifest"
+        for root, dirs, files in os.walk(self.source):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                if os.path.abspath(path).startswith(os.path.abspath(self.output)):
+                    continue
+                if filename.endswith(ASSET_EXTENSIONS):
+                    name = os.path.relpath(path, self.source).replace(os.sep, "/")
+                    self._build(name)
+
+        path = os.path.join(self.output, MANIFEST_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+        return self.manifest
+
+    def _build(self, name: str) -> str:
+        if name in self.manifest:
+            return self.manifest[name]
+        if name in self._building:
+            cycle = " -> ".join(self._building + [name])
+            raise ValueError(f"circular import between assets: {cycle}")
+
+        self._building.append(name)
+        try:
+            with open(os.path.join(self.source, name), "rb") as f:
+                content = f.read()
+            if name.endswith(".js"):
+                content = self._rewrite_imports(name, content)
+        finally:
+            self._building.pop()
+
+        hashed = hashed_name(name, content)
+        self._write(hashed, content)
+        variants = compress(content)
+        for encoding, suffix in ENCODINGS:
+            variant = variants.get(encoding)
+            if variant is not None and len(variant) < len(content):
+                self._write(hashed + suffix, variant)
+        self.manifest[name] = hashed
+        return hashed
+
+    def _rewrite_imports(self, name: str, content: bytes) -> bytes:
+        directory = posixpath.dirname(name)
+
+        def replace(match):
+            prefix, quote, target = match.groups()
+            resolved = posixpath.normpath(posixpath.join(directory, target))
+            if not os.path.isfile(os.path.join(self.source, resolved)):
+                return match.group(0)
+            hashed = self._build(resolved)
+            relative = posixpath.relpath(hashed, directory or ".")
+            if not relative.startswith("."):
+                relative = "./" + relative
+            return f"{prefix}{quote}{relative}{quote}"
+
+        text = content.decode("utf-8")
+        return IMPORT_PATTERN.sub(replace, text).encode("utf-8")
+
+    def _write(self, name: str, content: bytes):
+        path = os.path.join(self.output, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            return
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+
+
+class AssetManifest:
+    """maps asset names to their hashed urls
+
+    without a built manifest, eg. in development, urls point at the plain
+    static files instead
+    """
+
+    def __init__(self, directory: str, fallback_prefix: str = "/static/"):
+        self.directory = directory
+        self.fallback_prefix = fallback_prefix
+        self._manifest: Dict[str, str] = dict()
+        self._hashed = set()
+
+    def load(self) -> "AssetManifest":
+        try:
+            with open(os.path.join(self.directory, MANIFEST_NAME)) as f:
+                self._manifest = json.load(f)
+        except FileNotFoundError:
+            self._manifest = dict()
+        self._hashed = set(self._manifest.values())
+        return self
+
+    def url(self, name: str) -> str:
+        hashed = self._manifest.get(name)
+        if hashed is None:
+            return self.fallback_prefix + name
+        return ASSET_URL_PREFIX + hashed
+
+    def is_hashed(self, name: str) -> bool:
+        return name in self._hashed
+
+    def __len__(self):
+        return len(self._manifest)
+
+
+def choose_encoding(
+    directory: str, name: str, accepted: Dict[str, float]
+) -> Tuple[str, Optional[str]]:
+    """the file to send for name and its content encoding
+
+    accepted maps encodings to their quality from Accept-Encoding, the
+    smallest acceptable precompressed file that exists wins
+    """
+    for encoding, suffix in ENCODINGS:
+        if accepted.get(encoding, 0) <= 0:
+            continue
+        if os.path.isfile(os.path.join(directory, name + suffix)):
+            return name + suffix, encoding
+    return name, None
+
+
+def content_type(name: str) -> str:
+    mimetype, _ = mimetypes.guess_type(name)
+    if mimetype == "application/javascript":
+        # the type browsers expect for module scripts
+        return "text/javascript"
+    return mimetype or "application/octet-stream"
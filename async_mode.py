@@ -0,0 +1,22 @@
+"""picks the async mode the socket server runs in
+
+this has to be imported before anything else in chat_server so eventlet
+or gevent can monkey patch the standard library before it gets used
+"""
+
+from .config import ASYNC_MODE
+
+ASYNC_MODES = ("threading", "eventlet", "gevent")
+
+if ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f"ASYNC_MODE must be one of {ASYNC_MODES}, not {ASYNC_MODE!r}")
+
+if ASYNC_MODE == "eventlet":
+    import eventlet
+
+    eventlet.monkey_patch()
+
+elif ASYNC_MODE == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
@@ -0,0 +1,166 @@
+import hashlib
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from flask import current_app
+
+from .sql_models import db
+
+
+class BloomFilter:
+    """set membership in a fixed bit array, with false positives but never
+    false negatives
+
+    a million entries at a 1% error rate take a bit over 1 MB
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        bits = -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = max(int(bits), 8)
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, value: str) -> Iterable[int]:
+        # double hashing, k positions from the two halves of one digest
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value: str):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(value)
+        )
+
+
+class AvailabilityIndex:
+    """answers whether a username or email is already taken
+
+    a bloom filter per column says "definitely free" without touching the
+    database, only a probable hit is confirmed with a query. the filters
+    are warmed from the users table on start and every new signup is
+    added. a filter that fills past its capacity is rebuilt twice as large
+    on a background thread so the error rate stays put, lookups keep using
+    the old filters until the new ones are ready.
+    """
+
+    def __init__(
+        self,
+        table: "db.Model",
+        columns: Tuple[str, ...],
+        capacity: int = 100_000,
+        error_rate: float = 0.01,
+    ):
+        self.table = table
+        self.columns = columns
+        self.error_rate = error_rate
+        self._filters: Dict[str, BloomFilter] = dict()
+        self._capacity = capacity
+        self._lock = threading.Lock()
+        self._app = None
+        # values added while load() reads the table, it may not see them
+        self._added: Optional[List[Tuple[str, str]]] = None
+        self._rebuild: Optional[threading.Thread] = None
+        self.stats = {"lookups": 0, "database_checks": 0, "false_positives": 0}
+
+    def init_app(self, app):
+        self._app = app
+        app.extensions["availability"] = self
+
+    @property
+    def warm(self) -> bool:
+        return bool(self._filters)
+
+    def load(self):
+        "build the filters from the users table, needs an app context"
+        with self._lock:
+            self._added = []
+        try:
+            (count,) = db.session.query(db.func.count(self.table.id)).one()
+            capacity = max(self._capacity, count * 2)
+            filters = {
+                name: BloomFilter(capacity, self.error_rate) for name in self.columns
+            }
+            columns = [getattr(self.table, name) for name in self.columns]
+            for row in db.session.query(*columns).yield_per(10_000):
+                for name, value in zip(self.columns, row):
+                    if value is not None:
+                        filters[name].add(value)
+        finally:
+            with self._lock:
+                added, self._added = self._added, None
+        with self._lock:
+            for name, value in added:
+                filters[name].add(value)
+            self._capacity = capacity
+            self._filters = filters
+
+    def add(self, column: str, value: Optional[str]):
+        "record a value as taken, eg. after a signup"
+        if value is None or column not in self.columns:
+            return
+        with self._lock:
+            if self._added is not None:
+                self._added.append((column, value))
+            bloom = self._filters.get(column)
+            if bloom is None:
+                return
+            bloom.add(value)
+            if bloom.count <= bloom.capacity or self._app is None:
+                return
+            if self._rebuild is not None and self._rebuild.is_alive():
+                return
+            self._rebuild = threading.Thread(
+                target=self._rebuild_filters, name="availability", daemon=True
+            )
+            self._rebuild.start()
+
+    def _rebuild_filters(self):
+        with self._app.app_context():
+            try:
+                self.load()
+            except Exception as e:
+                # the old filters stay, full ones give more false positives
+                # but never false negatives
+                print("availability: failed to rebuild the filters", e)
+            finally:
+                db.session.remove()
+
+    def might_be_taken(self, column: str, value: str) -> bool:
+        "False means free for certain, True needs checking"
+        with self._lock:
+            bloom = self._filters.get(column)
+            if bloom is None:
+                return True
+            return value in bloom
+
+    def is_taken(self, column: str, value: str) -> bool:
+        "exact answer, queries the database only on probable hits"
+        self.stats["lookups"] += 1
+        if not self.might_be_taken(column, value):
+            return False
+
+        self.stats["database_checks"] += 1
+        column_attr = getattr(self.table, column)
+        taken = (
+            db.session.query(self.table.id).filter(column_attr == value).first()
+            is not None
+        )
+        if not taken and self.warm:
+            self.stats["false_positives"] += 1
+        return taken
+
+
+def current_index() -> Optional[AvailabilityIndex]:
+    "the index of the current app, if it has one"
+    return current_app.extensions.get("availability")
@@ -0,0 +1,120 @@
+import hashlib
+import io
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Callable, Dict, Optional, Tuple
+
+from flask import current_app
+
+AVATAR_URL_PREFIX = "/avatars/"
+DEFAULT_AVATAR_URL = "/static/avatars/default.jpg"
+
+
+def avatar_name(digest: str, size: int) -> str:
+    return f"{digest}_{size}.png"
+
+
+def avatar_url(avatar_filename: Optional[str], size: int) -> str:
+    """url of a user's avatar at size
+
+    processed avatars are stored as a bare content hash, anything with an
+    extension is an upload from before the pipeline existed and only comes
+    in its original size
+    """
+    if not avatar_filename:
+        return DEFAULT_AVATAR_URL
+    if "." in avatar_filename:
+        return f"/static/avatars/{avatar_filename}"
+    return AVATAR_URL_PREFIX + avatar_name(avatar_filename, size)
+
+
+def avatar_sizes() -> Tuple[int, ...]:
+    "the sizes uploads are resized to, from the app's AVATAR_SIZES"
+    return tuple(current_app.config["AVATAR_SIZES"])
+
+
+def nearest_size(size: int) -> int:
+    "the smallest configured size at least size, the largest if none is"
+    sizes = sorted(avatar_sizes())
+    return next((candidate for candidate in sizes if candidate >= size), sizes[-1])
+
+
+def avatar_urls(
+    avatar_filename: Optional[str], sizes: Optional[Tuple[int, ...]] = None
+) -> Dict[int, str]:
+    return {size: avatar_url(avatar_filename, size) for size in sizes or avatar_sizes()}
+
+
+def process_avatar(data: bytes, directory: str, sizes: Tuple[int, ...]) -> str:
+    """decode an upload and write a square png per size, returns the digest
+
+    runs in a worker process. re-encoding from pixels drops exif and any
+    other metadata. files are named after the hash of the upload so the
+    same image always maps to the same immutable urls.
+    """
+    from PIL import Image, ImageOps
+
+    digest = hashlib.sha256(data).hexdigest()[:24]
+    with Image.open(io.BytesIO(data)) as image:
+        image.seek(0)  # first frame of animated gifs
+        image = ImageOps.exif_transpose(image).convert("RGBA")
+        for size in sizes:
+            path = os.path.join(directory, avatar_name(digest, size))
+            if os.path.exists(path):
+                continue
+            thumbnail = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            # write then rename so a half written file is never served
+            thumbnail.save(path + ".tmp", "PNG", optimize=True)
+            os.replace(path + ".tmp", path)
+    return digest
+
+
+class AvatarPipeline:
+    """resizes uploaded avatars off the request thread
+
+    on_done is called with (user_id, digest) from a pool thread once every
+    size has been written, or with (user_id, None) if the upload couldn't
+    be decoded
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        sizes: Tuple[int, ...],
+        on_done: Callable[[int, Optional[str]], None],
+        workers: int = 2,
+    ):
+        self.directory = directory
+        self.sizes = sizes
+        self.on_done = on_done
+        self._pool = ProcessPoolExecutor(workers) if workers else None
+
+    def submit(self, user_id: int, data: bytes) -> Optional[Future]:
+        os.makedirs(self.directory, exist_ok=True)
+        if self._pool is None:
+            self._finish(user_id, self._run_inline(data))
+            return None
+
+        future = self._pool.submit(process_avatar, data, self.directory, self.sizes)
+        future.add_done_callback(
+            lambda future: self._finish(
+                user_id, None if future.exception() else future.result()
+            )
+        )
+        return future
+
+    def _run_inline(self, data: bytes) -> Optional[str]:
+        try:
+            return process_avatar(data, self.directory, self.sizes)
+        except Exception:
+            return None
+
+    def _finish(self, user_id: int, digest: Optional[str]):
+        try:
+            self.on_done(user_id, digest)
+        except Exception as e:
+            print("avatar pipeline: updating user", user_id, "failed:", e)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
@@ -0,0 +1,105 @@
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+BATCH_EVENT = "batch"
+
+Key = Tuple[str, bool]
+
+
+class BroadcastBatcher:
+    """coalesces room broadcasts into one "batch" frame per interval
+
+    a burst of n messages to a room of m clients costs n * m socket writes
+    when every message is emitted on its own, batched it costs one write
+    per client per interval. the first event into an idle room is sent
+    straight away so a quiet room sees no added latency, events arriving
+    within interval of it are queued and flushed together, or as soon as
+    max_batch of them are waiting.
+
+    a batch is sent as BATCH_EVENT with a list of [event, payload] pairs,
+    a flush with one queued event sends it as itself.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[..., None],
+        interval: float = 0.01,
+        max_batch: int = 64,
+    ):
+        self._emit = emit
+        self.interval = interval
+        self.max_batch = max_batch
+        self._queues: Dict[Key, List[list]] = dict()
+        self._last_sent: Dict[Key, float] = dict()
+        self._lock = threading.Lock()
+        # notified when a room's queue opens, run_forever waits on it
+        self._opened = threading.Condition(self._lock)
+        self.stats = {"events": 0, "frames": 0}
+
+    def send(self, room: str, event: str, payload, ignore_queue: bool = False):
+        "emit event to room, possibly later and together with others"
+        if self.interval <= 0:
+            self._send(room, ignore_queue, [[event, payload]])
+            return
+
+        key = (room, ignore_queue)
+        now = time.monotonic()
+        with self._lock:
+            queue = self._queues.get(key)
+            idle = not queue and now - self._last_sent.get(key, 0) >= self.interval
+            if idle:
+                self._last_sent[key] = now
+                batch = [[event, payload]]
+            else:
+                if queue is None:
+                    queue = self._queues[key] = []
+                    self._opened.notify()
+                queue.append([event, payload])
+                if len(queue) < self.max_batch:
+                    return
+                batch = self._queues.pop(key)
+                self._last_sent[key] = now
+        self._send(room, ignore_queue, batch)
+
+    def flush(self, force: bool = False):
+        "send every queued batch whose interval has passed, or all with force"
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                key
+                for key, queue in self._queues.items()
+                if queue
+                and (force or now - self._last_sent.get(key, 0) >= self.interval)
+            ]
+            batches = [(key, self._queues.pop(key)) for key in due]
+            for key in due:
+                self._last_sent[key] = now
+        for (room, ignore_queue), batch in batches:
+            self._send(room, ignore_queue, batch)
+
+    def run_forever(self, sleep: Callable[[float], None]):
+        """flush each queue once its interval is up, run in a background task
+
+        idles on a condition while nothing is queued instead of waking up
+        every interval
+        """
+        while True:
+            with self._lock:
+                while not self._queues:
+                    self._opened.wait()
+                due = min(self._last_sent.get(key, 0) for key in self._queues)
+            delay = due + self.interval - time.monotonic()
+            if delay > 0:
+                sleep(delay)
+            self.flush()
+
+    def _send(self, room: str, ignore_queue: bool, batch: List[list]):
+        with self._lock:
+            self.stats["events"] += len(batch)
+            self.stats["frames"] += 1
+        if len(batch) == 1:
+            event, payload = batch[0]
+        else:
+            event, payload = BATCH_EVENT, batch
+        self._emit(event, payload, to=room, ignore_queue=ignore_queue)
@@ -0,0 +1,141 @@
+"""chat history latency and table size before and after archiving
+
+builds a sqlite database of --messages messages spread evenly over a year
+and a few rooms, times history pages near the present and far back, moves
+everything older than --days to an archive with archive_older_than and
+times the same pages again, now partly read from the archive. runs in
+process, no server needed.
+
+    python benchmarks/archive.py --messages 2000000 --days 90
+"""
+
+import argparse
+import json
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from importlib import import_module
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from common import PACKAGE, percentiles
+
+archive = import_module(f"{PACKAGE}.archive")
+history = import_module(f"{PACKAGE}.history")
+sql_models = import_module(f"{PACKAGE}.sql_models")
+
+END = datetime(2025, 1, 1)
+SECONDS = 365 * 24 * 3600
+WORDS = "the a chat room message hello again later maybe yes no why ok".split()
+
+
+def build(path: Path, messages: int, rooms: int, seed: int):
+    rng = random.Random(seed)
+    sql_models.db.metadata.create_all(create_engine(f"sqlite:///{path}"))
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO rooms (id, name) VALUES (?, ?)",
+        ((i, "chat" if i == 1 else f"room{i}") for i in range(1, rooms + 1)),
+    )
+    start = END - timedelta(seconds=SECONDS)
+    step = SECONDS / messages
+    connection.executemany(
+        "INSERT INTO messages (id, text, datetime, user_id, room_id)"
+        " VALUES (?, ?, ?, ?, ?)",
+        (
+            (
+                i + 1,
+                " ".join(rng.choices(WORDS, k=rng.randint(2, 15))),
+                # the format sqlalchemy stores, so keys compare the same
+                (start + timedelta(seconds=i * step)).strftime("%Y-%m-%d %H:%M:%S.%f"),
+                rng.randint(1, 1000),
+                rng.randint(1, rooms),
+            )
+            for i in range(messages)
+        ),
+    )
+    connection.commit()
+    connection.close()
+
+
+def app_for(path: Path):
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    sql_models.db.init_app(app)
+    return app
+
+
+def time_pages(message_archive, runs: int, limit: int) -> dict:
+    "history pages of room 1 that start this many days back"
+    results = dict()
+    for days in (0, 30, 180, 360):
+        key = None
+        if days:
+            key = ((END - timedelta(days=days)).timestamp(), 0)
+        samples = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            page = history.fetch_page(
+                key, history.BEFORE, limit, room_id=1, archive=message_archive
+            )
+            samples.append(time.perf_counter() - start)
+        results[f"{days} days back"] = dict(
+            percentiles(samples, (50, 95)), messages=len(page.messages)
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--batch", type=int, default=20_000)
+    parser.add_argument("--block-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    tempdir = tempfile.TemporaryDirectory(prefix="chat-archive-")
+    path = Path(tempdir.name) / "chat.db"
+    report = {"messages": args.messages, "rooms": args.rooms}
+    start = time.perf_counter()
+    build(path, args.messages, args.rooms, args.seed)
+    report["build_seconds"] = time.perf_counter() - start
+    report["database_bytes"] = path.stat().st_size
+
+    app = app_for(path)
+    message_archive = archive.MessageArchive(
+        Path(tempdir.name) / "archive", args.block_size
+    )
+    with app.app_context():
+        report["before"] = time_pages(None, args.runs, args.limit)
+
+        cutoff = END - timedelta(days=args.days)
+        moved, start = 0, time.perf_counter()
+        while True:
+            count = archive.archive_older_than(message_archive, cutoff, args.batch)
+            moved += count
+            if count < args.batch:
+                break
+        report["archive_seconds"] = time.perf_counter() - start
+        report["archived"] = moved
+        sql_models.db.session.execute(sql_models.db.text("VACUUM"))
+        report["database_bytes_after"] = path.stat().st_size
+        report["archive_bytes"] = message_archive.stats["bytes"]
+
+        report["after"] = time_pages(message_archive, args.runs, args.limit)
+
+    print(json.dumps(report, indent=2))
+    tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""how many connected chat clients one server process sustains per async mode
+
+clients are added in steps, after each step a probe client round-trips a
+get-messages request. a step fails when clients can't connect or the
+probe's p95 latency goes over --max-latency. results are printed as json.
+
+    python benchmarks/async_modes.py --modes threading eventlet --max 2000
+"""
+
+import argparse
+import json
+import threading
+import time
+from typing import List
+
+import socketio
+
+from common import Server, cookie_header, login, percentiles
+
+
+def connect(url: str, cookie: str) -> socketio.Client:
+    client = socketio.Client(reconnection=False)
+    client.connect(url, headers={"Cookie": cookie}, wait_timeout=10)
+    return client
+
+
+def probe(client: socketio.Client, rounds: int) -> List[float]:
+    "round-trip latency of get-messages in seconds"
+    done = threading.Event()
+    client.on("return-messages", lambda messages: done.set())
+    samples = []
+    for _ in range(rounds):
+        done.clear()
+        start = time.perf_counter()
+        client.emit("get-messages", {"since": None})
+        if not done.wait(10):
+            samples.append(float("inf"))
+            continue
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def run_mode(args, async_mode: str) -> dict:
+    steps = []
+    with Server(users=args.users, async_mode=async_mode, messages=100) as server:
+        cookies = [cookie_header(login(server.url, name)) for name in server.usernames]
+        prober = connect(server.url, cookies[0])
+        clients = []
+        sustained = 0
+        try:
+            while len(clients) < args.max:
+                target = min(len(clients) + args.step, args.max)
+                failures = 0
+                start = time.perf_counter()
+                while len(clients) < target:
+                    try:
+                        clients.append(
+                            connect(server.url, cookies[len(clients) % len(cookies)])
+                        )
+                    except socketio.exceptions.ConnectionError:
+                        failures += 1
+                        if failures > args.step // 10:
+                            break
+                connect_seconds = time.perf_counter() - start
+
+                latency = percentiles(probe(prober, args.probes))
+                step = {
+                    "clients": len(clients),
+                    "connect_failures": failures,
+                    "connect_seconds": connect_seconds,
+                    "probe_latency": latency,
+                    "server_rss_bytes": server.rss_bytes(),
+                }
+                steps.append(step)
+                print(async_mode, json.dumps(step))
+                if failures > args.step // 10 or latency["p95"] > args.max_latency:
+                    break
+                sustained = len(clients)
+        finally:
+            for client in clients + [prober]:
+                client.disconnect()
+
+    return {"async_mode": async_mode, "sustained_clients": sustained, "steps": steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threading"])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--step", type=int, default=100)
+    parser.add_argument("--max", type=int, default=1000)
+    parser.add_argument("--probes", type=int, default=20)
+    parser.add_argument("--max-latency", type=float, default=0.5)
+    parser.add_argument("--output", help="write results to this json file")
+    args = parser.parse_args()
+
+    results = [run_mode(args, mode) for mode in args.modes]
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    print(
+        json.dumps(
+            [{k: r[k] for k in ("async_mode", "sustained_clients")} for r in results]
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""server cpu and socket writes per chat message at high fan-out
+
+a burst of messages is broadcast to a room of connected clients through a
+real python-socketio server, once emitted one by one and once through the
+broadcast batcher at each interval. engine.io's send is replaced
+by a counter, every call to it would be one websocket write (a send
+syscall) for a real client. runs in process, no server needed.
+
+    python benchmarks/broadcast_batching.py --clients 1000 --messages 500
+"""
+
+import argparse
+import json
+import time
+from importlib import import_module
+from typing import Tuple
+
+import socketio
+
+from common import PACKAGE
+
+batching = import_module(f"{PACKAGE}.batching")
+
+
+class CountingTransport:
+    "replaces engine.io's send, encodes packets but counts instead of writing"
+
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def send_packet(self, eio_sid, packet):
+        self.writes += 1
+        self.bytes += len(packet.encode())
+
+
+def room_server(clients: int) -> Tuple[socketio.Server, CountingTransport]:
+    server = socketio.Server()
+    transport = CountingTransport()
+    server.eio.send_packet = transport.send_packet
+    for i in range(clients):
+        sid = server.manager.connect(f"eio-{i}", "/")
+        server.manager.enter_room(sid, "/", "chat")
+    return server, transport
+
+
+def run(args, interval: float) -> dict:
+    server, transport = room_server(args.clients)
+    emit_seconds = 0.0
+
+    def emit(*a, **kw):
+        # time spent encoding and writing, the pacing sleeps don't count
+        nonlocal emit_seconds
+        start = time.process_time()
+        server.emit(*a, **kw)
+        emit_seconds += time.process_time() - start
+
+    batcher = batching.BroadcastBatcher(emit, interval, args.max_batch)
+    message = {"id": 1, "text": "hello room", "datetime": time.time(), "user_id": 1}
+
+    # messages arrive spread over burst_seconds, the batcher's background
+    # flush is driven inline to keep the run single threaded
+    gap = args.burst_seconds / args.messages
+    start = time.perf_counter()
+    for i in range(args.messages):
+        batcher.send("chat", "chat-message", dict(message, id=i))
+        batcher.flush()
+        time.sleep(max(0.0, start + (i + 1) * gap - time.perf_counter()))
+    batcher.flush(force=True)
+
+    return {
+        "interval": interval,
+        "messages": args.messages,
+        "clients": args.clients,
+        "frames": batcher.stats["frames"],
+        "writes_per_message": transport.writes / args.messages,
+        "bytes_per_message": transport.bytes / args.messages,
+        "cpu_us_per_message": emit_seconds / args.messages * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--burst-seconds", type=float, default=1.0)
+    parser.add_argument(
+        "--intervals", type=float, nargs="+", default=[0, 0.005, 0.01, 0.02]
+    )
+    parser.add_argument("--max-batch", type=int, default=64)
+    args = parser.parse_args()
+
+    print(json.dumps([run(args, interval) for interval in args.intervals], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""latency of the terminal client's pooled session against per-request calls
+
+starts chat_server, logs in two users and measures
+
+    requests  the same http call made with a fresh requests.post every
+              time, the way chat_client used to, and through the pooled
+              session ChatConnection keeps
+    delivery  how long a message sent by one user takes to show up for
+              the other: polling chat history with fresh requests every
+              --poll-interval seconds against the socket.io push
+
+    python benchmarks/client_latency.py --requests 500 --messages 100
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+
+import requests
+
+from common import PASSWORD, REPO, Server, cookie_header, percentiles
+
+# chat_client is a script that imports its neighbours as top level modules
+sys.path.insert(0, str(REPO))
+
+from chat_client import ChatConnection  # noqa: E402
+
+
+def time_calls(call, count: int) -> dict:
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        call().raise_for_status()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def request_latency(client: ChatConnection, count: int) -> dict:
+    url = client.url + "/api/get/chat/history"
+    headers = {"Cookie": cookie_header(client.http)}
+    return {
+        "per_request": time_calls(
+            lambda: requests.post(url, json={"limit": 1}, headers=headers), count
+        ),
+        "pooled": time_calls(lambda: client.http.post(url, json={"limit": 1}), count),
+    }
+
+
+def polled_delivery(sender: ChatConnection, receiver: ChatConnection, args) -> dict:
+    url = receiver.url + "/api/get/chat/history"
+    headers = {"Cookie": cookie_header(receiver.http)}
+    samples = []
+    for i in range(args.messages):
+        text = f"poll {i}"
+        start = time.perf_counter()
+        sender.send(text)
+        while True:
+            resp = requests.post(url, json={"limit": 5}, headers=headers)
+            if any(message["text"] == text for message in resp.json()["messages"]):
+                break
+            time.sleep(args.poll_interval)
+        samples.append(time.perf_counter() - start)
+        # stay under the chat-message rate limit
+        time.sleep(args.send_interval)
+    return percentiles(samples)
+
+
+def pushed_delivery(sender: ChatConnection, receiver: ChatConnection, args) -> dict:
+    arrived = threading.Event()
+    expected = [None]
+
+    def on_message(message: dict):
+        if message["text"] == expected[0]:
+            arrived.set()
+
+    receiver.on_message = on_message
+    samples = []
+    for i in range(args.messages):
+        expected[0] = f"push {i}"
+        arrived.clear()
+        start = time.perf_counter()
+        sender.send(expected[0])
+        if not arrived.wait(10):
+            raise RuntimeError(f"message {i} never arrived")
+        samples.append(time.perf_counter() - start)
+        time.sleep(args.send_interval)
+    return percentiles(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--send-interval", type=float, default=0.25)
+    parser.add_argument("--async-mode", default="threading")
+    args = parser.parse_args()
+
+    with Server(users=2, async_mode=args.async_mode, messages=10) as server:
+        clients = [ChatConnection(server.url) for _ in server.usernames]
+        for client, name in zip(clients, server.usernames):
+            failure = client.login(name, PASSWORD)
+            if failure:
+                raise RuntimeError(f"login failed for {name}: {failure}")
+            client.connect()
+        sender, receiver = clients
+        try:
+            result = {
+                "requests": request_latency(receiver, args.requests),
+                "delivery": {
+                    "polled": polled_delivery(sender, receiver, args),
+                    "pushed": pushed_delivery(sender, receiver, args),
+                },
+                "poll_interval": args.poll_interval,
+            }
+        finally:
+            for client in clients:
+                client.close()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
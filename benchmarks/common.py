@@ -0,0 +1,176 @@
+"""helpers shared by the benchmark scripts
+
+the scripts import the app as a package, so the repository directory has
+to be importable (a valid python identifier) from its parent directory
+"""
+
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import requests
+
+REPO = Path(__file__).resolve().parents[1]
+PACKAGE = REPO.name
+PASSWORD = "benchmark-password"
+
+sys.path.insert(0, str(REPO.parent))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def create_database(
+    workdir: Path,
+    users: int,
+    messages: int = 0,
+    password_method: str = "pbkdf2:sha256:1",
+) -> List[str]:
+    """create the server database inside workdir with synthetic users
+
+    the server resolves its sqlite path relative to its working directory
+    so running it from workdir picks this database up. every account shares
+    one password hash, cheap unless password_method says otherwise
+    """
+    from datetime import datetime, timedelta
+    from importlib import import_module
+
+    from flask import Flask
+    from werkzeug.security import generate_password_hash
+
+    sql_models = import_module(f"{PACKAGE}.sql_models")
+    db, User, Message = sql_models.db, sql_models.User, sql_models.Message
+
+    (workdir / "local" / "test").mkdir(parents=True, exist_ok=True)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = (
+        f"sqlite:///{workdir / 'local' / 'test' / 'database.db'}"
+    )
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+
+    password = generate_password_hash(PASSWORD, password_method)
+    usernames = [f"bench{i:05d}" for i in range(users)]
+    with app.app_context():
+        db.create_all()
+        db.session.execute(
+            User.__table__.insert(),
+            [
+                {"username": name, "email": f"{name}@example.com", "password": password}
+                for name in usernames
+            ],
+        )
+        start = datetime.utcnow() - timedelta(seconds=messages)
+        # an empty parameter list would insert a single row of defaults
+        if messages:
+            db.session.execute(
+                Message.__table__.insert(),
+                [
+                    {
+                        "text": f"history message {i}",
+                        "datetime": start + timedelta(seconds=i),
+                        "user_id": i % users + 1,
+                    }
+                    for i in range(messages)
+                ],
+            )
+        db.session.commit()
+    return usernames
+
+
+class Server:
+    "chat_server running in a subprocess against a throwaway database"
+
+    def __init__(
+        self,
+        users: int,
+        async_mode: str = "threading",
+        messages: int = 0,
+        env: Optional[Dict[str, str]] = None,
+        password_method: str = "pbkdf2:sha256:1",
+    ):
+        self.async_mode = async_mode
+        self.port = free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._tempdir = tempfile.TemporaryDirectory(prefix="chat-bench-")
+        self.workdir = Path(self._tempdir.name)
+        self.usernames = create_database(self.workdir, users, messages, password_method)
+        self._env = dict(os.environ, CHAT_ASYNC_MODE=async_mode, **(env or {}))
+        self.process: Optional[subprocess.Popen] = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                str(REPO / "benchmarks" / "run_server.py"),
+                str(self.port),
+            ],
+            cwd=self.workdir,
+            env=self._env,
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                requests.get(self.url + "/", timeout=1)
+                return self
+            except requests.ConnectionError:
+                time.sleep(0.2)
+        self.__exit__()
+        raise RuntimeError("chat server did not start")
+
+    def __exit__(self, *exc):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(10)
+        self._tempdir.cleanup()
+
+    def rss_bytes(self) -> int:
+        "resident set size of the server process, from /proc"
+        with open(f"/proc/{self.process.pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+
+def post_login(url: str, username: str) -> Tuple[requests.Session, int]:
+    "submit the html login form, returns the session and the response status"
+    session = requests.Session()
+    page = session.get(url + "/login").text
+    match = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page)
+    data = {"username": username, "password": PASSWORD}
+    if match:
+        data["csrf_token"] = match.group(1)
+    resp = session.post(url + "/login", data=data, allow_redirects=False)
+    return session, resp.status_code
+
+
+def login(url: str, username: str) -> requests.Session:
+    "log in through the html form, returns a session holding the cookie"
+    session, status = post_login(url, username)
+    if status != 302:
+        raise RuntimeError(f"login failed for {username}: {status}")
+    return session
+
+
+def cookie_header(session: requests.Session) -> str:
+    return "; ".join(f"{name}={value}" for name, value in session.cookies.items())
+
+
+def percentiles(samples: List[float], points=(50, 95, 99)) -> Dict[str, float]:
+    if not samples:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(samples)
+    return {
+        f"p{p}": ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+        for p in points
+    }
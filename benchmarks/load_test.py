@@ -0,0 +1,306 @@
+"""load test of many concurrent socket.io chat clients against one server
+
+starts chat_server on a throwaway sqlite database, logs in one synthetic
+user per client, connects every client and then runs the chosen workloads
+for --duration seconds:
+
+    chat      clients send messages at --message-rate per second in total,
+              latency is measured from send until each client receives it
+    presence  clients disconnect and reconnect, --churn-rate per second
+    history   clients page back through chat history over http,
+              --history-rate requests per second
+
+results are printed and, with --output, saved as json. --compare takes an
+earlier result file and prints how the headline numbers moved.
+
+    python benchmarks/load_test.py --clients 500 --duration 30 \\
+        --workloads chat presence history --output results/load.json
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import requests
+import socketio
+
+from common import REPO, Server, cookie_header, login, percentiles
+
+MARKER = "load-test"
+
+
+class Recorder:
+    "samples and counters shared by every client thread"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def sample(self, name: str, seconds: float):
+        with self._lock:
+            self.samples[name].append(seconds)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] += n
+
+
+class LoadClient:
+    "one socket.io chat client, records when it receives load test messages"
+
+    def __init__(self, url: str, cookie: str, recorder: Recorder):
+        self.url = url
+        self.cookie = cookie
+        self.recorder = recorder
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("chat-message", self._on_chat_message)
+        self.sio.on("batch", self._on_batch)
+        self.sio.on("rate-limited", self._on_rate_limited)
+
+    def connect(self):
+        start = time.perf_counter()
+        self.sio.connect(self.url, headers={"Cookie": self.cookie}, wait_timeout=10)
+        self.recorder.sample("connect", time.perf_counter() - start)
+
+    def disconnect(self):
+        self.sio.disconnect()
+
+    def send(self, text: str):
+        self.sio.emit("chat-message", {"text": text})
+
+    def _on_chat_message(self, message: dict):
+        # "load-test <sent unix time>", everything else is someone else's
+        marker, _, sent = message.get("text", "").partition(" ")
+        if marker == MARKER:
+            self.recorder.sample("message", time.time() - float(sent))
+            self.recorder.count("received")
+
+    def _on_batch(self, events: list):
+        self.recorder.count("batches")
+        for event, payload in events:
+            if event == "chat-message":
+                self._on_chat_message(payload)
+
+    def _on_rate_limited(self, limited: dict):
+        self.recorder.count(f"rate_limited:{limited['event']}")
+
+
+def paced(rate: float, duration: float, action, stop: threading.Event):
+    "call action rate times per second for duration seconds"
+    if rate <= 0:
+        return
+    start = time.perf_counter()
+    calls = 0
+    while not stop.is_set():
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return
+        due = int(elapsed * rate)
+        while calls < due:
+            action()
+            calls += 1
+        time.sleep(min(0.01, 1 / rate))
+
+
+def chat_workload(clients: List[LoadClient], recorder: Recorder):
+    def send():
+        client = random.choice(clients)
+        if client.sio.connected:
+            client.send(f"{MARKER} {time.time()!r}")
+            recorder.count("sent")
+
+    return send
+
+
+def presence_workload(clients: List[LoadClient], recorder: Recorder):
+    def churn():
+        client = random.choice(clients)
+        if not client.sio.connected:
+            return
+        client.disconnect()
+        try:
+            client.connect()
+            recorder.count("reconnects")
+        except socketio.exceptions.ConnectionError:
+            recorder.count("reconnect_failures")
+
+    return churn
+
+
+def history_workload(url: str, sessions: List[requests.Session], recorder: Recorder):
+    def page():
+        session = random.choice(sessions)
+        start = time.perf_counter()
+        resp = session.post(
+            url + "/api/get/chat/history", json={"limit": 100}, timeout=30
+        )
+        recorder.sample("history", time.perf_counter() - start)
+        recorder.count("history_ok" if resp.ok else "history_errors")
+
+    return page
+
+
+def run(args) -> dict:
+    recorder = Recorder()
+    with Server(
+        users=args.clients, async_mode=args.async_mode, messages=args.history
+    ) as server:
+        sessions = [login(server.url, name) for name in server.usernames]
+        clients = [
+            LoadClient(server.url, cookie_header(session), recorder)
+            for session in sessions
+        ]
+        start = time.perf_counter()
+        for client in clients:
+            client.connect()
+        ramp_seconds = time.perf_counter() - start
+        rss_idle = server.rss_bytes()
+
+        workloads = {
+            "chat": (chat_workload(clients, recorder), args.message_rate),
+            "presence": (presence_workload(clients, recorder), args.churn_rate),
+            "history": (
+                history_workload(server.url, sessions, recorder),
+                args.history_rate,
+            ),
+        }
+        stop = threading.Event()
+        threads = [
+            threading.Thread(
+                target=paced, args=(rate, args.duration, action, stop), daemon=True
+            )
+            for name, (action, rate) in workloads.items()
+            if name in args.workloads
+        ]
+        rss_samples = []
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                rss_samples.append(server.rss_bytes())
+                time.sleep(1)
+        except KeyboardInterrupt:
+            # stop early but still report what was measured
+            stop.set()
+        elapsed = time.perf_counter() - start
+        # let messages still in flight arrive
+        time.sleep(args.drain)
+
+        connected = sum(client.sio.connected for client in clients)
+        for client in clients:
+            if client.sio.connected:
+                client.disconnect()
+
+    counts = dict(recorder.counts)
+    sent = counts.get("sent", 0)
+    received = counts.get("received", 0)
+    return {
+        "clients": args.clients,
+        "connected_at_end": connected,
+        "async_mode": args.async_mode,
+        "workloads": args.workloads,
+        "duration": elapsed,
+        "ramp_seconds": ramp_seconds,
+        "messages_sent": sent,
+        "messages_per_second": sent / elapsed if elapsed else 0,
+        "deliveries": received,
+        "deliveries_per_second": received / elapsed if elapsed else 0,
+        # every client is in the room, including the sender
+        "delivery_ratio": received / (sent * args.clients) if sent else None,
+        "message_latency": percentiles(recorder.samples["message"]),
+        "connect_latency": percentiles(recorder.samples["connect"]),
+        "history_latency": percentiles(recorder.samples["history"]),
+        "server_rss_bytes": {
+            "idle": rss_idle,
+            "peak": max(rss_samples, default=rss_idle),
+        },
+        "counts": counts,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+HEADLINES = (
+    ("messages_per_second", ()),
+    ("deliveries_per_second", ()),
+    ("message_latency", ("p50", "p95", "p99")),
+    ("history_latency", ("p50", "p95", "p99")),
+    ("server_rss_bytes", ("peak",)),
+)
+
+
+def compare(baseline: dict, result: dict):
+    "print how the headline numbers changed since baseline"
+    print(f"compared to {baseline.get('revision')} ({baseline.get('started')}):")
+    for name, keys in HEADLINES:
+        for key in keys or (None,):
+            old = baseline["result"].get(name)
+            new = result.get(name)
+            if key is not None:
+                old, new = (old or {}).get(key), (new or {}).get(key)
+            label = f"{name}.{key}" if key else name
+            if not old or new is None:
+                print(f"  {label}: {old} -> {new}")
+                continue
+            print(f"  {label}: {old:.4g} -> {new:.4g} ({(new - old) / old:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--workloads",
+        nargs="+",
+        choices=("chat", "presence", "history"),
+        default=["chat"],
+    )
+    parser.add_argument("--message-rate", type=float, default=20)
+    parser.add_argument("--churn-rate", type=float, default=2)
+    parser.add_argument("--history-rate", type=float, default=5)
+    parser.add_argument("--history", type=int, default=1000, help="seed messages")
+    parser.add_argument("--async-mode", default="threading")
+    parser.add_argument("--drain", type=float, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write results to this json file")
+    parser.add_argument("--compare", help="earlier --output file to compare with")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    started = time.strftime("%Y-%m-%dT%H:%M:%S")
+    result = run(args)
+    report = {
+        "revision": git_revision(),
+        "started": started,
+        "arguments": vars(args),
+        "result": result,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(json.load(baseline), result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""login throughput and latency of unrelated requests during a login burst
+
+every account logs in at once while a probe thread keeps requesting an
+unrelated page. run once with hashing on the request threads and once
+per pool size. results are printed as json.
+
+    python benchmarks/login_burst.py --users 200 --workers 0 2 4
+"""
+
+import argparse
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from importlib import import_module
+from typing import Tuple
+
+import requests
+
+from common import PACKAGE, Server, percentiles, post_login
+
+config = import_module(f"{PACKAGE}.config")
+
+
+def probed(url: str, func) -> Tuple[object, list]:
+    "run func while timing requests to an unrelated page, returns both"
+    samples = []
+    stop = threading.Event()
+
+    def probe():
+        session = requests.Session()
+        while not stop.is_set():
+            start = time.perf_counter()
+            session.get(url + "/api/get/user/1/stats", timeout=30)
+            samples.append(time.perf_counter() - start)
+
+    prober = threading.Thread(target=probe)
+    prober.start()
+    try:
+        return func(), samples
+    finally:
+        stop.set()
+        prober.join()
+
+
+def run(args, workers: int) -> dict:
+    with Server(
+        users=args.users,
+        env={"CHAT_PASSWORD_WORKERS": str(workers)},
+        password_method=config.PASSWORD_HASH_METHOD,
+    ) as server:
+        _, idle = probed(server.url, lambda: time.sleep(args.idle_seconds))
+
+        def burst():
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                return list(
+                    pool.map(
+                        lambda name: post_login(server.url, name)[1], server.usernames
+                    )
+                )
+
+        start = time.perf_counter()
+        statuses, busy = probed(server.url, burst)
+        elapsed = time.perf_counter() - start
+
+    return {
+        "password_workers": workers,
+        "logins": statuses.count(302),
+        "rejected": statuses.count(503),
+        "other_errors": len(statuses) - statuses.count(302) - statuses.count(503),
+        "seconds": elapsed,
+        "logins_per_second": statuses.count(302) / elapsed,
+        "probe_latency_idle": percentiles(idle),
+        "probe_latency_during_burst": percentiles(busy),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--idle-seconds", type=float, default=2)
+    args = parser.parse_args()
+
+    print(json.dumps([run(args, workers) for workers in args.workers], indent=2))
+
+
+if __name__ == "__main__":
+    main()
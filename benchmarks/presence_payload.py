@@ -0,0 +1,72 @@
+"""bytes and server cpu per connect for the presence protocol
+
+compares the old online-users-mapping dump of every registered user with
+the versioned snapshot of online users, plus the size of a single delta.
+runs in process, no server needed.
+
+    python benchmarks/presence_payload.py --users 10000 100000
+"""
+
+import argparse
+import json
+import time
+from importlib import import_module
+
+from common import PACKAGE
+
+presence = import_module(f"{PACKAGE}.presence")
+
+
+def timed(func, rounds: int) -> float:
+    "mean seconds per call"
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+
+def run(users: int, online_fraction: float, rounds: int) -> dict:
+    # the old payload: {id: PublicUser.__dict__} for every registered user
+    full_dump = {
+        user_id: {
+            "id": user_id,
+            "username": f"user{user_id:07d}",
+            "avatar_filename": f"user_{user_id}_avatar.jpg",
+            "online": user_id % int(1 / online_fraction) == 0,
+        }
+        for user_id in range(users)
+    }
+
+    log = presence.PresenceLog()
+    for user in full_dump.values():
+        if user["online"]:
+            log.join(user["id"], user["username"], user["avatar_filename"])
+    delta = log.leave(0)
+
+    return {
+        "users": users,
+        "online": len(log.snapshot()["users"]),
+        "full_dump_bytes": len(json.dumps(full_dump)),
+        "snapshot_bytes": len(json.dumps(log.snapshot())),
+        "delta_bytes": len(json.dumps(delta)),
+        "full_dump_seconds": timed(lambda: json.dumps(full_dump), rounds),
+        "snapshot_seconds": timed(lambda: json.dumps(log.snapshot()), rounds),
+        "resync_seconds": timed(
+            lambda: json.dumps(log.since(log.epoch, log.version - 1)), rounds
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--online-fraction", type=float, default=0.05)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    for users in args.users:
+        print(json.dumps(run(users, args.online_fraction, args.rounds)))
+
+
+if __name__ == "__main__":
+    main()
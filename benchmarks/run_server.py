@@ -0,0 +1,17 @@
+"runs chat_server for the benchmarks, usage: run_server.py <port>"
+
+import sys
+from importlib import import_module
+from pathlib import Path
+
+# nothing else may be imported first, chat_server may monkey patch
+REPO = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO.parent))
+chat_server = import_module(f"{REPO.name}.chat_server")
+
+with chat_server.app.app_context():
+    chat_server.db.create_all()
+
+chat_server.socketio.run(
+    chat_server.app, host="127.0.0.1", port=int(sys.argv[1]), log_output=False
+)
@@ -0,0 +1,195 @@
+"""full text search latency on a large synthetic chat history
+
+builds a sqlite database of --messages messages from a zipf distributed
+vocabulary, indexes it with search.ensure_index and times a set of queries
+from very selective to very broad, each with and without filters. also
+measures what the index triggers cost the message writer's bulk inserts.
+runs in process, no server needed.
+
+    python benchmarks/search.py --messages 2000000 --database /tmp/search.db
+"""
+
+import argparse
+import json
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+from importlib import import_module
+from pathlib import Path
+
+from sqlalchemy import create_engine
+
+from common import PACKAGE, percentiles
+
+search = import_module(f"{PACKAGE}.search")
+sql_models = import_module(f"{PACKAGE}.sql_models")
+
+VOCABULARY = 50_000
+USERS = 1000
+START = datetime(2024, 1, 1)
+
+
+def word(rank: int) -> str:
+    "a pronounceable made up word, rank 0 the most common"
+    consonants, vowels = "bcdfghklmnprstvz", "aeiou"
+    letters = []
+    rank += 1
+    while rank:
+        rank, c = divmod(rank, len(consonants))
+        rank, v = divmod(rank, len(vowels))
+        letters.append(consonants[c] + vowels[v])
+    return "".join(letters)
+
+
+def zipf_words(rng: random.Random, count: int):
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+    return rng.choices(range(VOCABULARY), weights, k=count)
+
+
+def generate(rng: random.Random, messages: int, seconds: int):
+    "rows of (text, datetime, user_id), evenly spread over seconds"
+    step = seconds / messages
+    chunk = 100_000
+    for first in range(0, messages, chunk):
+        n = min(chunk, messages - first)
+        lengths = [rng.randint(3, 20) for _ in range(n)]
+        ranks = iter(zipf_words(rng, sum(lengths)))
+        for i, length in enumerate(lengths):
+            text = " ".join(word(next(ranks)) for _ in range(length))
+            when = START + timedelta(seconds=(first + i) * step)
+            yield text, when.isoformat(" "), rng.randrange(1, USERS + 1)
+
+
+def build(path: Path, messages: int, seed: int):
+    connection = sqlite3.connect(path)
+    sql_models.db.metadata.create_all(
+        create_engine(f"sqlite:///{path}"),
+        tables=[
+            sql_models.User.__table__,
+            sql_models.Room.__table__,
+            sql_models.Message.__table__,
+        ],
+    )
+    connection.execute("INSERT INTO rooms (id, name) VALUES (1, 'chat')")
+    connection.executemany(
+        "INSERT INTO users (id, username) VALUES (?, ?)",
+        ((i, f"user{i}") for i in range(1, USERS + 1)),
+    )
+    connection.executemany(
+        "INSERT INTO messages (text, datetime, user_id) VALUES (?, ?, ?)",
+        generate(random.Random(seed), messages, 365 * 24 * 3600),
+    )
+    connection.commit()
+    connection.close()
+
+
+def app_for(path: Path):
+    from flask import Flask
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    sql_models.db.init_app(app)
+    return app
+
+
+def queries():
+    "(name, text, filters) from one rare word to several common ones"
+    middle = START + timedelta(days=180)
+    cases = [
+        ("rare word", word(40_000), {}),
+        ("mid word", word(500), {}),
+        ("common word", word(2), {}),
+        ("two words", f"{word(10)} {word(200)}", {}),
+        ("prefix", word(30)[:3] + "*", {}),
+    ]
+    filtered = []
+    for name, text, _ in cases:
+        filtered.append((f"{name} by user", text, {"user_id": 7}))
+        filtered.append(
+            (
+                f"{name} in a week",
+                text,
+                {"since": middle, "until": middle + timedelta(days=7)},
+            )
+        )
+    return cases + filtered
+
+
+def time_queries(runs: int, fts: bool) -> dict:
+    results = dict()
+    for name, text, filters in queries():
+        for order in search.ORDERS:
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                page = search.search(text, order=order, fts=fts, **filters)
+                samples.append(time.perf_counter() - start)
+            results[f"{name}, {order}"] = dict(
+                percentiles(samples, (50, 95)), results=len(page.results)
+            )
+    return results
+
+
+def insert_cost(app, batch: int, batches: int) -> dict:
+    "seconds per bulk insert of batch messages, with and without the index"
+    db, Message = sql_models.db, sql_models.Message
+    rows = [
+        {"text": text, "datetime": START, "user_id": user_id}
+        for text, _, user_id in generate(random.Random(1), batch, 1)
+    ]
+    result = dict()
+    with app.app_context():
+        for indexed in (True, False):
+            if not indexed:
+                for suffix in ("insert", "delete", "update"):
+                    db.session.execute(
+                        db.text(f"DROP TRIGGER {search.FTS_TABLE}_{suffix}")
+                    )
+            samples = []
+            for _ in range(batches):
+                start = time.perf_counter()
+                db.session.execute(Message.__table__.insert(), rows)
+                db.session.commit()
+                samples.append(time.perf_counter() - start)
+            result["indexed" if indexed else "plain"] = percentiles(samples, (50,))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database", help="reuse or keep the database here")
+    parser.add_argument("--scan", action="store_true", help="also time LIKE scans")
+    args = parser.parse_args()
+
+    tempdir = tempfile.TemporaryDirectory(prefix="chat-search-")
+    path = Path(args.database or Path(tempdir.name) / "search.db")
+    report = {"messages": args.messages}
+    if not path.exists():
+        start = time.perf_counter()
+        build(path, args.messages, args.seed)
+        report["build_seconds"] = time.perf_counter() - start
+
+    app = app_for(path)
+    with app.app_context():
+        start = time.perf_counter()
+        search.ensure_index()
+        report["index_seconds"] = time.perf_counter() - start
+        report["database_bytes"] = path.stat().st_size
+        report["fts"] = time_queries(args.runs, fts=True)
+        if args.scan:
+            report["scan"] = time_queries(max(1, args.runs // 10), fts=False)
+
+    if not args.database:
+        report["bulk_insert_200"] = insert_cost(app, 200, 20)
+    print(json.dumps(report, indent=2))
+    tempdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
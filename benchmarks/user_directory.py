@@ -0,0 +1,121 @@
+"""startup time and memory of the user directory against a large user table
+
+compares the old eager load (every account turned into a PublicUser
+before the first request) with the lazy LRU directory. each mode runs in
+a fresh process so its RSS is measured on its own.
+
+    python benchmarks/user_directory.py --users 1000000
+"""
+
+import argparse
+import json
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+from pathlib import Path
+
+from common import PACKAGE
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def create_users(path: Path, users: int):
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(15) UNIQUE,"
+        " email VARCHAR(50) UNIQUE, password VARCHAR(80), avatar_filename"
+        " VARCHAR(30), post_count INTEGER NOT NULL DEFAULT 0)"
+    )
+    db.executemany(
+        "INSERT INTO users (id, username, email, password, avatar_filename)"
+        " VALUES (?, ?, ?, 'x', 'default.jpg')",
+        ((i, f"u{i}", f"u{i}@example.com") for i in range(1, users + 1)),
+    )
+    db.commit()
+    db.close()
+
+
+def child(mode: str, path: str, users: int):
+    from flask import Flask
+
+    sql_models = import_module(f"{PACKAGE}.sql_models")
+    user_directory = import_module(f"{PACKAGE}.user_directory")
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    sql_models.db.init_app(app)
+    baseline = rss_bytes()
+
+    with app.app_context():
+        start = time.perf_counter()
+        if mode == "eager":
+            # what load_users did before: every account up front
+            directory = {
+                db_user.id: user_directory.PublicUser.from_db(db_user)
+                for db_user in sql_models.User.query.all()
+            }
+            lookup = directory.get
+        else:
+            manager = user_directory.PublicUserManager()
+            manager.load_from_db(app)
+            lookup = manager.lookup_user
+        startup = time.perf_counter() - start
+
+        ids = random.sample(range(1, users + 1), 1000)
+        start = time.perf_counter()
+        for user_id in ids:
+            lookup(user_id)
+        first_lookups = (time.perf_counter() - start) / len(ids)
+
+        start = time.perf_counter()
+        for user_id in ids:
+            lookup(user_id)
+        cached_lookups = (time.perf_counter() - start) / len(ids)
+
+    print(
+        json.dumps(
+            {
+                "mode": mode,
+                "startup_seconds": startup,
+                "rss_growth_bytes": rss_bytes() - baseline,
+                "first_lookup_seconds": first_lookups,
+                "cached_lookup_seconds": cached_lookups,
+            }
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.users)
+        return
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        path = Path(tempdir) / "users.db"
+        create_users(path, args.users)
+        for mode in ("eager", "lazy"):
+            subprocess.run(
+                [sys.executable, __file__, "--users", str(args.users)]
+                + ["--child", mode, str(path)],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""bytes on the wire and encode/decode cpu of json vs packed chat events
+
+measures a 100 message history load (return-messages) and a single
+broadcast chat-message, framed the way python-socketio frames them.
+runs in process, no server needed.
+
+    python benchmarks/wire_format.py --messages 100
+"""
+
+import argparse
+import json
+import random
+import time
+from importlib import import_module
+
+from socketio import packet
+
+from common import PACKAGE
+
+wire = import_module(f"{PACKAGE}.wire")
+message_cache = import_module(f"{PACKAGE}.message_cache")
+
+WORDS = "the quick brown fox jumps over a lazy dog while chat keeps going".split()
+
+
+def synthetic_messages(count: int) -> list:
+    start = time.time() - count
+    return [
+        {
+            "id": 1_000_000 + i,
+            "text": " ".join(random.choices(WORDS, k=random.randint(2, 14))),
+            "datetime": start + i + random.random(),
+            "user_id": random.randint(1, 50_000),
+            "room_id": 1,
+        }
+        for i in range(count)
+    ]
+
+
+def wire_bytes(event: str, payload) -> int:
+    "socket.io packet size, a binary payload adds a placeholder packet"
+    encoded = packet.Packet(packet.EVENT, data=[event, payload]).encode()
+    if isinstance(encoded, list):
+        return sum(len(part) for part in encoded)
+    return len(encoded)
+
+
+def timed(func, rounds: int) -> float:
+    "mean microseconds per call"
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds * 1e6
+
+
+def run(count: int, rounds: int) -> dict:
+    messages = synthetic_messages(count)
+    cache = message_cache.RecentMessageCache(count)
+    cache.warm("chat", reversed(messages))
+    entries = cache.recent_entries("chat", count)
+
+    packed = cache.pack(entries)
+    as_json = json.dumps(messages, separators=(",", ":"))
+    return {
+        "messages": count,
+        "msgpack_package": wire.packb is not wire._packb,
+        "history_bytes": {
+            "json": wire_bytes("return-messages", messages),
+            "packed": wire_bytes("return-messages", packed),
+        },
+        "chat_message_bytes": {
+            "json": wire_bytes("chat-message", messages[0]),
+            "packed": wire_bytes("chat-message", wire.pack_message(messages[0])),
+        },
+        "history_encode_us": {
+            "json": timed(lambda: json.dumps(messages, separators=(",", ":")), rounds),
+            "packed_from_cache": timed(lambda: cache.pack(entries), rounds),
+            "packed_from_dicts": timed(
+                lambda: wire.packb(
+                    [wire.SCHEMA_VERSION, [wire.message_tuple(m) for m in messages]]
+                ),
+                rounds,
+            ),
+        },
+        "history_decode_us": {
+            "json": timed(lambda: json.loads(as_json), rounds),
+            "packed": timed(lambda: wire.unpack_messages(packed), rounds),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, nargs="+", default=[100])
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    print(json.dumps([run(count, args.rounds) for count in args.messages], indent=2))
+
+
+if __name__ == "__main__":
+    main()
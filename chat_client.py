@@ -1,24 +1,370 @@
-import click
-from flask import Flask, request
+"""terminal client for chat_server
+
+logs in through the html form, then keeps one requests.Session (a small
+pool of keep-alive connections) for every http call and a socket.io
+connection for sending and receiving chat messages. the socket runs in its
+own thread, so messages print as they arrive while you type. what you
+send goes through an outbox that keeps it until the server acknowledges
+it, saved to disk, so nothing typed during an outage is lost.
+
+    python chat_client.py http://localhost:5000
+"""
+
+import getpass
+import itertools
 import json
-from pathlib import Path
-import requests
+import os
+import random
+import re
+import sys
 import threading
 import time
+import uuid
+from collections import OrderedDict
+from functools import partial
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlsplit
 
-from typing import Callable, Dict, List, Optional, Type
-
-from requests import exceptions
-from requests.packages.urllib3.exceptions import HTTPError
+import click
+import requests
+import socketio
+from requests.adapters import HTTPAdapter
 
 import error
 
+try:
+    import readline
+except ImportError:  # windows
+    readline = None
+
 
-URL_t = Type[str]
 NAME = ""
+OUTBOX_DIRECTORY = Path.home() / ".chat_client"
+CLIENT: Optional["ChatConnection"] = None
 CHAT_COMMANDS: Dict[str, Callable] = dict()
 
 
+class ChatConnection:
+    """a logged in session with the chat server
+
+    http requests share pooled connections through one session, the
+    socket.io client reuses the session's cookies and, when it falls back
+    to long polling, its connections too. websocket transport needs the
+    websocket-client package.
+    """
+
+    def __init__(self, url: str, pool_size: int = 4):
+        self.url = url.rstrip("/")
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+        self.socket = socketio.Client(http_session=self.http)
+        self.usernames: Dict[int, str] = dict()
+        self._usernames_lock = threading.Lock()
+        self.on_message: Callable[[dict], None] = lambda message: None
+        self.on_notice: Callable[[str], None] = lambda notice: None
+        self.outbox: Optional[Outbox] = None
+
+        self.socket.on("connect", self._connected)
+        self.socket.on("chat-message", self._chat_message)
+        self.socket.on("batch", self._batch)
+        self.socket.on("rate-limited", self._rate_limited)
+        self.socket.on("disconnect", self._disconnected)
+
+    def login(self, username: str, password: str) -> Optional[str]:
+        "None on success, else the reason it failed"
+        page = self.http.get(self.url + "/login", timeout=10)
+        page.raise_for_status()
+        data = {"username": username, "password": password}
+        match = re.search(r'name="csrf_token"[^>]*value="([^"]+)"', page.text)
+        if match:
+            data["csrf_token"] = match.group(1)
+        resp = self.http.post(
+            self.url + "/login", data=data, allow_redirects=False, timeout=10
+        )
+        if resp.status_code == 503:
+            return "the server is busy, try again shortly"
+        if resp.status_code != 302:
+            return "username/password combination incorrect"
+        return None
+
+    def connect(self, keep_trying: bool = False):
+        """connect the socket
+
+        with keep_trying a failed first attempt is retried in the background
+        with the client's reconnection backoff instead of raising
+        """
+        try:
+            self.socket.connect(self.url, wait_timeout=10)
+        except socketio.exceptions.ConnectionError:
+            if not keep_trying:
+                raise
+            self.on_notice("can't reach the server, messages are queued until then")
+            threading.Thread(
+                target=self.socket.connect,
+                args=(self.url,),
+                kwargs={"wait_timeout": 10, "retry": True},
+                daemon=True,
+            ).start()
+
+    def close(self):
+        self.on_notice = lambda notice: None
+        if self.outbox:
+            self.outbox.close()
+        if self.socket.connected:
+            self.socket.disconnect()
+        self.http.close()
+
+    def send(self, text: str):
+        "send straight away, without waiting for or retrying on failure"
+        self.socket.emit("chat-message", {"text": text})
+
+    def open_outbox(self, path: Path) -> "Outbox":
+        "queue messages in an outbox kept in path, see Outbox"
+        self.outbox = Outbox(self.socket.emit, path)
+        self.outbox.on_rejected = lambda count: self.on_notice(
+            f"the server refused {count} message{'s' if count > 1 else ''}"
+        )
+        if self.socket.connected:
+            self.outbox.connected()
+        self.outbox.start()
+        return self.outbox
+
+    def history(self, limit: int = 20) -> List[dict]:
+        "the latest limit messages, oldest first"
+        resp = self.http.post(
+            self.url + "/api/get/chat/history", json={"limit": limit}, timeout=10
+        )
+        resp.raise_for_status()
+        return resp.json()["messages"]
+
+    def username(self, user_id: int) -> str:
+        if user_id not in self.usernames:
+            self.lookup_users([user_id])
+        return self.usernames.get(user_id, f"#{user_id}")
+
+    def lookup_users(self, user_ids: Iterable[int]):
+        "fetch the names of users that aren't known yet in one request"
+        missing = {user_id for user_id in user_ids if user_id not in self.usernames}
+        if not missing:
+            return
+        ids = ",".join(str(user_id) for user_id in sorted(missing))
+        resp = self.http.get(
+            self.url + "/api/get/userlist", params={"ids": ids}, timeout=10
+        )
+        resp.raise_for_status()
+        with self._usernames_lock:
+            for user in resp.json():
+                self.usernames[user["id"]] = user["username"]
+
+    def _chat_message(self, message: dict):
+        self.on_message(message)
+
+    def _batch(self, events: list):
+        for event, payload in events:
+            if event == "chat-message":
+                self.on_message(payload)
+
+    def _rate_limited(self, limited: dict):
+        if limited["event"] == "chat-message":
+            self.on_notice(
+                f"sending too fast, message dropped. "
+                f"try again in {limited['retry_after']:.1f}s"
+            )
+
+    def _connected(self):
+        if self.outbox:
+            self.outbox.connected()
+
+    def _disconnected(self, *args):
+        if self.outbox:
+            self.outbox.disconnected()
+        self.on_notice("disconnected from the server, reconnecting")
+
+
+class Outbox:
+    """messages typed but not yet acknowledged by the server
+
+    put never blocks. a sender thread emits whatever is waiting as
+    "chat-messages" batches of up to max_batch, with up to window batches
+    awaiting their ack at once. a batch that isn't acknowledged within
+    timeout, or was in flight when the connection dropped, goes back in
+    the queue and is resent after a backoff that doubles up to max_backoff.
+    each message carries a client id so the server can drop the copies a
+    resend makes.
+
+    unacknowledged messages are kept in path, so what was typed while the
+    server was unreachable survives quitting and is sent on the next start.
+    """
+
+    def __init__(
+        self,
+        emit: Callable[..., None],
+        path: Path,
+        max_batch: int = 20,
+        window: int = 4,
+        timeout: float = 10,
+        max_backoff: float = 30,
+    ):
+        self._emit = emit
+        self.path = path
+        self.max_batch = max_batch
+        self.window = window
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.on_rejected: Callable[[int], None] = lambda count: None
+        self._pending: "OrderedDict[str, str]" = OrderedDict()
+        self._in_flight: Dict[int, Tuple[List[str], float]] = dict()
+        self._batch_numbers = itertools.count()
+        self._cond = threading.Condition()
+        self._connected = False
+        self._closed = False
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._thread = None
+        self._load()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, text: str) -> str:
+        "queue text to be sent, returns its client id"
+        client_id = uuid.uuid4().hex
+        with self._cond:
+            self._pending[client_id] = text
+            self._save()
+            self._cond.notify()
+        return client_id
+
+    def connected(self):
+        with self._cond:
+            self._connected = True
+            self._cond.notify()
+
+    def disconnected(self):
+        with self._cond:
+            self._connected = False
+            # whatever was in flight may or may not have arrived, it is sent
+            # again after reconnecting and the server drops what it has seen
+            self._in_flight.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ids = self._next_batch()
+                while not ids and not self._closed:
+                    self._cond.wait(self._wait_time())
+                    self._expire()
+                    ids = self._next_batch()
+                if self._closed:
+                    return
+                number = next(self._batch_numbers)
+                self._in_flight[number] = (ids, time.monotonic() + self.timeout)
+                batch = [{"client_id": id, "text": self._pending[id]} for id in ids]
+            try:
+                self._emit(
+                    "chat-messages",
+                    {"messages": batch},
+                    callback=partial(self._acked, number),
+                )
+            except socketio.exceptions.SocketIOError:
+                with self._cond:
+                    self._failed(number)
+
+    def _next_batch(self) -> List[str]:
+        if (
+            not self._connected
+            or len(self._in_flight) >= self.window
+            or time.monotonic() < self._retry_at
+        ):
+            return []
+        flying = {id for ids, _ in self._in_flight.values() for id in ids}
+        unsent = (id for id in self._pending if id not in flying)
+        return list(itertools.islice(unsent, self.max_batch))
+
+    def _wait_time(self) -> Optional[float]:
+        "how long until a retry or an ack timeout is due, None for neither"
+        now = time.monotonic()
+        due = [deadline for _, deadline in self._in_flight.values()]
+        if self._retry_at > now:
+            due.append(self._retry_at)
+        return max(0.0, min(due) - now) if due else None
+
+    def _expire(self):
+        now = time.monotonic()
+        for number, (_, deadline) in list(self._in_flight.items()):
+            if deadline <= now:
+                self._failed(number)
+
+    def _failed(self, number: int, retry_after: Optional[float] = None):
+        self._in_flight.pop(number, None)
+        if retry_after is None:
+            self._backoff = min(self.max_backoff, self._backoff * 2 or 0.5)
+            retry_after = self._backoff * random.uniform(0.5, 1)
+        self._retry_at = max(self._retry_at, time.monotonic() + retry_after)
+
+    def _acked(self, number: int, reply=None):
+        with self._cond:
+            if not isinstance(reply, dict) or not (
+                "acked" in reply or "rejected" in reply
+            ):
+                # an old server that doesn't ack batches, or an error reply
+                # such as {"error": ...}, nothing was taken so back off
+                self._failed(number)
+                self._cond.notify()
+                return
+            # acks can arrive after a batch timed out and was queued again
+            for id in reply.get("acked", []) + reply.get("rejected", []):
+                self._pending.pop(id, None)
+            if "retry_after" in reply:
+                # rate limited part way through, the rest is sent again later
+                self._failed(number, reply["retry_after"])
+            else:
+                self._in_flight.pop(number, None)
+                self._backoff = 0.0
+            self._save()
+            self._cond.notify()
+        if reply.get("rejected"):
+            self.on_rejected(len(reply["rejected"]))
+
+    def _save(self):
+        if not self._pending:
+            if self.path.exists():
+                self.path.unlink()
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_suffix(".tmp")
+        with open(temporary, "w") as file:
+            for client_id, text in self._pending.items():
+                file.write(json.dumps({"client_id": client_id, "text": text}) + "\n")
+        os.replace(temporary, self.path)
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    message = json.loads(line)
+                    self._pending[message["client_id"]] = message["text"]
+                except (ValueError, KeyError, TypeError):
+                    # a line cut short by a crash mid write
+                    continue
+
+
 def handleChatCommand(line: str):
     if len(line) < 2:
         raise error.ChatInvalidCommand(reason="no command given")
@@ -46,7 +392,6 @@ def chatCommand(
         command._help = help
         command._syntax = syntax
         command._arguments = arguments
-        print("registered", name, "as a chat command")
 
     def decorator(command: Callable):
         register(command)
@@ -68,31 +413,24 @@ def exitChat(*args) -> None:
         raise error.ChatExit
 
 
-@chatCommand(arguments=["resource messages users"])
-def get(resource: str = None) -> None:
+@chatCommand(arguments=["messages"], syntax="get messages [count]")
+def get(resource: str = None, count: str = "20") -> None:
     "get <resource> from the server"
     if not resource:
-        raise error.ChatMissingArgument
-
-    resp = requests.get(url=URL + "/chat", json={"token": TOKEN, "get": "messages"})
-    resp.raise_for_status()
-    resp = resp.json()
-    if resp is not dict:
-        raise error.ChatException("expected a dict type json")
-
-    messages = resp.get("messages", [])
+        raise error.ChatMissingArgument(command=get, required="resource")
+    if resource != "messages":
+        raise error.ChatInvalidArgument(command=get, arg=resource)
+    try:
+        limit = int(count)
+    except ValueError:
+        raise error.ChatInvalidArgument(command=get, arg=count)
 
+    messages = CLIENT.history(limit)
     if not messages:
-        print("there are no new messages")
-
+        print("there are no messages")
+    CLIENT.lookup_users(message["user_id"] for message in messages)
     for message in messages:
-        tm = message.get("time", None)
-        if tm is float:
-            tm = time.strftime(tm)
-        else:
-            tm = ""
-
-        print("[" + tm + "]", message.get("user", ""), ">", message.get("content", ""))
+        print(format_message(message))
 
 
 @chatCommand(name="help")
@@ -114,12 +452,10 @@ def chatHelp(*args: List[str]) -> None:
         )
         return
 
-    if len(args) > 1:
-        subcommands = [subcommand for subcommand in args[1:]]
-
-    else:
-        text = getattr(cmd, "_help", cmd.__doc__)
-        print(f"{cmd_name}: {text}")
+    text = getattr(cmd, "_help", "") or cmd.__doc__
+    print(f"{cmd_name}: {text}")
+    if getattr(cmd, "_syntax", ""):
+        print(f"\tsyntax: /{cmd._syntax}")
 
 
 def format_status_code(status: int):
@@ -134,84 +470,122 @@ def format_status_code(status: int):
         return click.style(str(status), fg="red")
 
 
+def format_message(message: dict) -> str:
+    tm = time.strftime("%H:%M:%S", time.localtime(message["datetime"]))
+    name = CLIENT.username(message["user_id"])
+    style = dict(fg="yellow", bold=True) if name == NAME else dict(fg="cyan")
+    return f"[{tm}] {click.style(name, **style)} > {message['text']}"
+
+
+def prompt() -> str:
+    name = click.style(NAME, fg="yellow", bold=True)
+    if CLIENT.outbox and not CLIENT.socket.connected and len(CLIENT.outbox):
+        return f"[{len(CLIENT.outbox)} unsent]{name}>"
+    return f"{name}>"
+
+
+_print_lock = threading.Lock()
+
+
+def print_above_prompt(line: str):
+    "print a line from the receive thread without mangling what is being typed"
+    with _print_lock:
+        typed = readline.get_line_buffer() if readline else ""
+        sys.stdout.write(f"\r\x1b[K{line}\n{prompt()}{typed}")
+        sys.stdout.flush()
+
+
+def outbox_path(url: str, name: str) -> Path:
+    server = urlsplit(url).netloc.replace(":", "_")
+    return OUTBOX_DIRECTORY / f"outbox-{server}-{name}.jsonl"
+
+
+def listen_to_chat():
+    "print messages and notices as the socket receives them"
+    CLIENT.on_message = lambda message: print_above_prompt(format_message(message))
+    CLIENT.on_notice = lambda notice: print_above_prompt(click.style(notice, fg="red"))
+    outbox = CLIENT.open_outbox(outbox_path(CLIENT.url, NAME))
+    if len(outbox):
+        print(f"sending {len(outbox)} messages left over from last time")
+    CLIENT.connect(keep_trying=True)
+
+
 def enter_chat():
-    print('type "/exit" to exit chat')
-    status = ""
+    print('type "/exit" to exit chat, "/help" for commands')
+    listen_to_chat()
     while True:
         try:
-            msg = input(f'[{status:>3}]{click.style(NAME, fg="yellow", bold=True)}>')
+            msg = input(prompt())
 
             if not msg:
-                status = ""
                 continue
 
             elif msg[0] == "/":
                 handleChatCommand(msg)
+                continue
 
-            msg = msg.replace("\\n", "\n")
-            payload = {"token": TOKEN, "message": msg}
-            resp = requests.post(url=URL + "/chat", json=payload)
-            resp.raise_for_status()
-            status = format_status_code(resp.status_code)
+            CLIENT.outbox.put(msg.replace("\\n", "\n"))
+            if sys.stdout.isatty():
+                # the message shows up again once the server has broadcast it
+                sys.stdout.write("\x1b[1A\x1b[K")
 
-        except error.ChatExit as e:
-            print(e)
+        except (error.ChatExit, EOFError, KeyboardInterrupt) as e:
+            print(e if isinstance(e, error.ChatExit) else "")
             break
 
         except error.ChatException as e:
             print(e)
-            status = ""
             continue
 
-        except HTTPError as e:
-            print(e)
-
-            if (resp_json := resp.json()) is not dict:
-                raise error.ChatDisconnect(reason="expected response json to be a dict")
+        except requests.exceptions.HTTPError as e:
+            print(format_status_code(e.response.status_code), e)
 
-            elif resp_json:
-                print(resp_json)
+        except (
+            requests.exceptions.RequestException,
+            socketio.exceptions.SocketIOError,
+        ) as e:
+            print(click.style(f"connection problem: {e}", fg="red"))
 
 
-def connectToServer() -> bool:
-    global TOKEN
+def connectToServer(url: str, password: str) -> bool:
+    global CLIENT
+    CLIENT = ChatConnection(url)
     try:
-        payload = {"username": NAME}
-        resp = requests.get(url=URL + "/login", json=payload)
-        resp.raise_for_status()
-        resp = resp.json()
-        TOKEN = resp.get("token", None)
-        if TOKEN:
-            return True
-        else:
-            print("login failure:", resp.get("error", ""))
+        failure = CLIENT.login(NAME, password)
+        if failure:
+            print("login failure:", failure)
             return False
+        return True
 
     except requests.exceptions.RequestException as e:
         print("login failure:", str(e))
         return False
 
 
-def listen_to_chat():
-    payload = json.dumps({})
-    resp = requests.get(url=URL + "/chat", json=payload)
-
-
 def main():
     global NAME
-    global URL
 
-    while True:
-        login_success = False
-        while not login_success:
-            URL = input("enter url>")
-            NAME = input("enter username>")
+    url = sys.argv[1] if len(sys.argv) > 1 else None
+    login_success = False
+    while not login_success:
+        url = url or input("enter url>")
+        NAME = input("enter username>")
+        password = getpass.getpass("enter password>")
 
-            login_success = connectToServer()
+        login_success = connectToServer(url, password)
+        if not login_success:
+            CLIENT.close()
 
+    try:
         enter_chat()
+    finally:
+        CLIENT.close()
+        if CLIENT.outbox and len(CLIENT.outbox):
+            print(
+                f"{len(CLIENT.outbox)} messages were not sent yet,"
+                f" they are saved in {CLIENT.outbox.path} and sent next time"
+            )
 
 
 if __name__ == "__main__":
     main()
-
@@ -1,9 +1,16 @@
-from functools import singledispatchmethod
+from .async_mode import ASYNC_MODE
+
 import colorama
-from dataclasses import dataclass
-from datetime import datetime
-from typing import Callable, Dict, List, Optional, Type, Union
-from flask import Flask, render_template, redirect, url_for
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple, Type, Union
+from flask import (
+    Flask,
+    make_response,
+    render_template,
+    redirect,
+    send_from_directory,
+    url_for,
+)
 from flask.globals import request, session
 from flask.helpers import flash
 from flask_login import (
@@ -13,17 +20,44 @@ from flask_login import (
     login_user,
     logout_user,
 )
-from flask_socketio import SocketIO, emit, disconnect, join_room, send
+from flask_socketio import SocketIO, emit, disconnect, join_room, leave_room, send
 from flask_wtf import FlaskForm
+from sqlalchemy.exc import IntegrityError
 from functools import wraps
+import atexit
+import hashlib
 import json
+import math
 import os
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
 from wtforms.widgets.html5 import EmailInput, URLInput
 
-from . import forms
+from . import (
+    assets,
+    avatars,
+    forms,
+    history,
+    message_views,
+    metrics,
+    rooms,
+    search,
+    user_stats,
+    wire,
+)
+from .archive import MessageArchive, archive_older_than
+from .availability import AvailabilityIndex
+from .batching import BroadcastBatcher
+from .db_executor import DatabaseExecutor
+from .dedup import RecentIds
+from .flow_control import OutboundMonitor, RateLimiter
+from .message_bus import BusClientManager, ClusterChannel, bus_from_url
+from .message_cache import RecentMessageCache
+from .message_writer import FlushPolicy, MessageWriter
+from .passwords import HasherBusy, PasswordHasher
+from .presence import PresenceLog, PresenceTracker, backend_from_config
+from .profiler import SamplingProfiler, SlowHandlerLog
+from .rooms import DEFAULT_ROOM, RoomDirectory, RoomMembership, RoomPresence
 from .sql_models import db, User, Message
+from .user_directory import PublicUser, PublicUserManager
 
 colorama.init()
 
@@ -35,125 +69,329 @@ db.init_app(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
-socketio = SocketIO(app)
+message_bus = None
+if app.config["MESSAGE_BUS_URL"]:
+    message_bus = bus_from_url(app.config["MESSAGE_BUS_URL"])
+
+# with a bus, room broadcasts reach clients connected to every worker
+socketio = SocketIO(
+    app,
+    async_mode=ASYNC_MODE,
+    client_manager=BusClientManager(message_bus) if message_bus else None,
+)
+
+metrics_registry = metrics.Registry()
+app_metrics = metrics.AppMetrics(metrics_registry)
+app_metrics.init_app(app)
+# every @socketio.on handler below is timed
+app_metrics.instrument_socketio(socketio)
+
+profiler = SamplingProfiler(
+    app.config["PROFILER_INTERVAL"], app.config["PROFILER_MAX_DURATION"], ASYNC_MODE
+)
+slow_handlers = SlowHandlerLog(
+    app.config["SLOW_HANDLER_THRESHOLD"],
+    app.config["SLOW_HANDLER_KEEP"],
+    async_mode=ASYNC_MODE,
+)
+slow_handlers.init_app(app)
+slow_handlers.instrument_socketio(socketio)
+
+cluster = ClusterChannel(message_bus)
+
+broadcasts = BroadcastBatcher(
+    socketio.emit,
+    app.config["BROADCAST_BATCH_INTERVAL"],
+    app.config["BROADCAST_BATCH_SIZE"],
+)
+
+db_executor = DatabaseExecutor(app, ASYNC_MODE, app.config["DATABASE_WORKERS"])
+
+message_cache = RecentMessageCache(app.config["RECENT_MESSAGE_CACHE_SIZE"])
+
+message_archive = MessageArchive(
+    os.path.join(app.root_path, app.config["ARCHIVE_DIRECTORY"]),
+    app.config["ARCHIVE_BLOCK_SIZE"],
+)
+
+room_directory = RoomDirectory()
+# rooms each socket on this worker is in, and who is in every room
+room_membership = RoomMembership()
+room_presence = RoomPresence()
+
+message_writer = MessageWriter(
+    app,
+    app.config["MESSAGE_JOURNAL_PATH"].format(worker_id=app.config["WORKER_ID"]),
+    FlushPolicy.from_config(app.config),
+    db_executor,
+    id_offset=app.config["WORKER_ID"],
+    id_step=app.config["WORKER_COUNT"],
+)
 
 DEBUG = bool(os.environ.get("FLASK_DEBUG", False))
 print("DEBUG:", DEBUG)
 
 
-@dataclass
-class PublicUser:
-    "front facing user class which doesn't expose private info"
+onlineUsers = PublicUserManager(app.config["USER_DIRECTORY_CACHE_SIZE"])
 
-    id: int
-    username: str
-    avatar_filename: str
-    online: bool = False
 
-    @classmethod
-    def from_db(cls, db_user):
-        return cls(
-            id=db_user.id,
-            username=db_user.username,
-            avatar_filename=db_user.avatar_filename,
-        )
+@app.before_first_request
+def migrate_user_stats():
+    user_stats.ensure_post_count_column(message_archive)
 
 
-class PublicUserManager:
-    "manages user state such as online status"
+@app.before_first_request
+def migrate_rooms():
+    rooms.ensure_rooms()
 
-    def __init__(self):
-        self._users_by_name: Dict[str, PublicUser] = dict()
-        self._users_by_id: Dict[int, PublicUser] = dict()
-        self._last_request_time = dict()
 
-    def load_from_db(self, user_model):
-        for db_user in user_model.query.all():
-            self.add_user(PublicUser.from_db(db_user))
+@app.before_first_request
+def load_users():
+    onlineUsers.load_from_db(app)
 
-    @singledispatchmethod
-    def add_user(self, user):
-        raise TypeError(user)
 
-    @add_user.register
-    def _(self, user: User):
-        user = PublicUser.from_db(user)
-        self._users_by_id[user.id] = user
-        self._users_by_name[user.username] = user
-        self._last_request_time[user.id] = datetime.utcnow()
+availability = AvailabilityIndex(
+    User,
+    ("username", "email"),
+    app.config["AVAILABILITY_CAPACITY"],
+    app.config["AVAILABILITY_ERROR_RATE"],
+)
+availability.init_app(app)
 
-    @add_user.register
-    def _(self, user: PublicUser):
-        self._users_by_id[user.id] = user
-        self._users_by_name[user.username] = user
-        self._last_request_time[user.id] = datetime.utcnow()
 
-    @singledispatchmethod
-    def remove_user(self, user):
-        raise TypeError(user)
+@app.before_first_request
+def load_availability():
+    availability.load()
 
-    @remove_user.register
-    def _(self, user: User):
-        del self._users_by_id[user.id]
-        del self._users_by_name[user.username]
-        del self._last_request_time[user.id]
-        print("user removed", self._users_by_id)
 
-    def __len__(self):
-        return len(self._users_by_id)
+@app.before_first_request
+def start_message_writer():
+    message_writer.start()
+    atexit.register(message_writer.stop)
 
-    @property
-    def user_dict(self) -> Dict[int, PublicUser]:
-        return self._users_by_id
 
-    @singledispatchmethod
-    def lookup_user(self, user) -> PublicUser:
-        raise TypeError(user)
+@app.before_first_request
+def create_history_indexes():
+    history.ensure_indexes()
 
-    @lookup_user.register(int)
-    def _(self, user_id: int) -> PublicUser:
-        return self._users_by_id.get(user_id, None)
 
-    @lookup_user.register(str)
-    def _(self, user: str) -> PublicUser:
-        return self._users_by_name.get(user, None)
+def warm_room(room: str, room_id: int):
+    "load a room's recent messages into the cache, other rooms wait for a join"
+    messages = db_executor.run(history.recent_messages, room_id, message_cache.size)
+    # older messages may be in the archive even when the table has few
+    complete = False if message_archive.holds(room_id) else None
+    message_cache.warm(room, messages, complete)
 
-    @singledispatchmethod
-    def update_request_time(self, user, time=datetime.utcnow()) -> None:
-        raise TypeError(user)
 
-    @update_request_time.register
-    def _(self, user_id: int, time=datetime.utcnow()) -> None:
-        self._last_request_time[user_id] = time
+@app.before_first_request
+def warm_message_cache():
+    warm_room(DEFAULT_ROOM, rooms.DEFAULT_ROOM_ID)
+
 
-    @update_request_time.register
-    def _(self, username: str, time=datetime.utcnow()) -> None:
-        user_id = self._by_username[username].id
-        self._last_request_time[user_id] = time
+search_enabled = False
 
-    @singledispatchmethod
-    def get_last_request_time(self, user) -> datetime:
-        raise TypeError(user)
 
-    @get_last_request_time.register
-    def _(self, user: int) -> datetime:
-        return self._last_request_time[user]
+@app.before_first_request
+def create_search_index():
+    global search_enabled
+    search_enabled = search.ensure_index()
 
-    @get_last_request_time.register
-    def _(self, user: str) -> datetime:
-        user_id = self._users_by_name[user].id
-        return self._last_request_time[user_id]
 
-    def get_users_by_name(self) -> List[PublicUser]:
-        return self._users_by_name.values()
+@app.cli.command("rebuild-search-index")
+def rebuild_search_index_command():
+    "reindex every message for full text search"
+    if search.ensure_index():
+        search.rebuild_index()
+        print("rebuilt the search index")
+    else:
+        print("full text search needs sqlite with fts5, searches will scan")
 
 
-onlineUsers = PublicUserManager()
+def archive_old_messages() -> int:
+    "move every message older than ARCHIVE_AFTER_DAYS to the archive"
+    cutoff = datetime.utcnow() - timedelta(days=app.config["ARCHIVE_AFTER_DAYS"])
+    batch_size = app.config["ARCHIVE_BATCH_SIZE"]
+    moved = 0
+    while True:
+        count = db_executor.run(archive_older_than, message_archive, cutoff, batch_size)
+        moved += count
+        if count < batch_size:
+            return moved
+        # let the database breathe between batches
+        socketio.sleep(1)
 
 
 @app.before_first_request
-def load_users():
-    onlineUsers.load_from_db(User)
+def start_archiver():
+    # one worker moves messages, every worker reads the archive
+    if not app.config["ARCHIVE_AFTER_DAYS"] or app.config["WORKER_ID"] != 0:
+        return
+
+    def archive_forever():
+        with app.app_context():
+            try:
+                # segments written before they had a search index
+                message_archive.index_segments()
+            except Exception as e:
+                print("archiver: failed to index the archive", e)
+            while True:
+                try:
+                    moved = archive_old_messages()
+                except Exception as e:
+                    db.session.rollback()
+                    print("archiver: failed to archive messages", e)
+                else:
+                    if moved:
+                        print("archiver: archived", moved, "messages")
+                socketio.sleep(app.config["ARCHIVE_INTERVAL"])
+
+    socketio.start_background_task(archive_forever)
+
+
+@app.cli.command("archive-messages")
+def archive_messages_command():
+    "move messages older than ARCHIVE_AFTER_DAYS to the archive now"
+    if not app.config["ARCHIVE_AFTER_DAYS"]:
+        print("archiving is turned off, set ARCHIVE_AFTER_DAYS")
+        return
+    rooms.ensure_rooms()
+    print("archived", archive_old_messages(), "messages")
+
+
+@app.cli.command("rebuild-post-counts")
+def rebuild_post_counts_command():
+    "recount every user's posts from the messages table and the archive"
+    user_stats.ensure_post_count_column(message_archive)
+    print(
+        "rebuilt post counts for",
+        user_stats.rebuild_post_counts(message_archive),
+        "users",
+    )
+
+
+@app.before_first_request
+def start_cluster_listener():
+    socketio.start_background_task(cluster.listen_forever)
+
+
+@app.before_first_request
+def start_broadcast_batcher():
+    socketio.start_background_task(broadcasts.run_forever, socketio.sleep)
+
+
+presence_log = PresenceLog()
+
+
+def send_presence_delta(delta: Optional[dict]):
+    # versions are per worker so each worker only sends its own deltas to
+    # its own clients, instead of going through the message bus
+    if delta:
+        broadcasts.send(
+            rooms.socket_room(DEFAULT_ROOM), "presence-delta", delta, ignore_queue=True
+        )
+
+
+def send_room_presence_delta(room: str, delta: Optional[dict]):
+    # per worker like the deltas above, only sent to the room's members
+    if delta:
+        broadcasts.send(
+            rooms.socket_room(room),
+            "room-presence-delta",
+            dict(delta, room=room),
+            ignore_queue=True,
+        )
+
+
+def record_presence(user: PublicUser, online: bool):
+    user.online = online
+    if online:
+        delta = presence_log.join(user.id, user.username, user.avatar_filename)
+    else:
+        delta = presence_log.leave(user.id)
+        for room, room_delta in room_presence.drop_user(user.id):
+            send_room_presence_delta(room, room_delta)
+    send_presence_delta(delta)
+
+
+def set_online(user: PublicUser, online: bool):
+    "change a user's online status on every worker"
+    record_presence(user, online)
+    cluster.publish("presence", {"user_id": user.id, "online": online})
+
+
+def record_avatar(user: PublicUser, avatar_filename: str):
+    user.avatar_filename = avatar_filename
+    send_presence_delta(presence_log.avatar(user.id, avatar_filename))
+    for room, delta in room_presence.avatar(user.id, avatar_filename):
+        send_room_presence_delta(room, delta)
+
+
+def set_avatar(user: PublicUser, avatar_filename: str):
+    "change a user's avatar on every worker"
+    record_avatar(user, avatar_filename)
+    cluster.publish("avatar", {"user_id": user.id, "avatar": avatar_filename})
+
+
+def record_room_presence(room: str, user_id: int, present: bool):
+    if present:
+        user = onlineUsers.lookup_user(user_id)
+        if user is None:
+            return
+        delta = room_presence.enter(room, user.id, user.username, user.avatar_filename)
+    else:
+        delta = room_presence.exit(room, user_id)
+    send_room_presence_delta(room, delta)
+
+
+def set_room_presence(room: str, user_id: int, present: bool):
+    "a user entered or left a room on this worker, tell every worker"
+    record_room_presence(room, user_id, present)
+    cluster.publish(
+        "room-presence", {"room": room, "user_id": user_id, "present": present}
+    )
+
+
+def add_chat_message(room: str, message: dict):
+    "cache a new message on every worker"
+    message_cache.append(room, message)
+    cluster.publish("chat-message", {"room": room, "message": message})
+
+
+@cluster.on("presence")
+def cluster_presence(data):
+    user = onlineUsers.lookup_user(data["user_id"])
+    if user:
+        record_presence(user, data["online"])
+
+
+@cluster.on("avatar")
+def cluster_avatar(data):
+    user = onlineUsers.lookup_user(data["user_id"])
+    if user:
+        record_avatar(user, data["avatar"])
+
+
+@cluster.on("room-presence")
+def cluster_room_presence(data):
+    record_room_presence(data["room"], data["user_id"], data["present"])
+
+
+@cluster.on("chat-message")
+def cluster_chat_message(data):
+    # rooms nobody here is in aren't cached until someone joins them
+    if message_cache.is_warm(data["room"]):
+        message_cache.append(data["room"], data["message"])
+
+
+@cluster.on("user-added")
+def cluster_user_added(data):
+    onlineUsers.add_user(PublicUser(**data))
+
+
+@cluster.on("names-taken")
+def cluster_names_taken(data):
+    for column, value in data.items():
+        availability.add(column, value)
 
 
 @login_manager.user_loader
@@ -178,79 +416,475 @@ def authentication_required(socket_func):
     return wrapper
 
 
+rate_limiter = RateLimiter(app.config["RATE_LIMITS"])
+
+
+def rate_limited(event: str):
+    """drop event from users over their RATE_LIMITS, use below authentication
+
+    a dropped call acknowledges with the seconds until it may be retried
+    """
+
+    def decorator(socket_func):
+        @wraps(socket_func)
+        def wrapper(*args, **kwargs):
+            retry_after = rate_limiter.allow(current_user.id, event)
+            if retry_after is not None:
+                emit("rate-limited", {"event": event, "retry_after": retry_after})
+                return {"retry_after": retry_after}
+            return socket_func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def outbound_queue_sizes() -> Dict[str, int]:
+    "packets waiting to be written, by engine.io session id"
+    sockets = list(socketio.server.eio.sockets.items())
+    return {sid: socket.queue.qsize() for sid, socket in sockets}
+
+
+outbound_monitor = OutboundMonitor(
+    outbound_queue_sizes,
+    socketio.server.eio.disconnect,
+    app.config["OUTBOUND_QUEUE_LIMIT"],
+    app.config["OUTBOUND_QUEUE_GRACE"],
+)
+
+
+@app.before_first_request
+def start_outbound_monitor():
+    socketio.start_background_task(
+        outbound_monitor.run_forever,
+        socketio.sleep,
+        app.config["OUTBOUND_CHECK_INTERVAL"],
+    )
+
+
+def user_came_online(user_id: int):
+    user = onlineUsers.lookup_user(user_id)
+    set_online(user, True)
+    socketio.emit(
+        "message",
+        f"{user.username} has connected!",
+        to=rooms.socket_room(DEFAULT_ROOM),
+        skip_sid=request.sid,
+    )
+
+
+def user_went_offline(user_id: int):
+    user = onlineUsers.lookup_user(user_id)
+    set_online(user, False)
+    broadcasts.send(
+        rooms.socket_room(DEFAULT_ROOM), "message", f"{user.username} has disconnected"
+    )
+
+
+# counts every socket a user has open, they only go offline when the last
+# one disconnects or stops sending heartbeats
+presence = PresenceTracker(
+    backend_from_config(app.config),
+    app.config["PRESENCE_TTL"],
+    on_online=user_came_online,
+    on_offline=user_went_offline,
+)
+
+
+@app.before_first_request
+def start_presence_sweeper():
+    def sweep_forever():
+        while True:
+            socketio.sleep(app.config["PRESENCE_TICK"])
+            try:
+                presence.sweep()
+            except Exception as e:
+                # a failed sweep is tried again next tick
+                print("presence sweeper: failed to sweep", e)
+
+    socketio.start_background_task(sweep_forever)
+
+
+# socket id -> wire encoding the client asked for, see wire.py
+wire_encodings: Dict[str, str] = dict()
+
+
+def client_encoding() -> str:
+    return wire_encodings.get(request.sid, wire.JSON)
+
+
+def emit_presence_snapshot():
+    snapshot = presence_log.snapshot()
+    if client_encoding() == wire.PACKED:
+        snapshot = wire.pack_snapshot(snapshot)
+    emit("presence-snapshot", snapshot, broadcast=False)
+
+
+def broadcast_chat_message(room: str, message: dict):
+    "send a message to the members of its room, each in their own encoding"
+    room = rooms.socket_room(room)
+    broadcasts.send(wire.room_for(room, wire.JSON), "chat-message", message)
+    broadcasts.send(
+        wire.room_for(room, wire.PACKED), "chat-message", wire.pack_message(message)
+    )
+
+
+def join_chat_room(room: str):
+    "subscribe the current socket to a room's broadcasts"
+    join_room(rooms.socket_room(room))
+    join_room(wire.room_for(rooms.socket_room(room), client_encoding()))
+    if room_membership.join(request.sid, current_user.id, room):
+        set_room_presence(room, current_user.id, True)
+
+
+def leave_chat_room(room: str):
+    leave_room(rooms.socket_room(room))
+    leave_room(wire.room_for(rooms.socket_room(room), client_encoding()))
+    if room_membership.leave(request.sid, current_user.id, room):
+        set_room_presence(room, current_user.id, False)
+        forget_if_empty(room)
+
+
+def forget_if_empty(room: str):
+    "stop caching a room once nobody on this worker is in it"
+    if room != DEFAULT_ROOM and not room_membership.sockets_in(room):
+        message_cache.forget(room)
+
+
 @socketio.on("connect")
 @authentication_required
 def handle_connection():
-    user = onlineUsers.lookup_user(current_user.id)
-    user.online = True
-
-    join_room("chat")
+    join_chat_room(DEFAULT_ROOM)
     emit("message", "you have connected", broadcast=False, include_self=True)
     emit(
-        "message",
-        f"{current_user.username} has connected!",
-        broadcast=True,
-        include_self=False,
+        "heartbeat-interval",
+        app.config["PRESENCE_HEARTBEAT_INTERVAL"],
+        broadcast=False,
+        include_self=True,
     )
+    presence.connect(current_user.id, request.sid)
 
-    data = {"user_id": user.id, "timestamp": datetime.utcnow().timestamp()}
 
-    emit("user-joined", data, broadcast=True, include_self=True)
+@socketio.on("heartbeat")
+@authentication_required
+def handle_heartbeat():
+    presence.heartbeat(current_user.id, request.sid)
 
 
 @socketio.on("disconnect")
 def handle_disconnect():
-    user = onlineUsers.lookup_user(current_user.id)
-    user.online = False
+    wire_encodings.pop(request.sid, None)
+    if current_user.is_authenticated:
+        for room in room_membership.drop(request.sid, current_user.id):
+            set_room_presence(room, current_user.id, False)
+            forget_if_empty(room)
+        presence.disconnect(current_user.id, request.sid)
+    disconnect()
 
-    emit(
-        "message",
-        f"{current_user.username} has disconnected",
-        room="chat",
-        broadcast=True,
-    )
 
-    data = {"user_id": user.id, "timestamp": datetime.utcnow().timestamp()}
-    emit("user-left", data, room="chat", broadcast=True)
-    disconnect()
+@socketio.on("set-encoding")
+@authentication_required
+@rate_limited("set-encoding")
+def set_encoding(data):
+    "opt in to the packed wire format, answers with the encoding now in use"
+    encoding = data.get("encoding", wire.JSON)
+    if encoding not in wire.ENCODINGS or (
+        encoding == wire.PACKED and data.get("version") != wire.SCHEMA_VERSION
+    ):
+        encoding = wire.JSON
+    for room in room_membership.rooms(request.sid):
+        leave_room(wire.room_for(rooms.socket_room(room), client_encoding()))
+        join_room(wire.room_for(rooms.socket_room(room), encoding))
+    wire_encodings[request.sid] = encoding
+    emit("encoding", {"encoding": encoding, "version": wire.SCHEMA_VERSION})
 
 
 @socketio.on("get-user-list")
 @authentication_required
+@rate_limited("get-user-list")
 def get_online_users():
-    emit(
-        "online-users-mapping",
-        onlineUsers.user_dict,
-        broadcast=False,
-        include_self=True,
+    emit_presence_snapshot()
+
+
+def presence_version(data) -> Optional[Tuple[str, int]]:
+    "the (epoch, version) a client says it has, None if it sent anything else"
+    if not isinstance(data, dict):
+        return None
+    epoch, version = data.get("epoch"), data.get("version", 0)
+    if not isinstance(epoch, str) or type(version) is not int:
+        return None
+    return epoch, version
+
+
+@socketio.on("presence-sync")
+@authentication_required
+@rate_limited("presence-sync")
+def sync_presence(data):
+    "deltas since the client's version, or a snapshot if they're gone"
+    synced = presence_version(data)
+    deltas = None if synced is None else presence_log.since(*synced)
+    if deltas is None:
+        emit_presence_snapshot()
+    else:
+        emit("presence-deltas", deltas, broadcast=False)
+
+
+def room_from(data) -> str:
+    "the room a socket event is about, the default room if it doesn't say"
+    room = data.get("room", DEFAULT_ROOM) if isinstance(data, dict) else None
+    if not rooms.valid_name(room):
+        raise ValueError("room names are 1 to 32 lowercase letters, digits, - or _")
+    return room
+
+
+def enter_room(room: str, room_id: int) -> dict:
+    "join the current socket to a room, the reply for join-room and create-room"
+    if not message_cache.is_warm(room):
+        warm_room(room, room_id)
+    join_chat_room(room)
+    return {"room": room, "id": room_id, "members": room_presence.snapshot(room)}
+
+
+def room_to_join(data) -> str:
+    "the room named by data, if the current socket may join another one"
+    room = room_from(data)
+    joined = room_membership.rooms(request.sid)
+    if room not in joined and len(joined) >= app.config["ROOMS_PER_SOCKET"]:
+        raise ValueError("in too many rooms, leave one first")
+    return room
+
+
+@socketio.on("join-room")
+@authentication_required
+@rate_limited("join-room")
+def handle_join_room(data):
+    """subscribe to an existing room
+
+    acknowledges with the room's name, id and a snapshot of its members
+    """
+    try:
+        room = room_to_join(data)
+    except ValueError as e:
+        return {"error": str(e)}
+    room_id = db_executor.run(room_directory.lookup, room)
+    if room_id is None:
+        return {"error": f"there is no room called {room}"}
+    return enter_room(room, room_id)
+
+
+@socketio.on("create-room")
+@authentication_required
+@rate_limited("create-room")
+def handle_create_room(data):
+    """make a new room and join it, a user can make ROOMS_PER_USER of them
+
+    acknowledges like join-room
+    """
+    try:
+        room = room_to_join(data)
+        room_id = db_executor.run(
+            room_directory.create,
+            room,
+            current_user.id,
+            app.config["ROOMS_PER_USER"],
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+    return enter_room(room, room_id)
+
+
+@socketio.on("leave-room")
+@authentication_required
+@rate_limited("join-room")
+def handle_leave_room(data):
+    try:
+        room = room_from(data)
+    except ValueError as e:
+        return {"error": str(e)}
+    leave_chat_room(room)
+    return {"room": room}
+
+
+@socketio.on("room-presence-sync")
+@authentication_required
+@rate_limited("presence-sync")
+def sync_room_presence(data):
+    "like presence-sync for the members of one room the socket is in"
+    room = data.get("room") if isinstance(data, dict) else None
+    if not room_membership.is_in(request.sid, room):
+        return
+    synced = presence_version(data)
+    deltas = None if synced is None else room_presence.since(room, *synced)
+    if deltas is None:
+        snapshot = dict(room_presence.snapshot(room), room=room)
+        emit("room-presence-snapshot", snapshot, broadcast=False)
+    else:
+        emit("room-presence-deltas", dict(deltas, room=room), broadcast=False)
+
+
+sent_message_ids = RecentIds(app.config["CLIENT_MESSAGE_ID_WINDOW"])
+
+
+def post_chat_message(
+    text: str, client_id: Optional[str] = None, room: str = DEFAULT_ROOM
+) -> bool:
+    """store and broadcast a message from the current user to a room they're in
+
+    False when client_id says the client already sent it, a resend after
+    an acknowledgement went missing
+    """
+    if client_id is not None and not sent_message_ids.add((current_user.id, client_id)):
+        return False
+    room_id = room_directory.cached(room)
+    message = message_writer.submit(text, current_user.id, room_id=room_id).to_json()
+    add_chat_message(room, message)
+    broadcast_chat_message(room, message)
+    return True
+
+
+def valid_text(text) -> bool:
+    "text comes straight from clients, only a non-empty string that fits is kept"
+    return isinstance(text, str) and 0 < len(text) <= app.config["MAX_MESSAGE_LENGTH"]
+
+
+def valid_client_message(data, needs_client_id: bool = True) -> bool:
+    "a message from a client, for a room its socket is in"
+    if not isinstance(data, dict):
+        return False
+    client_id = data.get("client_id")
+    if client_id is None:
+        valid_id = not needs_client_id
+    else:
+        valid_id = isinstance(client_id, str) and 0 < len(client_id) <= 64
+    return (
+        valid_id
+        and valid_text(data.get("text"))
+        and room_membership.is_in(request.sid, data.get("room", DEFAULT_ROOM))
     )
 
 
 @socketio.on("chat-message")
 @authentication_required
+@rate_limited("chat-message")
 def handle_message(data):
-    text = data["text"]
-    room = "chat"
-    message = Message(text=text, datetime=datetime.utcnow(), user_id=current_user.id)
-    db.session.add(message)
-    db.session.commit()
+    "a single message, acknowledged with its client_id if it has one"
+    if not valid_client_message(data, needs_client_id=False):
+        return {"error": "invalid message, or for a room you haven't joined"}
+    post_chat_message(
+        data["text"], data.get("client_id"), data.get("room", DEFAULT_ROOM)
+    )
+    return data.get("client_id")
 
-    emit(
-        "chat-message", message.to_json(), broadcast=True, include_self=True, room=room
+
+@socketio.on("chat-messages")
+@authentication_required
+@rate_limited("chat-messages")
+def handle_messages(data):
+    """a batch of queued messages, each {"client_id": ..., "text": ...} and
+    optionally the "room" it's for
+
+    acknowledges with the client ids that were posted or had been already
+    and the ones that never will be, so the client can forget both. every
+    message posted takes a chat-message token as if it had come on its
+    own, a batch is posted as far as the user's tokens go and the reply
+    says when to retry_after for the rest
+    """
+    if not isinstance(data, dict) or not isinstance(data.get("messages"), list):
+        return {"error": 'expected {"messages": [...]}'}
+    acked, rejected = [], []
+    reply = {"acked": acked, "rejected": rejected}
+    for item in data["messages"][: app.config["CLIENT_MESSAGE_BATCH_SIZE"]]:
+        if not valid_client_message(item):
+            if isinstance(item, dict) and isinstance(item.get("client_id"), str):
+                rejected.append(item["client_id"])
+            continue
+        # resends of messages already posted are acked for free
+        if (current_user.id, item["client_id"]) not in sent_message_ids:
+            retry_after = rate_limiter.allow(current_user.id, "chat-message")
+            if retry_after is not None:
+                emit(
+                    "rate-limited",
+                    {"event": "chat-message", "retry_after": retry_after},
+                )
+                reply["retry_after"] = retry_after
+                break
+        post_chat_message(
+            item["text"], item["client_id"], item.get("room", DEFAULT_ROOM)
+        )
+        acked.append(item["client_id"])
+    return reply
+
+
+def search_messages(values) -> search.SearchPage:
+    """run a search described by request args or a socket event's data
+
+    q is the text to look for, room, user_id, since and until (unix
+    timestamps) narrow it down, order is "rank" or "recent", limit and
+    offset page. raises ValueError for anything malformed
+    """
+    text = str(values.get("q") or "").strip()
+    if not text:
+        raise ValueError("expected 'q' with the text to search for")
+    limit = int(values.get("limit") or app.config["SEARCH_PAGE_SIZE"])
+    limit = max(1, min(limit, app.config["SEARCH_MAX_PAGE_SIZE"]))
+    offset = max(0, int(values.get("offset") or 0))
+    if offset > app.config["SEARCH_MAX_OFFSET"]:
+        raise ValueError("too far into the results, narrow the search down")
+    room_id = None
+    if values.get("room"):
+        room_id = db_executor.run(room_directory.lookup, str(values["room"]))
+        if room_id is None:
+            return search.SearchPage(results=[], next_offset=None)
+    user_id, since, until = (values.get(key) for key in ("user_id", "since", "until"))
+    return db_executor.run(
+        search.search,
+        text,
+        user_id=int(user_id) if user_id else None,
+        room_id=room_id,
+        since=datetime.fromtimestamp(float(since)) if since else None,
+        until=datetime.fromtimestamp(float(until)) if until else None,
+        order=values.get("order") or search.RANK,
+        limit=limit,
+        offset=offset,
+        fts=search_enabled,
+        archive=message_archive,
     )
 
 
+@socketio.on("search-messages")
+@authentication_required
+@rate_limited("search-messages")
+def handle_search(data):
+    """same arguments as /api/search, answered with search-results
+
+    the reply carries back the request's "id" so a client can match it up
+    """
+    data = data if isinstance(data, dict) else {}
+    try:
+        reply = search_messages(data).to_json()
+    except (TypeError, ValueError) as e:
+        reply = {"error": str(e)}
+    reply["id"] = data.get("id")
+    emit("search-results", reply)
+
+
 @socketio.on("get-messages")
 @authentication_required
+@rate_limited("get-messages")
 def get_messages(data):
-    since = datetime.utcnow()
-    messages = [
-        msg.to_json()
-        for msg in reversed(
-            Message.query.order_by(Message.datetime.desc()).limit(100).all()
-        )
-    ]
-    emit("return-messages", messages, broadcast=False, include_self=True)
+    "the newest messages of a room the socket is in, the default room if none"
+    room = data.get("room", DEFAULT_ROOM) if isinstance(data, dict) else DEFAULT_ROOM
+    if not room_membership.is_in(request.sid, room):
+        return {"error": "join the room first"}
+    entries = message_cache.recent_entries(room, 100)
+    if client_encoding() == wire.PACKED:
+        emit("return-messages", message_cache.pack(entries), broadcast=False)
+    else:
+        messages = [entry.data for entry in entries]
+        emit("return-messages", messages, broadcast=False, include_self=True)
+    if entries:
+        cursor = history.encode_cursor(entries[0].data)
+        emit("history-cursor", cursor, broadcast=False, include_self=True)
 
 
 app.add_template_filter(datetime.strftime)
@@ -261,12 +895,36 @@ def index():
     return render_template("test/index.html", title="Index")
 
 
+password_hasher = PasswordHasher(
+    app.config["PASSWORD_HASH_METHOD"],
+    app.config["PASSWORD_WORKERS"],
+    app.config["PASSWORD_MAX_PENDING"],
+    app.config["PASSWORD_TIMEOUT"],
+)
+atexit.register(password_hasher.shutdown)
+
+
+@app.errorhandler(HasherBusy)
+def password_hasher_busy(e):
+    resp = make_response("too many logins right now, try again shortly", 503)
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     form = forms.Login()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and check_password_hash(user.password, form.password.data):
+        matched, rehashed = False, None
+        if user:
+            matched, rehashed = password_hasher.verify(
+                user.password, form.password.data
+            )
+        if matched:
+            if rehashed:
+                user.password = rehashed
+                db.session.commit()
             login_user(user)
             flash("Login Success!", "success")
             return redirect(url_for("dashboard"))
@@ -283,8 +941,7 @@ def login():
 @app.route("/logout")
 @login_required
 def logout():
-    user = onlineUsers.lookup_user(current_user.id)
-    user.online = False
+    presence.drop_user(current_user.id)
     logout_user()
     return render_template("/test/logout.html")
 
@@ -293,17 +950,29 @@ def logout():
 def signup():
     form = forms.Signup()
     if form.validate_on_submit():
-        hashed_password = generate_password_hash(form.password.data, "sha256")
+        hashed_password = password_hasher.hash(form.password.data)
         new_user = User(
             username=form.username.data,
             email=form.email.data,
             password=hashed_password,
         )
         db.session.add(new_user)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # taken between validation and now, eg. through another worker
+            db.session.rollback()
+            flash("username or email already in use", "error")
+            return render_template("test/signup.html", title="Signup", form=form)
         flash("User created!", "success")
 
+        taken = {"username": new_user.username, "email": new_user.email}
+        for column, value in taken.items():
+            availability.add(column, value)
+        cluster.publish("names-taken", taken)
+
         onlineUsers.add_user(new_user)
+        cluster.publish("user-added", onlineUsers.lookup_user(new_user.id).__dict__)
         session["user_id"] = new_user.id
 
         return redirect(url_for("login")), 300
@@ -314,18 +983,37 @@ def signup():
     return render_template("test/signup.html", title="Signup", form=form)
 
 
+AVATAR_DIRECTORY = os.path.join(app.root_path, app.config["AVATAR_DIRECTORY"])
+
+
+def avatar_processed(user_id: int, digest: Optional[str]):
+    "called from the avatar pipeline once every size of an upload is written"
+    if digest is None:
+        print("avatar pipeline: could not decode upload from user", user_id)
+        return
+    with app.app_context():
+        user = User.query.get(user_id)
+        user.avatar_filename = digest
+        db.session.commit()
+    set_avatar(onlineUsers.lookup_user(user_id), digest)
+
+
+avatar_pipeline = avatars.AvatarPipeline(
+    AVATAR_DIRECTORY,
+    app.config["AVATAR_SIZES"],
+    avatar_processed,
+    app.config["AVATAR_WORKERS"],
+)
+atexit.register(avatar_pipeline.shutdown)
+
+
 @app.route("/change_avatar", methods=["POST", "GET"])
 @login_required
 def change_avatar():
     form = forms.Avatar()
     if form.validate_on_submit():
-        filename = secure_filename(form.avatar.data.filename)
-        filename = f"user_{current_user.id}_avatar.{filename.split('.')[-1]}"
-        form.avatar.data.save(f"static/avatars/{filename}")
-        current_user.avatar_filename = filename
-
-        db.session.commit()
-        flash("changed avatar", "success")
+        avatar_pipeline.submit(current_user.id, form.avatar.data.read())
+        flash("avatar uploaded, it will change once it's processed", "success")
         redirect(url_for("dashboard"))
 
     elif form.is_submitted():
@@ -334,6 +1022,50 @@ def change_avatar():
     return render_template("test/change_avatar.html", form=form)
 
 
+@app.route(avatars.AVATAR_URL_PREFIX + "<name>")
+def avatar_image(name):
+    # names are content hashes so a given url never changes
+    resp = send_from_directory(AVATAR_DIRECTORY, name)
+    resp.cache_control.max_age = 365 * 24 * 60 * 60
+    resp.cache_control.immutable = True
+    resp.cache_control.public = True
+    return resp
+
+
+ASSET_DIRECTORY = os.path.join(app.root_path, app.config["ASSET_DIRECTORY"])
+
+asset_manifest = assets.AssetManifest(ASSET_DIRECTORY).load()
+app.add_template_global(asset_manifest.url, "asset_url")
+
+
+@app.cli.command("build-assets")
+def build_assets_command():
+    "write hashed and compressed copies of the static js and css"
+    builder = assets.AssetBuilder(app.static_folder, ASSET_DIRECTORY)
+    print("built", len(builder.build()), "assets into", ASSET_DIRECTORY)
+
+
+@app.route(assets.ASSET_URL_PREFIX + "<path:name>")
+def asset(name):
+    # only hashed names, anything else could change behind an immutable url
+    if not asset_manifest.is_hashed(name):
+        return "", 404
+    accepted = {value: quality for value, quality in request.accept_encodings}
+    filename, encoding = assets.choose_encoding(ASSET_DIRECTORY, name, accepted)
+    resp = send_from_directory(
+        ASSET_DIRECTORY, filename, mimetype=assets.content_type(name)
+    )
+    if encoding is not None:
+        resp.headers["Content-Encoding"] = encoding
+    # don't suggest saving it as .gz or .br
+    resp.headers.pop("Content-Disposition", None)
+    resp.vary.add("Accept-Encoding")
+    resp.cache_control.max_age = 365 * 24 * 60 * 60
+    resp.cache_control.immutable = True
+    resp.cache_control.public = True
+    return resp
+
+
 @app.route("/dashboard")
 @login_required
 def dashboard():
@@ -351,17 +1083,12 @@ def chat():
 def chat_messages():
     last_seen = onlineUsers.get_last_request_time(current_user.id)
     messages = (
-        Message.query.order_by(Message.datetime)
+        message_views.message_query(authors=True)
+        .filter(Message.room_id == rooms.DEFAULT_ROOM_ID)
         .filter(Message.datetime > last_seen)
-        .all()
+        .order_by(Message.datetime, Message.id)
     )
-    resp = json.dumps(
-        [
-            (datetime.strftime(msg.datetime, r"%H:%M:%S"), msg.user.username, msg.text)
-            for msg in messages
-        ]
-    )
-    return resp
+    return json.dumps(message_views.to_chat_lines(messages))
 
 
 @app.route("/space")
@@ -372,8 +1099,38 @@ def space():
 @app.route("/api/get/userlist")
 @login_required
 def get_userlist():
-    user_list = [user.__dict__ for user in onlineUsers.user_dict.values()]
-    return json.dumps(user_list)
+    "a page of the user directory, ?offset=&limit= or ?ids=1,2,3"
+    if "ids" in request.args:
+        try:
+            ids = [int(user_id) for user_id in request.args["ids"].split(",")]
+        except ValueError:
+            return "ids must be a comma separated list of user ids", 400
+        users = onlineUsers.lookup_many(ids[: app.config["USER_LIST_MAX_PAGE_SIZE"]])
+    else:
+        offset = request.args.get("offset", 0, type=int)
+        limit = request.args.get("limit", app.config["USER_LIST_PAGE_SIZE"], type=int)
+        limit = max(1, min(limit, app.config["USER_LIST_MAX_PAGE_SIZE"]))
+        users = onlineUsers.page(max(offset, 0), limit)
+    return json.dumps([user.to_json() for user in users])
+
+
+@app.route("/api/get/available")
+def get_availability():
+    """?username=&email=, whether each given value is still free
+
+    open to anyone signing up, so limited per client address instead
+    """
+    retry_after = rate_limiter.allow(("ip", request.remote_addr), "check-availability")
+    if retry_after is not None:
+        return "Too many requests", 429, {"Retry-After": str(math.ceil(retry_after))}
+    result = dict()
+    for column in availability.columns:
+        value = request.args.get(column)
+        if value:
+            result[column] = not availability.is_taken(column, value)
+    if not result:
+        return "Expected 'username' or 'email'", 400
+    return json.dumps(result)
 
 
 @app.route("/api/get/user/<user_id>/stats")
@@ -384,10 +1141,8 @@ def get_user_stats(user_id):
         stats = {
             "ID": user.id,
             "Username": user.username,
-            "Posts": Message.query.filter(Message.user_id == user.id).count(),
-            "Status": "Online"
-            if onlineUsers.lookup_user(user.id).online
-            else "Offline",
+            "Posts": user.post_count + message_writer.pending_count(user.id),
+            "Status": "Online" if presence.is_online(user.id) else "Offline",
         }
     else:
         status = 404
@@ -396,36 +1151,129 @@ def get_user_stats(user_id):
     return json.dumps(stats), status
 
 
+@app.route("/api/get/stats/message-writer")
+@login_required
+def get_message_writer_stats():
+    stats = dict(message_writer.stats.__dict__, queue_depth=message_writer.queue_depth)
+    return json.dumps(stats)
+
+
+@app.route("/api/get/stats/flow-control")
+@login_required
+def get_flow_control_stats():
+    stats = dict(
+        outbound_monitor.stats,
+        throttled=rate_limiter.throttled,
+        rate_limit_buckets=len(rate_limiter),
+        duplicate_messages=sent_message_ids.duplicates,
+    )
+    return json.dumps(stats)
+
+
+@app.route("/api/get/stats/rooms")
+@login_required
+def get_room_stats():
+    sizes = room_presence.sizes()
+    stats = {
+        "rooms_with_members": len(sizes),
+        "largest_rooms": dict(sizes.most_common(10)),
+        "sockets_in_rooms": len(room_membership),
+    }
+    return json.dumps(stats)
+
+
+@app.route("/api/get/stats/archive")
+@login_required
+def get_archive_stats():
+    return json.dumps(message_archive.stats)
+
+
+@app.route("/api/get/stats/broadcasts")
+@login_required
+def get_broadcast_stats():
+    return json.dumps(broadcasts.stats)
+
+
+@app.route("/api/search")
+@login_required
+def search_chat():
+    "?q=&room=&user_id=&since=&until=&order=&limit=&offset=, see search_messages"
+    # shares its limit with the search-messages socket event
+    retry_after = rate_limiter.allow(current_user.id, "search-messages")
+    if retry_after is not None:
+        return "Too many requests", 429, {"Retry-After": str(math.ceil(retry_after))}
+    try:
+        page = search_messages(request.args)
+    except (TypeError, ValueError) as e:
+        return str(e), 400
+    return json.dumps(page.to_json())
+
+
 @app.route("/api/get/chat/history", methods=["POST"])
 def get_chat_history():
+    """a room's chat history paged by (datetime, id) cursors
+
+    expects json with an optional 'room', the default room otherwise, an
+    optional 'cursor' from a previous page, a 'direction' of 'before' or
+    'after' and an optional 'limit'. the older form containing only
+    'before' (a UNIX timestamp) returns a plain list of messages newest
+    first.
+    """
     if not request.is_json:
-        return "Expected json containing 'before': UNIX timestamp", 400
-    before = request.get_json().get("before", None)
-    if not before:
-        return (
-            "request must inclue 'before' which contains the UNIX time to look for",
-            400,
+        return "Expected json containing 'cursor' or 'before'", 400
+    data = request.get_json()
+
+    room = data.get("room", DEFAULT_ROOM)
+    room_id = rooms.valid_name(room) and db_executor.run(room_directory.lookup, room)
+    if not room_id:
+        return "no such room", 404
+
+    try:
+        before = data.get("before", None)
+        if before and "cursor" not in data:
+            before = float(before)
+            if not math.isfinite(before):
+                raise ValueError("before must be a UNIX timestamp")
+            cached = message_cache.before(room, (before, 0), 100)
+            if cached is not None:
+                return message_cache.encode(cached)
+            page = db_executor.run(
+                history.fetch_page,
+                (before, 0),
+                history.BEFORE,
+                100,
+                room=room,
+                room_id=room_id,
+                archive=message_archive,
+            )
+            return json.dumps(page.messages[::-1])
+
+        limit = int(data.get("limit", app.config["CHAT_HISTORY_PAGE_SIZE"]))
+        limit = max(1, min(limit, app.config["CHAT_HISTORY_MAX_PAGE_SIZE"]))
+        cursor = data.get("cursor", None)
+        key = history.decode_cursor(cursor) if cursor else None
+        page = db_executor.run(
+            history.fetch_page,
+            key,
+            data.get("direction", history.BEFORE),
+            limit,
+            cache=message_cache,
+            room=room,
+            room_id=room_id,
+            archive=message_archive,
         )
-    before = datetime.fromtimestamp(before)
-    messages = (
-        Message.query.order_by(Message.datetime.desc())
-        .filter(Message.datetime < before)
-        .limit(100)
-        .all()
-    )
-    payload = json.dumps([msg.to_json() for msg in messages])
-    return payload
+    except (TypeError, ValueError, OverflowError) as e:
+        return str(e), 400
+
+    return json.dumps(page.to_json())
 
 
 @app.route("/chat/post", methods=["POST"])
 def chat_post():
     form = forms.Chat()
     if form.validate_on_submit():
-        message = Message(
-            text=form.message.data, datetime=datetime.utcnow(), user_id=current_user.id
-        )
-        db.session.add(message)
-        db.session.commit()
+        message = message_writer.submit(form.message.data, current_user.id)
+        add_chat_message(DEFAULT_ROOM, message.to_json())
     flash_form_errors(form)
     return redirect(url_for("chat"))
 
@@ -448,16 +1296,180 @@ def user_card(user_id):
         stats = {
             "ID": str(user.id),
             "Username": user.username,
-            "Posts": str(Message.query.filter(Message.user_id == user.id).count()),
+            "Posts": str(user.post_count + message_writer.pending_count(user.id)),
             # "Status": ("Online" if user.online else "Offline"),
         }
-        avatar = f"{user.avatar_filename}"
-        return render_template("user-card.html", stats=stats, avatar=avatar)
+        avatar = avatars.avatar_url(
+            user.avatar_filename, max(app.config["AVATAR_SIZES"])
+        )
+
+        # the card only depends on these values, so they make a cheap etag
+        # that can be checked before rendering anything
+        etag = hashlib.sha1(repr((stats, avatar)).encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+        else:
+            resp = make_response(
+                render_template("user-card.html", stats=stats, avatar=avatar)
+            )
+        resp.set_etag(etag)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = app.config["USER_CARD_MAX_AGE"]
+        return resp
 
     else:
         return render_template("user-card.html"), 404
 
 
-if __name__ == "__main__":
-    socketio.run(debug=DEBUG, use_evalex=False)
+def room_sizes() -> Dict[str, int]:
+    """clients in the METRICS_ROOM_LIMIT biggest socket.io rooms, the rest
+    added up under "other"
+
+    leaves out the room socket.io makes per client
+    """
+    namespace_rooms = socketio.server.manager.rooms.get("/", {})
+    clients = namespace_rooms.get(None, {})
+    sizes = sorted(
+        (
+            (len(members), room)
+            for room, members in list(namespace_rooms.items())
+            if room is not None and room not in clients
+        ),
+        reverse=True,
+    )
+    limit = app.config["METRICS_ROOM_LIMIT"]
+    largest = {room: size for size, room in sizes[:limit]}
+    if len(sizes) > limit:
+        largest["other"] = sum(size for size, _ in sizes[limit:])
+    return largest
+
+
+metrics_registry.gauge(
+    "chat_connected_clients",
+    "open engine.io connections on this worker",
+    lambda: len(socketio.server.eio.sockets),
+)
+metrics_registry.gauge(
+    "chat_room_clients", "clients in the biggest rooms", room_sizes, ("room",)
+)
+metrics_registry.gauge(
+    "chat_online_users",
+    "users with a live connection",
+    lambda: len(presence_log.snapshot()["users"]),
+)
+metrics_registry.gauge(
+    "chat_user_directory_cached",
+    "users loaded in the directory",
+    lambda: len(onlineUsers),
+)
+metrics_registry.gauge(
+    "chat_message_writer_queue",
+    "messages waiting to be written",
+    lambda: message_writer.queue_depth,
+)
+metrics_registry.gauge(
+    "chat_broadcast_total",
+    "broadcast events and the frames they were sent in",
+    lambda: {(kind,): count for kind, count in broadcasts.stats.items()},
+    ("kind",),
+    kind="counter",
+)
+metrics_registry.gauge(
+    "chat_rate_limited_total",
+    "socket events dropped by rate limits",
+    lambda: {(event,): count for event, count in rate_limiter.throttled.items()},
+    ("event",),
+    kind="counter",
+)
+metrics_registry.gauge(
+    "chat_slow_consumers",
+    "slow connection evictions, lagging connections and the deepest queue",
+    lambda: {(kind,): value for kind, value in outbound_monitor.stats.items()},
+    ("kind",),
+)
+metrics_registry.gauge(
+    "chat_password_rejected_total",
+    "logins and signups turned away by the password hasher",
+    lambda: password_hasher.rejected,
+    kind="counter",
+)
+metrics_registry.gauge(
+    "chat_availability_lookups",
+    "username and email checks and how many reached the database",
+    lambda: {(kind,): count for kind, count in availability.stats.items()},
+    ("kind",),
+)
 
+
+@app.route("/metrics")
+def prometheus_metrics():
+    token = app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return "", 401
+    resp = make_response(metrics_registry.render())
+    resp.headers["Content-Type"] = metrics.CONTENT_TYPE
+    return resp
+
+
+def admin_required(view):
+    "only for users listed in ADMIN_USERS"
+
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if current_user.username not in app.config["ADMIN_USERS"]:
+            return "", 403
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.route("/admin/profiler", methods=["GET", "POST"])
+@admin_required
+def profiler_control():
+    """status of the sampling profiler in this worker
+
+    post with action=start (and optional interval, duration and idle=1) or
+    action=stop
+    """
+    if request.method == "POST":
+        action = request.values.get("action")
+        if action == "start":
+            try:
+                interval = float(request.values.get("interval", 0))
+                duration = float(request.values.get("duration", 0))
+            except ValueError as e:
+                return str(e), 400
+            idle = request.values.get("idle") == "1"
+            if not profiler.start(interval, duration, include_idle=idle):
+                return json.dumps(profiler.status()), 409
+        elif action == "stop":
+            profiler.stop()
+        else:
+            return "action must be start or stop", 400
+    return json.dumps(profiler.status())
+
+
+@app.route("/admin/profiler/profile")
+@admin_required
+def profiler_download():
+    "the last profile as collapsed stacks, for flamegraph.pl or speedscope"
+    resp = make_response(profiler.collapsed())
+    resp.headers["Content-Type"] = "text/plain; charset=utf-8"
+    started = datetime.fromtimestamp(profiler.started or 0).strftime("%Y%m%d-%H%M%S")
+    filename = f"chat-{os.getpid()}-{started}.folded"
+    resp.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return resp
+
+
+@app.route("/admin/slow")
+@admin_required
+def slow_handler_traces():
+    "requests and socket events slower than SLOW_HANDLER_THRESHOLD, newest first"
+    return json.dumps(list(reversed(slow_handlers.traces)))
+
+
+if __name__ == "__main__":
+    # use_evalex only means something to the werkzeug dev server
+    run_options = {"use_evalex": False} if ASYNC_MODE == "threading" else {}
+    socketio.run(app, debug=DEBUG, **run_options)
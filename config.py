@@ -1,7 +1,146 @@
-from os import urandom
-
+from os import environ, urandom
 
 SECRET_KEY = urandom(24)
 SQLALCHEMY_DATABASE_URI = "sqlite:///local/test/database.db"
 SQLALCHEMY_TRACK_NOTIFICATIONS = True
 MAX_CONTENT_LENGTH = 100 * 1024
+
+# write-behind message persistence, see message_writer.py
+MESSAGE_JOURNAL_PATH = "local/test/messages-{worker_id}.journal"
+MESSAGE_FLUSH_SIZE = 200
+MESSAGE_FLUSH_INTERVAL = 0.5
+MESSAGE_JOURNAL_FSYNC = False
+
+# longest chat message accepted over a socket, the same as forms.Chat
+MAX_MESSAGE_LENGTH = 2000
+
+# number of recent messages per room kept in memory, see message_cache.py
+RECENT_MESSAGE_CACHE_SIZE = 500
+
+# keyset paginated chat history, see history.py
+CHAT_HISTORY_PAGE_SIZE = 100
+CHAT_HISTORY_MAX_PAGE_SIZE = 500
+
+# full text search over messages, see search.py
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_MAX_OFFSET = 1000
+
+# messages older than ARCHIVE_AFTER_DAYS are moved out of the messages
+# table into compressed monthly segments under ARCHIVE_DIRECTORY, checked
+# every ARCHIVE_INTERVAL seconds by worker 0 and moved ARCHIVE_BATCH_SIZE at
+# a time. 0 days turns it off, history reads the archive either way. see
+# archive.py
+ARCHIVE_DIRECTORY = "local/archive"
+ARCHIVE_AFTER_DAYS = int(environ.get("CHAT_ARCHIVE_AFTER_DAYS", 90))
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH_SIZE = 20_000
+ARCHIVE_BLOCK_SIZE = 256
+
+# seconds browsers may reuse a rendered user card before revalidating
+USER_CARD_MAX_AGE = 30
+
+# socket server concurrency, one of "threading", "eventlet" or "gevent".
+# the green thread modes need eventlet or gevent installed
+ASYNC_MODE = environ.get("CHAT_ASYNC_MODE", "threading")
+# most database calls allowed in flight at once, see db_executor.py
+DATABASE_WORKERS = 8
+
+# running several workers behind a load balancer. every worker needs the
+# same bus url ("redis://..." or "local://<name>" for a single process) and
+# its own worker id from 0 to WORKER_COUNT - 1
+MESSAGE_BUS_URL = environ.get("CHAT_MESSAGE_BUS")
+WORKER_ID = int(environ.get("CHAT_WORKER_ID", 0))
+WORKER_COUNT = int(environ.get("CHAT_WORKER_COUNT", 1))
+
+# presence, see presence.py. use "sqlite:///<path>" to share presence
+# between workers on one machine, "memory" for a single worker. the server
+# refuses to start with "memory" when WORKER_COUNT is more than 1
+PRESENCE_BACKEND = environ.get("CHAT_PRESENCE_BACKEND", "memory")
+PRESENCE_TTL = 45
+PRESENCE_HEARTBEAT_INTERVAL = 15
+PRESENCE_TICK = 1
+
+# users are loaded on demand, see user_directory.py
+USER_DIRECTORY_CACHE_SIZE = 10_000
+USER_LIST_PAGE_SIZE = 200
+USER_LIST_MAX_PAGE_SIZE = 1000
+
+# uploaded avatars are resized to these square sizes in AVATAR_WORKERS
+# processes (0 to resize on the request thread), see avatars.py
+AVATAR_DIRECTORY = "static/avatars"
+AVATAR_SIZES = (32, 64, 256)
+AVATAR_WORKERS = 2
+
+# content hashed, precompressed copies of static js and css written by
+# "flask build-assets", see assets.py. without a build the plain static
+# files are served
+ASSET_DIRECTORY = "local/assets"
+
+# password hashing, see passwords.py. hashes made with an older method are
+# replaced on the user's next login. PASSWORD_WORKERS processes do the
+# hashing (0 for the request thread), past PASSWORD_MAX_PENDING queued
+# logins and signups get a 503
+PASSWORD_HASH_METHOD = "pbkdf2:sha256:260000"
+PASSWORD_WORKERS = int(environ.get("CHAT_PASSWORD_WORKERS", 2))
+PASSWORD_MAX_PENDING = 32
+PASSWORD_TIMEOUT = 5
+
+# signup checks usernames and emails against bloom filters before the
+# database, see availability.py
+AVAILABILITY_CAPACITY = 100_000
+AVAILABILITY_ERROR_RATE = 0.01
+
+# room broadcasts within this many seconds of each other are sent as one
+# frame of at most BROADCAST_BATCH_SIZE events, 0 sends every event on its
+# own. see batching.py
+BROADCAST_BATCH_INTERVAL = 0.01
+BROADCAST_BATCH_SIZE = 64
+
+# socket events a user may send, as (events per second, burst), shared by
+# all of the user's connections. see flow_control.py
+RATE_LIMITS = {
+    "chat-message": (5, 10),
+    # "chat-messages" batches, their messages also count as chat-message
+    "chat-messages": (5, 10),
+    "get-messages": (1, 5),
+    "get-user-list": (1, 5),
+    "presence-sync": (2, 10),
+    "set-encoding": (1, 5),
+    "search-messages": (1, 5),
+    "join-room": (1, 10),
+    "create-room": (1 / 60, 3),
+    # per client address, the signup page checks names as the user types
+    "check-availability": (2, 20),
+}
+# chat rooms one socket may be in at once, see rooms.py
+ROOMS_PER_SOCKET = 20
+# rooms one user may make with "create-room", joining never makes one
+ROOMS_PER_USER = 5
+# messages a client may send in one "chat-messages" batch, and how many
+# recent client message ids are remembered to drop resends, see dedup.py
+CLIENT_MESSAGE_BATCH_SIZE = 50
+CLIENT_MESSAGE_ID_WINDOW = 10_000
+# connections with more than OUTBOUND_QUEUE_LIMIT packets waiting for
+# OUTBOUND_QUEUE_GRACE checks in a row are disconnected
+OUTBOUND_QUEUE_LIMIT = 1000
+OUTBOUND_QUEUE_GRACE = 3
+OUTBOUND_CHECK_INTERVAL = 2
+
+# bearer token prometheus has to send to read /metrics, unset leaves the
+# endpoint open. see metrics.py
+METRICS_TOKEN = environ.get("CHAT_METRICS_TOKEN")
+# chat_room_clients reports this many of the biggest rooms by name and
+# sums up the rest, so the number of series stays bounded
+METRICS_ROOM_LIMIT = 20
+
+# admin only profiling, see profiler.py. ADMIN_USERS are usernames,
+# comma separated in CHAT_ADMIN_USERS. a profile samples every thread every
+# PROFILER_INTERVAL seconds for at most PROFILER_MAX_DURATION. requests and
+# socket events slower than SLOW_HANDLER_THRESHOLD seconds keep a trace of
+# their sql and stack, 0 turns that off
+ADMIN_USERS = frozenset(filter(None, environ.get("CHAT_ADMIN_USERS", "").split(",")))
+PROFILER_INTERVAL = 0.01
+PROFILER_MAX_DURATION = 300
+SLOW_HANDLER_THRESHOLD = float(environ.get("CHAT_SLOW_HANDLER_THRESHOLD", 0.5))
+SLOW_HANDLER_KEEP = 50
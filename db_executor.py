@@ -0,0 +1,63 @@
+import threading
+from typing import Callable, TypeVar
+
+from .sql_models import db
+
+T = TypeVar("T")
+
+
+class DatabaseExecutor:
+    """runs blocking database work without stalling the socket server
+
+    in threading mode every handler already has its own thread so work runs
+    inline. under eventlet or gevent a blocking sqlite call would freeze
+    every green thread in the process, so the work is handed to a pool of
+    real os threads and only the calling green thread waits for it. either
+    way at most max_workers calls touch the database at once.
+    """
+
+    def __init__(self, app, async_mode: str = "threading", max_workers: int = 8):
+        self._app = app
+        self.async_mode = async_mode
+        self.max_workers = max_workers
+
+        if async_mode == "eventlet":
+            from eventlet import tpool
+            from eventlet.semaphore import Semaphore
+
+            tpool.set_num_threads(max_workers)
+            self._offload = tpool.execute
+            self._slots = Semaphore(max_workers)
+
+        elif async_mode == "gevent":
+            from gevent import get_hub
+            from gevent.lock import BoundedSemaphore
+
+            pool = get_hub().threadpool
+            pool.maxsize = max_workers
+            self._offload = pool.apply
+            self._slots = BoundedSemaphore(max_workers)
+
+        else:
+            self._offload = None
+            self._slots = threading.BoundedSemaphore(max_workers)
+
+    def run(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """call func(*args, **kwargs) and wait for the result
+
+        offloaded work gets its own app context and session, inline work
+        uses the caller's
+        """
+        if self._offload is None:
+            with self._slots:
+                return func(*args, **kwargs)
+
+        def work():
+            with self._app.app_context():
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    db.session.remove()
+
+        with self._slots:
+            return self._offload(work)
@@ -0,0 +1,38 @@
+import threading
+from collections import OrderedDict
+from typing import Hashable
+
+
+class RecentIds:
+    """remembers the last capacity ids it was given
+
+    clients tag each message with an id of their own and resend whatever
+    wasn't acknowledged, so a message whose ack was lost on the way back
+    arrives twice. checking the id here keeps it from being posted twice.
+    only recent ids are kept, a client retrying for longer than it takes
+    capacity other messages to arrive can still get a duplicate through.
+    """
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def add(self, key: Hashable) -> bool:
+        "False if key was seen already"
+        with self._lock:
+            if key in self._ids:
+                self._ids.move_to_end(key)
+                self.duplicates += 1
+                return False
+            self._ids[key] = None
+            if len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+            return True
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._ids
+
+    def __len__(self):
+        return len(self._ids)
@@ -0,0 +1,137 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+class TokenBucket:
+    """allows rate events per second on average with bursts of up to burst
+
+    starts full, so a client's first burst is never throttled
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float, tokens: float = 1) -> bool:
+        self._refill(now)
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def retry_after(self, tokens: float = 1) -> float:
+        "seconds until tokens are available"
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class RateLimiter:
+    """token buckets per user and event type
+
+    limits maps an event name to (events per second, burst). events without
+    a limit are always allowed. a user's buckets are shared by all of their
+    connections so opening more sockets doesn't buy a higher rate.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        self.limits = limits
+        self._buckets: Dict[Tuple[Hashable, str], TokenBucket] = dict()
+        self._lock = threading.Lock()
+        self._calls = 0
+        self.throttled: Dict[str, int] = defaultdict(int)
+
+    def allow(self, user: Hashable, event: str, cost: float = 1) -> Optional[float]:
+        """None if the event may go ahead, else seconds until it may
+
+        cost is how many events this one counts as. a cost over the burst
+        could never go ahead, callers split work that big up instead
+        """
+        limit = self.limits.get(event)
+        if limit is None:
+            return None
+        if cost > limit[1]:
+            raise ValueError(f"cost {cost} is over the {event!r} burst of {limit[1]}")
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((user, event))
+            if bucket is None:
+                bucket = self._buckets[user, event] = TokenBucket(*limit, now)
+            allowed = bucket.take(now, cost)
+            self._calls += 1
+            if self._calls % 10_000 == 0:
+                self._prune(now)
+            if allowed:
+                return None
+            self.throttled[event] += 1
+            return bucket.retry_after(cost)
+
+    def _prune(self, now: float):
+        # a full bucket is the same as no bucket
+        for key in [key for key, bucket in self._buckets.items() if bucket.full(now)]:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class OutboundMonitor:
+    """disconnects clients that don't read what is sent to them
+
+    every check looks at how many packets are waiting in each connection's
+    outbound queue. a connection that stays over limit for grace checks in
+    a row is evicted, it can reconnect and fetch history once it catches
+    up. short bursts that a client drains between checks are left alone.
+    """
+
+    def __init__(
+        self,
+        queue_sizes: Callable[[], Dict[str, int]],
+        evict: Callable[[str], None],
+        limit: int = 1000,
+        grace: int = 3,
+    ):
+        self.queue_sizes = queue_sizes
+        self.evict = evict
+        self.limit = limit
+        self.grace = grace
+        self._strikes: Dict[str, int] = dict()
+        self.stats = {"evicted": 0, "lagging": 0, "deepest_queue": 0}
+
+    def check(self):
+        sizes = self.queue_sizes()
+        strikes = dict()
+        for sid, size in sizes.items():
+            if size > self.limit:
+                strikes[sid] = self._strikes.get(sid, 0) + 1
+        self._strikes = strikes
+        self.stats["lagging"] = len(strikes)
+        self.stats["deepest_queue"] = max(sizes.values(), default=0)
+
+        for sid, count in list(strikes.items()):
+            if count >= self.grace:
+                try:
+                    self.evict(sid)
+                except Exception as e:
+                    print("evicting slow connection", sid, "failed:", e)
+                    continue
+                self.stats["evicted"] += 1
+                del self._strikes[sid]
+
+    def run_forever(self, sleep: Callable[[float], None], interval: float):
+        "check every interval seconds, run in a background task"
+        while True:
+            sleep(interval)
+            self.check()
@@ -7,6 +7,7 @@ from wtforms.fields.simple import TextField
 from wtforms.validators import InputRequired, Length, EqualTo, ValidationError
 from wtforms.fields.html5 import EmailField
 
+from .availability import current_index
 from .sql_models import db, User
 
 
@@ -22,7 +23,13 @@ class CustomValidator:
             raise ValueError(f"{column} is not a column in {table}")
 
         def _validator(form, field):
-            if table.query.filter(column == field.data).first():
+            index = current_index()
+            if index is not None and column.key in index.columns:
+                # the index only queries when the value is probably taken
+                taken = index.is_taken(column.key, field.data)
+            else:
+                taken = table.query.filter(column == field.data).first()
+            if taken:
                 if not message:
                     raise ValidationError(f"{field.name} already exists")
                 raise ValidationError(message)
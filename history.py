@@ -0,0 +1,161 @@
+import base64
+import binascii
+import heapq
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from . import message_views
+from .archive import MessageArchive
+from .message_cache import RecentMessageCache
+from .rooms import DEFAULT_ROOM, DEFAULT_ROOM_ID
+from .sql_models import db, Message
+
+BEFORE = "before"
+AFTER = "after"
+
+Key = Tuple[float, int]
+
+
+def encode_cursor(message: dict) -> str:
+    "opaque cursor pointing at message, made from its (datetime, id) key"
+    raw = f"{message['datetime']!r}:{message['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Key:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, message_id = raw.split(":")
+        return float(timestamp), int(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"invalid history cursor {cursor!r}")
+
+
+@dataclass
+class HistoryPage:
+    "one page of chat history, messages are oldest first"
+
+    messages: List[dict]
+    has_more: bool
+
+    def to_json(self):
+        return {
+            "messages": self.messages,
+            BEFORE: encode_cursor(self.messages[0]) if self.messages else None,
+            AFTER: encode_cursor(self.messages[-1]) if self.messages else None,
+            "has_more": self.has_more,
+        }
+
+
+def ensure_indexes():
+    "create the history indexes on databases made before they existed"
+    for index in Message.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def fetch_page(
+    key: Optional[Key],
+    direction: str = BEFORE,
+    limit: int = 100,
+    cache: Optional[RecentMessageCache] = None,
+    room: str = DEFAULT_ROOM,
+    room_id: int = DEFAULT_ROOM_ID,
+    archive: Optional[MessageArchive] = None,
+) -> HistoryPage:
+    """keyset paginated history of one room
+
+    direction BEFORE returns the limit messages older than key (the newest
+    messages when key is None), AFTER returns the limit messages newer than
+    key. one extra row is fetched to tell whether another page exists.
+    room names the room in the cache, room_id in the database, where the
+    (room_id, datetime, id) index serves both directions. pages reaching
+    back past the newest archived message also read from archive.
+    """
+    if direction == BEFORE:
+        rows = None
+        if cache is not None:
+            entries = cache.before(room, key or (float("inf"), 0), limit + 1)
+            if entries is not None:
+                rows = [entry.data for entry in entries]
+
+        if rows is None:
+            query = (
+                message_views.message_query()
+                .filter(Message.room_id == room_id)
+                .order_by(Message.datetime.desc(), Message.id.desc())
+            )
+            if key is not None:
+                query = query.filter(
+                    db.tuple_(Message.datetime, Message.id) < _db_key(key)
+                )
+            rows = message_views.to_json_list(query.limit(limit + 1))
+            watermark = archive.watermark if archive is not None else None
+            # archived messages are all from the watermark or before
+            if watermark is not None and (
+                len(rows) <= limit or rows[-1]["datetime"] <= watermark
+            ):
+                rows = _merge(rows, archive.before(room_id, key), limit, True)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+    elif direction == AFTER:
+        query = (
+            message_views.message_query()
+            .filter(Message.room_id == room_id)
+            .order_by(Message.datetime, Message.id)
+        )
+        if key is not None:
+            query = query.filter(db.tuple_(Message.datetime, Message.id) > _db_key(key))
+        rows = message_views.to_json_list(query.limit(limit + 1))
+        watermark = archive.watermark if archive is not None else None
+        if watermark is not None and (key is None or key[0] <= watermark):
+            rows = _merge(rows, archive.after(room_id, key), limit, False)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+    else:
+        raise ValueError(f"direction must be {BEFORE!r} or {AFTER!r}")
+
+    return HistoryPage(messages=rows, has_more=has_more)
+
+
+def recent_messages(room_id: int, limit: int) -> List[dict]:
+    "a room's newest messages newest first, as RecentMessageCache.warm takes them"
+    return message_views.to_json_list(
+        message_views.message_query()
+        .filter(Message.room_id == room_id)
+        .order_by(Message.datetime.desc(), Message.id.desc())
+        .limit(limit)
+    )
+
+
+def _merge(
+    rows: List[dict], archived: Iterable[dict], limit: int, newest_first: bool
+) -> List[dict]:
+    """the first limit + 1 of rows and archived messages together, in order
+
+    archived is only read as far as the page needs. a message caught
+    halfway through being archived can come from both, it's kept once
+    """
+    merged = heapq.merge(
+        rows,
+        archived,
+        key=lambda row: (row["datetime"], row["id"]),
+        reverse=newest_first,
+    )
+    page, last_id = [], None
+    for row in merged:
+        if row["id"] != last_id:
+            page.append(row)
+            last_id = row["id"]
+            if len(page) > limit:
+                break
+    return page
+
+
+def _db_key(key: Key) -> Tuple[datetime, int]:
+    timestamp, message_id = key
+    return datetime.fromtimestamp(timestamp), message_id
@@ -0,0 +1,168 @@
+import base64
+import json
+import queue
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Callable, Dict, Iterator, List, Optional
+
+from socketio import PubSubManager
+
+
+class MessageBus(ABC):
+    "publish/subscribe transport shared by every worker process"
+
+    @abstractmethod
+    def publish(self, channel: str, data: dict) -> None: ...
+
+    @abstractmethod
+    def listen(self, channel: str) -> Iterator[dict]:
+        "blocking iterator over everything published to channel"
+
+
+class LocalBus(MessageBus):
+    """in-process bus, every LocalBus with the same name shares subscribers
+
+    stands in for a real broker when several servers run inside one process,
+    eg. in tests
+    """
+
+    _subscribers: Dict[str, Dict[str, List[queue.Queue]]] = defaultdict(
+        lambda: defaultdict(list)
+    )
+    _lock = threading.Lock()
+
+    def __init__(self, name: str = "default"):
+        self.name = name
+
+    def publish(self, channel: str, data: dict) -> None:
+        with self._lock:
+            subscribers = list(self._subscribers[self.name][channel])
+        for subscriber in subscribers:
+            subscriber.put(data)
+
+    def listen(self, channel: str) -> Iterator[dict]:
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers[self.name][channel].append(subscriber)
+        try:
+            while True:
+                yield subscriber.get()
+        finally:
+            with self._lock:
+                self._subscribers[self.name][channel].remove(subscriber)
+
+
+def _encode_bytes(value):
+    # packed socket.io payloads are bytes, which json can't carry as is
+    if isinstance(value, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"{type(value).__name__} can't be sent over the message bus")
+
+
+def _decode_bytes(value: dict):
+    if len(value) == 1 and "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    return value
+
+
+def dumps(data: dict) -> bytes:
+    "json for the wire between workers, bytes values survive the trip"
+    return json.dumps(data, default=_encode_bytes, separators=(",", ":")).encode()
+
+
+def loads(raw: bytes) -> dict:
+    return json.loads(raw, object_hook=_decode_bytes)
+
+
+class RedisBus(MessageBus):
+    "redis pub/sub, needs the redis package"
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("redis message bus requires the redis package")
+        self._redis = redis.Redis.from_url(url)
+
+    def publish(self, channel: str, data: dict) -> None:
+        self._redis.publish(channel, dumps(data))
+
+    def listen(self, channel: str) -> Iterator[dict]:
+        pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        for message in pubsub.listen():
+            yield loads(message["data"])
+
+
+def bus_from_url(url: str) -> MessageBus:
+    """local://<name> or redis://host:port/db"""
+    if url.startswith("local://"):
+        return LocalBus(url[len("local://") :] or "default")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBus(url)
+    raise ValueError(f"unsupported message bus url {url!r}")
+
+
+class BusClientManager(PubSubManager):
+    """socket.io client manager that fans room broadcasts out over a MessageBus
+
+    each worker delivers to its own connected clients, so a broadcast from
+    any worker reaches every client in the room
+    """
+
+    name = "message-bus"
+
+    def __init__(self, bus: MessageBus, channel: str = "socketio", **kwargs):
+        super().__init__(channel=channel, **kwargs)
+        self.bus = bus
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    def _listen(self):
+        yield from self.bus.listen(self.channel)
+
+
+class ClusterChannel:
+    """application events shared between workers
+
+    used for state the socket.io manager doesn't carry, such as presence
+    and the recent message cache. handlers are not called for events the
+    same worker published.
+    """
+
+    def __init__(self, bus: Optional[MessageBus], channel: str = "chat-cluster"):
+        self.bus = bus
+        self.channel = channel
+        self.node_id = uuid.uuid4().hex
+        self._handlers: Dict[str, Callable[[dict], None]] = dict()
+
+    def on(self, event: str):
+        def decorator(handler: Callable[[dict], None]):
+            self._handlers[event] = handler
+            return handler
+
+        return decorator
+
+    def publish(self, event: str, data: dict) -> None:
+        if self.bus is not None:
+            self.bus.publish(
+                self.channel, {"event": event, "origin": self.node_id, "data": data}
+            )
+
+    def listen_forever(self) -> None:
+        "dispatch events from other workers, run in a background task"
+        if self.bus is None:
+            return
+        for message in self.bus.listen(self.channel):
+            if message.get("origin") == self.node_id:
+                continue
+            handler = self._handlers.get(message.get("event"))
+            if handler is None:
+                continue
+            try:
+                handler(message["data"])
+            except Exception as e:
+                print("cluster event", message.get("event"), "failed:", e)
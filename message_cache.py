@@ -0,0 +1,150 @@
+import json
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+from . import wire
+
+
+@dataclass(frozen=True)
+class CachedMessage:
+    "a message as it is sent to clients, kept alongside its encodings"
+
+    data: dict
+    encoded: str
+    packed: bytes
+
+    @classmethod
+    def from_json(cls, data: dict):
+        return cls(
+            data=data,
+            encoded=json.dumps(data),
+            packed=wire.packb(wire.message_tuple(data)),
+        )
+
+    @property
+    def key(self) -> Tuple[float, int]:
+        "(datetime, id) ordering key used for history paging"
+        return self.data["datetime"], self.data["id"]
+
+
+class RecentMessageCache:
+    """bounded per-room ring buffer of the most recent messages
+
+    serves connects and recent history pages from memory, messages are
+    stored oldest to newest
+    """
+
+    def __init__(self, size: int = 500):
+        self.size = size
+        self._rooms: Dict[str, Deque[CachedMessage]] = dict()
+        self._warm: Set[str] = set()
+        # rooms whose entire history fits in the buffer, a room that hasn't
+        # been warmed from the database may be missing older messages
+        self._complete: Dict[str, bool] = dict()
+        self._lock = threading.Lock()
+
+    def _room(self, room: str) -> Deque[CachedMessage]:
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            buffer = self._rooms[room] = deque(maxlen=self.size)
+            self._complete[room] = False
+        return buffer
+
+    def is_warm(self, room: str) -> bool:
+        return room in self._warm
+
+    def warm(
+        self, room: str, messages: Iterable[dict], complete: Optional[bool] = None
+    ):
+        """fill room with messages given newest first, eg. straight from the db
+
+        messages appended before it was warmed are kept, they may not have
+        been written to the database yet. complete says whether messages is
+        the room's entire history, by default it is if it's shorter than the
+        buffer
+        """
+        entries = [CachedMessage.from_json(data) for data in messages]
+        if complete is None:
+            complete = len(entries) < self.size
+        with self._lock:
+            ids = {entry.data["id"] for entry in entries}
+            entries += [
+                entry
+                for entry in self._rooms.get(room, ())
+                if entry.data["id"] not in ids
+            ]
+            entries.sort(key=lambda entry: entry.key)
+            buffer = self._rooms[room] = deque(entries[-self.size :], maxlen=self.size)
+            self._complete[room] = complete and len(entries) <= self.size
+            self._warm.add(room)
+            return len(buffer)
+
+    def forget(self, room: str):
+        "drop a room nobody here is in any more, it has to be warmed again"
+        with self._lock:
+            self._rooms.pop(room, None)
+            self._complete.pop(room, None)
+            self._warm.discard(room)
+
+    def append(self, room: str, message: dict):
+        entry = CachedMessage.from_json(message)
+        with self._lock:
+            buffer = self._room(room)
+            if len(buffer) == buffer.maxlen:
+                self._complete[room] = False
+                if entry.key < buffer[0].key:
+                    return
+
+            # messages relayed from other workers can arrive slightly out of
+            # order, walk back from the newest end to keep keys sorted
+            index = len(buffer)
+            while index and buffer[index - 1].key > entry.key:
+                index -= 1
+            if index == len(buffer):
+                buffer.append(entry)
+            else:
+                if len(buffer) == buffer.maxlen:
+                    buffer.popleft()
+                    index -= 1
+                buffer.insert(index, entry)
+
+    def recent(self, room: str, limit: int) -> List[dict]:
+        "the last limit messages oldest first"
+        return [entry.data for entry in self.recent_entries(room, limit)]
+
+    def recent_entries(self, room: str, limit: int) -> List[CachedMessage]:
+        with self._lock:
+            buffer = self._rooms.get(room, ())
+            start = max(len(buffer) - limit, 0)
+            return [buffer[i] for i in range(start, len(buffer))]
+
+    def before(
+        self, room: str, key: Tuple[float, int], limit: int
+    ) -> Optional[List[CachedMessage]]:
+        """up to limit messages whose (datetime, id) key is below key, newest first
+
+        returns None when the buffer can't answer without going to the db
+        """
+        with self._lock:
+            if room not in self._warm:
+                return None
+            buffer = self._rooms[room]
+            page = []
+            for entry in reversed(buffer):
+                if entry.key < key:
+                    page.append(entry)
+                    if len(page) == limit:
+                        return page
+            return page if self._complete[room] else None
+
+    @staticmethod
+    def encode(entries: List[CachedMessage]) -> str:
+        "join already encoded messages into a json array"
+        return "[" + ",".join(entry.encoded for entry in entries) + "]"
+
+    @staticmethod
+    def pack(entries: List[CachedMessage]) -> bytes:
+        "the same messages for clients using the packed encoding"
+        return wire.pack_messages(entry.packed for entry in entries)
@@ -0,0 +1,48 @@
+from datetime import datetime
+from typing import List
+
+from .sql_models import db, Message, User
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.datetime,
+    Message.user_id,
+    Message.room_id,
+)
+
+
+def message_query(authors: bool = False):
+    """query for message rows without building ORM objects
+
+    with authors the users table is joined in the same statement and each
+    row also carries the author's username
+    """
+    if not authors:
+        return db.session.query(*MESSAGE_COLUMNS)
+    return db.session.query(*MESSAGE_COLUMNS, User.username).outerjoin(
+        User, Message.user_id == User.id
+    )
+
+
+def to_json(row) -> dict:
+    "same shape as Message.to_json for a row from message_query"
+    return {
+        "id": row.id,
+        "text": row.text,
+        "datetime": row.datetime.timestamp(),
+        "user_id": row.user_id,
+        "room_id": row.room_id,
+    }
+
+
+def to_json_list(query) -> List[dict]:
+    return [to_json(row) for row in query]
+
+
+def to_chat_lines(query) -> List[tuple]:
+    "(time, username, text) tuples used by the polling chat page"
+    return [
+        (datetime.strftime(row.datetime, r"%H:%M:%S"), row.username, row.text)
+        for row in query
+    ]
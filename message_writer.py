@@ -0,0 +1,360 @@
+import itertools
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from sqlalchemy.exc import OperationalError
+
+from .db_executor import DatabaseExecutor
+from .rooms import DEFAULT_ROOM_ID
+from .sql_models import db, Message
+from .user_stats import increment_post_counts
+
+# rows per statement when inserting, replayed journals can be far longer
+# than sqlite's limit on bound variables
+INSERT_CHUNK = 500
+
+
+@dataclass
+class FlushPolicy:
+    "when the writer should flush queued messages to the database"
+
+    max_batch: int = 200
+    max_delay: float = 0.5
+    fsync: bool = False
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            max_batch=config.get("MESSAGE_FLUSH_SIZE", cls.max_batch),
+            max_delay=config.get("MESSAGE_FLUSH_INTERVAL", cls.max_delay),
+            fsync=config.get("MESSAGE_JOURNAL_FSYNC", cls.fsync),
+        )
+
+
+@dataclass
+class WriterStats:
+    "counters exposed by the message writer"
+
+    queued: int = 0
+    written: int = 0
+    flushes: int = 0
+    failed_flushes: int = 0
+    dead_letters: int = 0
+    replayed: int = 0
+    last_flush_seconds: float = 0.0
+    max_flush_seconds: float = 0.0
+    total_flush_seconds: float = 0.0
+
+
+class MessageWriter:
+    """write-behind persistence for chat messages
+
+    messages are given an id, appended to a journal and handed back to the
+    caller straight away, a background thread then inserts them into the
+    messages table in batches. anything still in the journal on startup is
+    replayed so a crash between broadcast and commit loses nothing.
+
+    a batch that fails is retried a message at a time. messages the
+    database rejects are written to a dead letter file next to the journal
+    instead of holding up everything queued behind them, ones that fail
+    because the database is unavailable are queued again.
+    """
+
+    def __init__(
+        self,
+        app,
+        journal_path: str,
+        policy: Optional[FlushPolicy] = None,
+        executor: Optional[DatabaseExecutor] = None,
+        id_offset: int = 0,
+        id_step: int = 1,
+    ):
+        """workers sharing a database each pass their own id_offset and the
+        worker count as id_step so the ids they hand out never collide"""
+        self._app = app
+        self._executor = executor or DatabaseExecutor(app)
+        self._journal_path = journal_path
+        self.dead_letter_path = journal_path + ".dead"
+        self.policy = policy or FlushPolicy()
+        self.stats = WriterStats()
+
+        self._pending: Deque[dict] = deque()
+        self._pending_by_user: Counter = Counter()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # held while a batch is written so only one is ever in flight
+        self._flush_lock = threading.Lock()
+        self._journal = None
+        self._ids = None
+        self._id_offset = id_offset
+        self._id_step = id_step
+        self._thread: Optional[threading.Thread] = None
+        self._running = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def pending_count(self, user_id: int) -> int:
+        "number of messages by user_id not yet committed"
+        return self._pending_by_user[user_id]
+
+    def start(self):
+        if self._running:
+            return
+
+        os.makedirs(os.path.dirname(self._journal_path) or ".", exist_ok=True)
+        with self._app.app_context():
+            self._replay_journal()
+            last_id = db.session.query(db.func.max(Message.id)).scalar() or 0
+
+        first_id = last_id + 1
+        first_id += (self._id_offset - first_id) % self._id_step
+        self._ids = itertools.count(first_id, self._id_step)
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="message-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        "flush everything still queued and stop the writer thread"
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._wakeup.notify()
+        self._thread.join(timeout)
+        self._journal.close()
+
+    def submit(
+        self,
+        text: str,
+        user_id: int,
+        when: Optional[datetime] = None,
+        room_id: int = DEFAULT_ROOM_ID,
+    ) -> Message:
+        """queue a new message for writing
+
+        returns a transient Message with its id already assigned so it can
+        be broadcast before it is committed
+        """
+        when = when or datetime.utcnow()
+        with self._lock:
+            message = Message(
+                id=next(self._ids),
+                text=text,
+                datetime=when,
+                user_id=user_id,
+                room_id=room_id,
+            )
+            row = self._to_row(message)
+            self._journal.write(json.dumps(row) + "\n")
+            self._journal.flush()
+            if self.policy.fsync:
+                os.fsync(self._journal.fileno())
+
+            self._pending.append(row)
+            self._pending_by_user[user_id] += 1
+            self.stats.queued += 1
+            if len(self._pending) >= self.policy.max_batch:
+                self._wakeup.notify()
+        return message
+
+    def flush(self):
+        "write everything queued right now, on the calling thread"
+        with self._flush_lock:
+            with self._lock:
+                batch = self._take_batch(len(self._pending))
+            self._write_batch(batch)
+
+    def _run(self):
+        with self._app.app_context():
+            while True:
+                with self._lock:
+                    deadline = time.monotonic() + self.policy.max_delay
+                    while (
+                        self._running
+                        and len(self._pending) < self.policy.max_batch
+                        and (remaining := deadline - time.monotonic()) > 0
+                    ):
+                        self._wakeup.wait(remaining)
+                    running = self._running
+
+                with self._flush_lock:
+                    with self._lock:
+                        batch = self._take_batch(
+                            self.policy.max_batch if running else len(self._pending)
+                        )
+                    self._write_batch(batch)
+                if not running:
+                    break
+
+    def _take_batch(self, size: int) -> List[dict]:
+        return [self._pending.popleft() for _ in range(min(size, len(self._pending)))]
+
+    def _write_batch(self, batch: List[dict]):
+        if not batch:
+            return
+
+        start = time.perf_counter()
+        retry: List[dict] = []
+        dead_letters = self.stats.dead_letters
+        try:
+            self._executor.run(self._insert, batch)
+        except Exception as e:
+            db.session.rollback()
+            self.stats.failed_flushes += 1
+            print("message writer: flush failed, retrying one by one", len(batch), e)
+            retry = self._insert_each(batch)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            if retry:
+                self._pending.extendleft(reversed(retry))
+            done = len(batch) - len(retry) - (self.stats.dead_letters - dead_letters)
+            for row in batch:
+                self._pending_by_user[row["user_id"]] -= 1
+            for row in retry:
+                self._pending_by_user[row["user_id"]] += 1
+            self.stats.written += done
+            self.stats.flushes += 1
+            self.stats.last_flush_seconds = elapsed
+            self.stats.total_flush_seconds += elapsed
+            self.stats.max_flush_seconds = max(self.stats.max_flush_seconds, elapsed)
+
+            self._rotate_journal()
+        if retry:
+            time.sleep(self.policy.max_delay)
+
+    def _rotate_journal(self):
+        """drop committed messages from the journal
+
+        called with the lock held after each batch. ids are handed out in
+        order and one batch is written at a time, so everything journaled
+        before the oldest pending message has been committed or dead
+        lettered and only the pending messages need to be kept
+        """
+        if not self._pending:
+            self._journal.truncate(0)
+            self._journal.seek(0)
+            return
+
+        rotated = self._journal_path + ".new"
+        with open(rotated, "w", encoding="utf-8") as journal:
+            for row in self._pending:
+                journal.write(json.dumps(row) + "\n")
+            journal.flush()
+            if self.policy.fsync:
+                os.fsync(journal.fileno())
+        os.replace(rotated, self._journal_path)
+        self._journal.close()
+        self._journal = open(self._journal_path, "a", encoding="utf-8")
+
+    def _insert_each(self, rows: List[dict]) -> List[dict]:
+        """insert rows one at a time after their batch failed
+
+        returns the rows to try again later, rows the database rejected
+        outright go to the dead letter file
+        """
+        retry = []
+        for row in rows:
+            try:
+                self._executor.run(self._insert, [row])
+            except OperationalError as e:
+                # locked, out of space, gone away: not the row's fault
+                db.session.rollback()
+                print("message writer: database unavailable, requeueing", e)
+                retry.append(row)
+            except Exception as e:
+                db.session.rollback()
+                self._dead_letter(row, e)
+        return retry
+
+    def _dead_letter(self, row: dict, error: Exception):
+        print(
+            "message writer: dropping message", row.get("id"), "to dead letters:", error
+        )
+        with open(self.dead_letter_path, "a", encoding="utf-8") as dead:
+            dead.write(
+                json.dumps({"row": row, "error": str(error)}, default=repr) + "\n"
+            )
+        self.stats.dead_letters += 1
+
+    def _insert(self, rows: List[dict]):
+        # ids are assigned up front so a retried or replayed batch may
+        # already be partly in the table
+        inserted = []
+        for start in range(0, len(rows), INSERT_CHUNK):
+            chunk = rows[start : start + INSERT_CHUNK]
+            existing = {
+                message_id
+                for (message_id,) in db.session.query(Message.id).filter(
+                    Message.id.in_([row["id"] for row in chunk])
+                )
+            }
+            chunk = [row for row in chunk if row["id"] not in existing]
+            if chunk:
+                db.session.execute(
+                    Message.__table__.insert(),
+                    [
+                        # journals written before rooms have no room_id
+                        dict(
+                            row,
+                            datetime=datetime.fromtimestamp(row["datetime"]),
+                            room_id=row.get("room_id", DEFAULT_ROOM_ID),
+                        )
+                        for row in chunk
+                    ],
+                )
+                inserted.extend(chunk)
+        increment_post_counts(row["user_id"] for row in inserted)
+        db.session.commit()
+        return len(inserted)
+
+    def _replay_journal(self):
+        if not os.path.exists(self._journal_path):
+            return
+
+        rows: Dict[int, dict] = dict()
+        with open(self._journal_path, encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn final line from a crash mid-write
+                    continue
+                rows[row["id"]] = row
+
+        if rows:
+            rows = list(rows.values())
+            try:
+                self.stats.replayed = self._insert(rows)
+            except OperationalError:
+                raise
+            except Exception:
+                db.session.rollback()
+                if self._insert_each(rows):
+                    # the journal is left alone for the next start
+                    raise RuntimeError("database unavailable replaying the journal")
+                # nothing is dead lettered before the journal is replayed
+                self.stats.replayed = len(rows) - self.stats.dead_letters
+
+        open(self._journal_path, "w").close()
+
+    @staticmethod
+    def _to_row(message: Message) -> dict:
+        return {
+            "id": message.id,
+            "text": message.text,
+            "datetime": message.datetime.timestamp(),
+            "user_id": message.user_id,
+            "room_id": message.room_id,
+        }
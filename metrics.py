@@ -0,0 +1,281 @@
+"""prometheus text format metrics
+
+a small self contained registry, histograms have fixed buckets and every
+observation is one bisect and a few increments under a lock. exposed at
+/metrics by chat_server.
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)  # fmt: skip
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names: Sequence[str], values: Iterable) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abstractmethod
+    def render(self) -> List[str]: ...
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Labels, float] = dict()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """a value read when metrics are scraped
+
+    collect returns {label values: value}, or a plain number without labels.
+    kind "counter" is for totals kept elsewhere that only go up
+    """
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], object],
+        labels: Sequence[str] = (),
+        kind: str = "gauge",
+    ):
+        super().__init__(name, help, labels)
+        self.collect = collect
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        lines = self.header()
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}{labels} {_format_value(value)}")
+        return lines
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket..., count over the last, sum]
+        self._series: Dict[Labels, list] = dict()
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = [(key, list(values)) for key, values in self._series.items()]
+        lines = self.header()
+        names = self.labels + ("le",)
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {values[-1]!r}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = dict()
+
+    def add(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), **kw):
+        return self.add(Histogram(name, help, labels, **kw))
+
+    def gauge(self, name: str, help: str, collect, labels: Sequence[str] = (), **kw):
+        return self.add(Gauge(name, help, collect, labels, **kw))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # one broken gauge shouldn't take every other metric with it
+                lines.append(f"# {metric.name} failed: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class AppMetrics:
+    """times flask routes, socket.io handlers and sql queries
+
+    queries are counted per request or socket event through flask's g,
+    which flask-socketio sets up for every event as well
+    """
+
+    def __init__(self, registry: Registry, prefix: str = "chat"):
+        self.registry = registry
+        self.route_latency = registry.histogram(
+            f"{prefix}_http_request_seconds",
+            "time spent handling http requests",
+            ("endpoint", "method", "status"),
+        )
+        self.event_latency = registry.histogram(
+            f"{prefix}_socket_event_seconds",
+            "time spent in socket.io event handlers",
+            ("event", "outcome"),
+        )
+        self.query_latency = registry.histogram(
+            f"{prefix}_sql_query_seconds",
+            "time spent executing sql statements",
+            ("statement",),
+        )
+        self.queries_per_handler = registry.histogram(
+            f"{prefix}_sql_queries_per_handler",
+            "sql statements executed by one request or socket event",
+            ("handler",),
+            buckets=COUNT_BUCKETS,
+        )
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        event.listen(Engine, "before_cursor_execute", self._before_query)
+        event.listen(Engine, "after_cursor_execute", self._after_query)
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+
+    def _after_request(self, response):
+        start = g.pop("metrics_start", None)
+        if start is not None:
+            endpoint = request.endpoint or "unmatched"
+            self.route_latency.observe(
+                time.perf_counter() - start,
+                endpoint,
+                request.method,
+                str(response.status_code),
+            )
+            self.queries_per_handler.observe(g.pop("metrics_queries", 0), endpoint)
+        return response
+
+    def instrument_socketio(self, socketio):
+        """time every handler registered with socketio.on from now on
+
+        has to be called before the handlers are defined
+        """
+        register = socketio.on
+
+        def on(message, namespace=None):
+            decorator = register(message, namespace)
+            return lambda handler: decorator(self._timed_event(message, handler))
+
+        socketio.on = on
+
+    def _timed_event(self, message: str, handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            g.metrics_queries = 0
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = handler(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                self.event_latency.observe(
+                    time.perf_counter() - start, message, outcome
+                )
+                self.queries_per_handler.observe(
+                    g.pop("metrics_queries", 0), "socket:" + message
+                )
+
+        return wrapper
+
+    def _before_query(self, conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, many):
+        starts = conn.info.get("metrics_query_start")
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        # the verb keeps the label set small, full statements would not be
+        self.query_latency.observe(elapsed, statement.lstrip().split(" ", 1)[0].upper())
+        if has_app_context() and "metrics_queries" in g:
+            g.metrics_queries += 1
@@ -0,0 +1,93 @@
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from typing import Callable, Optional, Tuple, TypeVar
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+T = TypeVar("T")
+
+
+class HasherBusy(Exception):
+    "the password hasher is at capacity or didn't answer in time"
+
+
+def needs_rehash(hashed: str, method: str) -> bool:
+    "True if hashed wasn't made with method, eg. a cheaper cost factor"
+    return not hashed.startswith(method + "$")
+
+
+def hash_password(password: str, method: str) -> str:
+    return generate_password_hash(password, method)
+
+
+def verify_password(
+    hashed: str, password: str, method: str
+) -> Tuple[bool, Optional[str]]:
+    """check password against hashed
+
+    returns whether it matched and, if hashed is out of date, a new hash
+    made with method while the plain password is at hand
+    """
+    if not check_password_hash(hashed, password):
+        return False, None
+    if needs_rehash(hashed, method):
+        return True, hash_password(password, method)
+    return True, None
+
+
+class PasswordHasher:
+    """hashes and checks passwords in a pool of worker processes
+
+    password hashes are slow on purpose, run on the request thread a burst
+    of logins holds the GIL and stalls every other request in the process.
+    at most max_pending calls are queued or running at once, callers past
+    that get HasherBusy straight away instead of waiting behind the queue,
+    and so does a call that takes longer than timeout.
+    """
+
+    def __init__(
+        self,
+        method: str,
+        workers: int = 2,
+        max_pending: int = 32,
+        timeout: float = 5.0,
+    ):
+        self.method = method
+        self.timeout = timeout
+        self._pool = ProcessPoolExecutor(workers) if workers else None
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self.rejected = 0
+
+    def hash(self, password: str) -> str:
+        return self._call(hash_password, password, self.method)
+
+    def verify(self, hashed: str, password: str) -> Tuple[bool, Optional[str]]:
+        "see verify_password"
+        return self._call(verify_password, hashed, password, self.method)
+
+    def _call(self, func: Callable[..., T], *args) -> T:
+        if not self._pending.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy("too many password checks in progress")
+
+        if self._pool is None:
+            try:
+                return func(*args)
+            finally:
+                self._pending.release()
+
+        future: Future = self._pool.submit(func, *args)
+        # the slot is held until the work is really done, not just until
+        # this caller stops waiting for it
+        future.add_done_callback(lambda future: self._pending.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            self.rejected += 1
+            raise HasherBusy("password check timed out")
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
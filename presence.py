@@ -0,0 +1,378 @@
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
+from typing import Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+Connection = Tuple[int, str]
+
+
+class TimerWheel:
+    """hashed timing wheel
+
+    keys are dropped into the slot for their deadline and handed back once
+    the wheel turns past it, so expiring costs nothing for keys that aren't
+    due. deadlines further out than the wheel spans land in its last slot
+    and callers reschedule whatever comes back early.
+    """
+
+    def __init__(self, tick: float, slots: int, now: Optional[float] = None):
+        self.tick = tick
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._current = int((time.time() if now is None else now) / tick)
+
+    def schedule(self, key: Hashable, deadline: float):
+        index = max(int(deadline / self.tick), self._current + 1)
+        index = min(index, self._current + len(self._slots) - 1)
+        self._slots[index % len(self._slots)].add(key)
+
+    def advance(self, now: float) -> List[Hashable]:
+        "turn the wheel to now, returns every key whose slot was passed"
+        target = int(now / self.tick)
+        expired = []
+        for _ in range(min(target - self._current, len(self._slots))):
+            self._current += 1
+            slot = self._slots[self._current % len(self._slots)]
+            expired.extend(slot)
+            slot.clear()
+        self._current = max(self._current, target)
+        return expired
+
+
+class PresenceBackend(ABC):
+    """where connections are recorded
+
+    every connection is a (user_id, sid) pair with an expiry time. a user
+    is online while they have at least one live connection. methods report
+    the users whose online state changed.
+    """
+
+    @abstractmethod
+    def connect(self, user_id: int, sid: str, expires: float) -> bool:
+        "returns True if this was the user's first connection"
+
+    @abstractmethod
+    def heartbeat(self, user_id: int, sid: str, expires: float) -> bool:
+        "extend a connection, returns False if it had already expired"
+
+    @abstractmethod
+    def disconnect(self, user_id: int, sid: str) -> bool:
+        "returns True if this was the user's last connection"
+
+    @abstractmethod
+    def drop_user(self, user_id: int) -> bool:
+        "remove all of a user's connections, returns True if they were online"
+
+    @abstractmethod
+    def expire(self, now: float) -> List[int]:
+        "remove expired connections, returns users who went offline"
+
+    @abstractmethod
+    def is_online(self, user_id: int) -> bool: ...
+
+    @abstractmethod
+    def online_users(self) -> Set[int]: ...
+
+
+class MemoryPresenceBackend(PresenceBackend):
+    "presence for a single worker process"
+
+    def __init__(self, tick: float = 1.0, ttl: float = 60.0):
+        self._deadlines: Dict[Connection, float] = dict()
+        self._connections: Dict[int, Set[str]] = defaultdict(set)
+        self._wheel = TimerWheel(tick, int(ttl / tick) + 2)
+        self._lock = threading.Lock()
+
+    def connect(self, user_id: int, sid: str, expires: float) -> bool:
+        with self._lock:
+            self._deadlines[user_id, sid] = expires
+            self._wheel.schedule((user_id, sid), expires)
+            sids = self._connections[user_id]
+            sids.add(sid)
+            return len(sids) == 1
+
+    def heartbeat(self, user_id: int, sid: str, expires: float) -> bool:
+        # only the deadline moves, the wheel entry is rescheduled lazily
+        with self._lock:
+            if (user_id, sid) not in self._deadlines:
+                return False
+            self._deadlines[user_id, sid] = expires
+            return True
+
+    def disconnect(self, user_id: int, sid: str) -> bool:
+        with self._lock:
+            if self._deadlines.pop((user_id, sid), None) is None:
+                return False
+            return self._remove(user_id, sid)
+
+    def drop_user(self, user_id: int) -> bool:
+        with self._lock:
+            sids = self._connections.pop(user_id, set())
+            for sid in sids:
+                del self._deadlines[user_id, sid]
+            return bool(sids)
+
+    def expire(self, now: float) -> List[int]:
+        offline = []
+        with self._lock:
+            for connection in self._wheel.advance(now):
+                deadline = self._deadlines.get(connection)
+                if deadline is None:
+                    continue
+                if deadline > now:
+                    self._wheel.schedule(connection, deadline)
+                    continue
+                del self._deadlines[connection]
+                if self._remove(*connection):
+                    offline.append(connection[0])
+        return offline
+
+    def _remove(self, user_id: int, sid: str) -> bool:
+        sids = self._connections.get(user_id)
+        if not sids:
+            return False
+        sids.discard(sid)
+        if not sids:
+            del self._connections[user_id]
+            return True
+        return False
+
+    def is_online(self, user_id: int) -> bool:
+        return bool(self._connections.get(user_id))
+
+    def online_users(self) -> Set[int]:
+        with self._lock:
+            return set(self._connections)
+
+
+class SQLitePresenceBackend(PresenceBackend):
+    """presence shared by every worker on one machine through a sqlite file
+
+    expiry is a range scan of the expires index, not a table scan
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(
+            path, timeout=10, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS presence ("
+                " user_id INTEGER NOT NULL,"
+                " sid TEXT NOT NULL,"
+                " expires REAL NOT NULL,"
+                " PRIMARY KEY (user_id, sid))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS ix_presence_expires ON presence (expires)"
+            )
+
+    def _count(self, user_id: int) -> int:
+        (count,) = self._db.execute(
+            "SELECT count(*) FROM presence WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        return count
+
+    def connect(self, user_id: int, sid: str, expires: float) -> bool:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute(
+                "INSERT OR REPLACE INTO presence VALUES (?, ?, ?)",
+                (user_id, sid, expires),
+            )
+            first = self._count(user_id) == 1
+            self._db.execute("COMMIT")
+            return first
+
+    def heartbeat(self, user_id: int, sid: str, expires: float) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE presence SET expires = ? WHERE user_id = ? AND sid = ?",
+                (expires, user_id, sid),
+            )
+            return cursor.rowcount == 1
+
+    def disconnect(self, user_id: int, sid: str) -> bool:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            cursor = self._db.execute(
+                "DELETE FROM presence WHERE user_id = ? AND sid = ?", (user_id, sid)
+            )
+            last = cursor.rowcount == 1 and self._count(user_id) == 0
+            self._db.execute("COMMIT")
+            return last
+
+    def drop_user(self, user_id: int) -> bool:
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM presence WHERE user_id = ?", (user_id,)
+            )
+            return cursor.rowcount > 0
+
+    def expire(self, now: float) -> List[int]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            users = {
+                user_id
+                for (user_id,) in self._db.execute(
+                    "SELECT DISTINCT user_id FROM presence WHERE expires <= ?", (now,)
+                )
+            }
+            self._db.execute("DELETE FROM presence WHERE expires <= ?", (now,))
+            offline = [user_id for user_id in users if self._count(user_id) == 0]
+            self._db.execute("COMMIT")
+            return offline
+
+    def is_online(self, user_id: int) -> bool:
+        with self._lock:
+            return self._count(user_id) > 0
+
+    def online_users(self) -> Set[int]:
+        with self._lock:
+            return {
+                user_id
+                for (user_id,) in self._db.execute(
+                    "SELECT DISTINCT user_id FROM presence"
+                )
+            }
+
+
+class PresenceTracker:
+    """online status from heartbeating connections
+
+    on_online and on_offline are called with a user id whenever a user's
+    first connection arrives or their last one leaves or times out
+    """
+
+    def __init__(
+        self,
+        backend: PresenceBackend,
+        ttl: float,
+        on_online: Callable[[int], None] = lambda user_id: None,
+        on_offline: Callable[[int], None] = lambda user_id: None,
+    ):
+        self.backend = backend
+        self.ttl = ttl
+        self.on_online = on_online
+        self.on_offline = on_offline
+
+    def connect(self, user_id: int, sid: str):
+        if self.backend.connect(user_id, sid, time.time() + self.ttl):
+            self.on_online(user_id)
+
+    def heartbeat(self, user_id: int, sid: str):
+        # a connection that expired but is still sending heartbeats is back
+        if not self.backend.heartbeat(user_id, sid, time.time() + self.ttl):
+            self.connect(user_id, sid)
+
+    def disconnect(self, user_id: int, sid: str):
+        if self.backend.disconnect(user_id, sid):
+            self.on_offline(user_id)
+
+    def drop_user(self, user_id: int):
+        if self.backend.drop_user(user_id):
+            self.on_offline(user_id)
+
+    def sweep(self):
+        for user_id in self.backend.expire(time.time()):
+            self.on_offline(user_id)
+
+    def is_online(self, user_id: int) -> bool:
+        return self.backend.is_online(user_id)
+
+    def online_users(self) -> Set[int]:
+        return self.backend.online_users()
+
+
+def backend_from_config(config) -> PresenceBackend:
+    "PRESENCE_BACKEND is 'memory' or 'sqlite:///<path>'"
+    backend = config["PRESENCE_BACKEND"]
+    if backend == "memory":
+        if config.get("WORKER_COUNT", 1) > 1:
+            # each worker would only see its own users online
+            raise ValueError(
+                "the memory presence backend can't be shared between workers,"
+                " set PRESENCE_BACKEND to 'sqlite:///<path>'"
+            )
+        return MemoryPresenceBackend(config["PRESENCE_TICK"], config["PRESENCE_TTL"])
+    if backend.startswith("sqlite:///"):
+        return SQLitePresenceBackend(backend[len("sqlite:///") :])
+    raise ValueError(f"unsupported presence backend {backend!r}")
+
+
+class PresenceLog:
+    """versioned record of who is online, for delta based client sync
+
+    clients take a snapshot once, then apply the numbered deltas broadcast
+    after it. a client that missed deltas asks for everything since its
+    version and only gets a fresh snapshot when that is older than the
+    deltas kept here. versions are per worker, the epoch tells a client
+    that reconnected to a different worker to start over.
+    """
+
+    JOIN = "join"
+    LEAVE = "leave"
+    AVATAR = "avatar"
+
+    def __init__(self, history: int = 1024):
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        self._deltas: Deque[dict] = deque(maxlen=history)
+        # user id -> [id, username, avatar_filename]
+        self._online: Dict[int, list] = dict()
+        self._lock = threading.Lock()
+
+    def _record(self, op: str, payload) -> dict:
+        self.version += 1
+        delta = {"v": self.version, "op": op, "user": payload}
+        self._deltas.append(delta)
+        return delta
+
+    def join(self, user_id: int, username: str, avatar: str) -> Optional[dict]:
+        with self._lock:
+            if user_id in self._online:
+                return None
+            entry = self._online[user_id] = [user_id, username, avatar]
+            return self._record(self.JOIN, entry)
+
+    def leave(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            if self._online.pop(user_id, None) is None:
+                return None
+            return self._record(self.LEAVE, user_id)
+
+    def avatar(self, user_id: int, avatar: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._online.get(user_id)
+            if entry is None:
+                return None
+            entry[2] = avatar
+            return self._record(self.AVATAR, [user_id, avatar])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "epoch": self.epoch,
+                "version": self.version,
+                "users": list(self._online.values()),
+            }
+
+    def since(self, epoch: str, version: int) -> Optional[dict]:
+        "deltas after version, None when a snapshot is needed instead"
+        with self._lock:
+            if epoch != self.epoch or version > self.version:
+                return None
+            if version < self.version and (
+                not self._deltas or self._deltas[0]["v"] > version + 1
+            ):
+                return None
+            deltas = [delta for delta in self._deltas if delta["v"] > version]
+            return {"epoch": self.epoch, "version": self.version, "deltas": deltas}
+
+    def __len__(self):
+        "users online"
+        return len(self._online)
@@ -0,0 +1,351 @@
+"""on demand sampling profiler and traces of slow handlers
+
+SamplingProfiler looks at the stack of every thread in the process a
+hundred times a second while it runs and counts how often each stack was
+seen. the result is in the collapsed stack format read by flamegraph.pl,
+speedscope and inferno, one "outer;...;inner count" line per stack.
+
+SlowHandlerLog keeps a trace of every request and socket event that took
+longer than a threshold: the sql it ran and where it was stuck, sampled by
+a watchdog while it was still running.
+
+both sample from a real os thread, under eventlet or gevent that is the
+unpatched threading module so the samples are taken even while a green
+thread hogs the cpu. only the green thread that is running shows up in
+sys._current_frames, waiting ones are looked up through their greenlet.
+"""
+
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict, deque
+from functools import wraps
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# where a thread with nothing to do sits, left out of profiles by default
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+    ("queue.py", "get"),
+    ("hub.py", "wait"),
+    ("hub.py", "switch"),
+}
+
+
+def os_threading(async_mode: str = "threading"):
+    "the threading module as it was before eventlet or gevent patched it"
+    if async_mode == "eventlet":
+        from eventlet.patcher import original
+
+        return original("threading")
+    if async_mode == "gevent":
+        from gevent.monkey import get_original
+
+        names = ("Thread", "Event", "Lock", "get_ident")
+        return SimpleNamespace(**dict(zip(names, get_original("threading", names))))
+    return threading
+
+
+def _current_task(async_mode: str):
+    "the greenlet running this code in green modes, else None"
+    if async_mode == "threading":
+        return None
+    from greenlet import getcurrent
+
+    return getcurrent()
+
+
+def _short_path(filename: str) -> str:
+    for marker in ("site-packages" + os.sep, "lib" + os.sep + "python"):
+        index = filename.rfind(marker)
+        if index >= 0:
+            return filename[index + len(marker) :]
+    return os.path.relpath(filename) if os.path.isabs(filename) else filename
+
+
+def frame_name(code) -> str:
+    # semicolons separate frames in the collapsed format
+    name = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+    return name.replace(";", ":")
+
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+
+class SamplingProfiler:
+    """counts the stacks of every thread every interval seconds
+
+    sampling stops by itself after max_duration seconds so a profile that
+    is forgotten about doesn't keep costing cpu. a new start discards the
+    previous profile.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.01,
+        max_duration: float = 300,
+        async_mode: str = "threading",
+    ):
+        self.interval = interval
+        self.max_duration = max_duration
+        self._threading = os_threading(async_mode)
+        # shared with the sampling thread, so a real lock and not a green one
+        self._lock = self._threading.Lock()
+        self._stop = None
+        self._thread = None
+        self._counts: Dict[Tuple, int] = defaultdict(int)
+        self.samples = 0
+        self.started: Optional[float] = None
+        self.stopped: Optional[float] = None
+        self.include_idle = False
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(
+        self,
+        interval: Optional[float] = None,
+        duration: Optional[float] = None,
+        include_idle: bool = False,
+    ) -> bool:
+        "False if a profile is already being taken"
+        with self._lock:
+            if self.running:
+                return False
+            if interval:
+                self.interval = max(0.001, interval)
+            duration = min(duration or self.max_duration, self.max_duration)
+            self.include_idle = include_idle
+            self._counts = defaultdict(int)
+            self.samples = 0
+            self.started = time.time()
+            self.stopped = None
+            self._stop = self._threading.Event()
+            self._thread = self._threading.Thread(
+                target=self._run,
+                args=(self._stop, duration),
+                name="sampling-profiler",
+                daemon=True,
+            )
+            self._thread.start()
+            return True
+
+    def stop(self):
+        with self._lock:
+            if self._stop is not None:
+                self._stop.set()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self, stop, duration: float):
+        own = self._threading.get_ident()
+        deadline = time.monotonic() + duration
+        while not stop.wait(self.interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            frames.pop(own, None)
+            for frame in frames.values():
+                if not self.include_idle and _is_idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                self._counts[tuple(stack)] += 1
+            self.samples += 1
+        self.stopped = time.time()
+
+    def collapsed(self) -> str:
+        "the profile in collapsed stack format, outermost frame first"
+        counts = list(self._counts.items())
+        names = dict()
+        lines = []
+        for stack, count in counts:
+            frames = []
+            for code in reversed(stack):
+                if code not in names:
+                    names[code] = frame_name(code)
+                frames.append(names[code])
+            lines.append(f"{';'.join(frames)} {count}")
+        lines.sort()
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def status(self) -> dict:
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "include_idle": self.include_idle,
+            "started": self.started,
+            "stopped": self.stopped,
+            "samples": self.samples,
+            "stacks": len(self._counts),
+        }
+
+
+class Trace:
+    __slots__ = ("name", "started", "start", "ident", "task", "queries", "stacks")
+
+    def __init__(self, name: str, ident: int, task):
+        self.name = name
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.ident = ident
+        self.task = task
+        self.queries: List[list] = []
+        self.stacks: List[List[str]] = []
+
+
+class SlowHandlerLog:
+    """keeps traces of requests and socket events slower than threshold
+
+    every handler records the sql it runs, at most max_queries statements,
+    without the values bound to them.
+    a watchdog checks on running handlers every threshold / 2 seconds and
+    takes up to max_stacks samples of the stack of any that have run past
+    threshold, so a trace shows where a handler was waiting and not just
+    that it was slow. the last keep traces are kept.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.5,
+        keep: int = 50,
+        max_queries: int = 100,
+        max_stacks: int = 5,
+        async_mode: str = "threading",
+    ):
+        self.threshold = threshold
+        self.max_queries = max_queries
+        self.max_stacks = max_stacks
+        self.async_mode = async_mode
+        self.traces = deque(maxlen=keep)
+        self._threading = os_threading(async_mode)
+        self._active: Dict[int, Trace] = dict()
+        # shared with the watchdog thread
+        self._lock = self._threading.Lock()
+        self._watchdog = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.threshold and self.threshold > 0)
+
+    def init_app(self, app):
+        if not self.enabled:
+            return
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+        event.listen(Engine, "before_cursor_execute", self._before_query)
+        event.listen(Engine, "after_cursor_execute", self._after_query)
+
+    def instrument_socketio(self, socketio):
+        "trace every handler registered with socketio.on from now on"
+        if not self.enabled:
+            return
+        register = socketio.on
+
+        def on(message, namespace=None):
+            decorator = register(message, namespace)
+            return lambda handler: decorator(self._traced_event(message, handler))
+
+        socketio.on = on
+
+    def _traced_event(self, message: str, handler):
+        @wraps(handler)
+        def wrapper(*args, **kwargs):
+            trace = self.begin("socket:" + message)
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                self.end(trace)
+
+        return wrapper
+
+    def _before_request(self):
+        g.slow_trace = self.begin(f"{request.method} {request.path}")
+
+    def _teardown_request(self, exc):
+        trace = g.pop("slow_trace", None)
+        if trace is not None:
+            self.end(trace)
+
+    def begin(self, name: str) -> Trace:
+        self._ensure_watchdog()
+        trace = Trace(name, self._threading.get_ident(), _current_task(self.async_mode))
+        g.slow_trace_queries = trace.queries
+        with self._lock:
+            self._active[id(trace)] = trace
+        return trace
+
+    def end(self, trace: Trace):
+        with self._lock:
+            self._active.pop(id(trace), None)
+        g.pop("slow_trace_queries", None)
+        duration = time.perf_counter() - trace.start
+        if duration < self.threshold:
+            return
+        self.traces.append(
+            {
+                "name": trace.name,
+                "started": trace.started,
+                "duration": duration,
+                "queries": trace.queries,
+                "stacks": trace.stacks,
+            }
+        )
+
+    def _before_query(self, conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault("slow_trace_query_start", []).append(time.perf_counter())
+
+    def _after_query(self, conn, cursor, statement, parameters, context, many):
+        starts = conn.info.get("slow_trace_query_start")
+        if not starts:
+            return
+        start = starts.pop()
+        if not has_app_context():
+            return
+        queries = g.get("slow_trace_queries")
+        if queries is not None and len(queries) < self.max_queries:
+            # only the statement, bound values can be passwords or messages
+            queries.append([statement, time.perf_counter() - start])
+
+    def _ensure_watchdog(self):
+        if self._watchdog is not None:
+            return
+        with self._lock:
+            if self._watchdog is None:
+                self._watchdog = self._threading.Thread(
+                    target=self._watch, name="slow-handler-watchdog", daemon=True
+                )
+                self._watchdog.start()
+
+    def _watch(self):
+        stop = self._threading.Event()
+        while not stop.wait(self.threshold / 2):
+            now = time.perf_counter()
+            with self._lock:
+                overdue = [
+                    trace
+                    for trace in self._active.values()
+                    if now - trace.start >= self.threshold
+                    and len(trace.stacks) < self.max_stacks
+                ]
+            if not overdue:
+                continue
+            frames = sys._current_frames()
+            for trace in overdue:
+                # a green thread that isn't running keeps its frame itself
+                frame = getattr(trace.task, "gr_frame", None) or frames.get(trace.ident)
+                if frame is not None:
+                    trace.stacks.append(traceback.format_stack(frame))
@@ -0,0 +1,282 @@
+"""chat rooms
+
+a socket only joins the rooms it asks for, so a broadcast to a room costs
+one write per member instead of one per connected socket. everything a
+room needs on a worker, its recent message cache, its member list and its
+socket.io rooms, is made the first time one of the worker's sockets joins
+it. every socket joins DEFAULT_ROOM when it connects, which is also where
+messages from before rooms existed live. rooms are only made when a user
+asks for a new one, and each user can only make so many.
+"""
+
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy.exc import IntegrityError
+
+from .presence import PresenceLog
+from .sql_models import db, Room
+
+DEFAULT_ROOM = "chat"
+# the row made by ensure_rooms, messages.room_id defaults to it
+DEFAULT_ROOM_ID = 1
+
+NAME_PATTERN = re.compile(r"[a-z0-9][a-z0-9_-]{0,31}")
+
+
+def valid_name(name) -> bool:
+    return isinstance(name, str) and NAME_PATTERN.fullmatch(name) is not None
+
+
+def socket_room(name: str) -> str:
+    """the socket.io room for a chat room
+
+    prefixed so a chat room can never be named after a socket id, every
+    socket is alone in a socket.io room of that name
+    """
+    return f"room:{name}"
+
+
+def ensure_rooms():
+    "add the rooms table and its columns to databases made before them"
+    Room.__table__.create(db.engine, checkfirst=True)
+    with db.engine.begin() as connection:
+        exists = connection.execute(
+            db.select(Room.id).where(Room.id == DEFAULT_ROOM_ID)
+        ).first()
+        if not exists:
+            connection.execute(
+                Room.__table__.insert().values(id=DEFAULT_ROOM_ID, name=DEFAULT_ROOM)
+            )
+    columns = {
+        column["name"] for column in db.inspect(db.engine).get_columns("messages")
+    }
+    if "room_id" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.text(
+                    "ALTER TABLE messages ADD COLUMN room_id INTEGER NOT NULL "
+                    f"DEFAULT {DEFAULT_ROOM_ID}"
+                )
+            )
+    columns = {column["name"] for column in db.inspect(db.engine).get_columns("rooms")}
+    if "created_by" not in columns:
+        # rooms made before it was recorded don't count against anyone
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.text("ALTER TABLE rooms ADD COLUMN created_by INTEGER")
+            )
+    for index in Room.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+class RoomDirectory:
+    """room name to id
+
+    names and ids never change so lookups are cached for good
+    """
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {DEFAULT_ROOM: DEFAULT_ROOM_ID}
+        self._lock = threading.Lock()
+
+    def cached(self, name: str) -> Optional[int]:
+        return self._ids.get(name)
+
+    def lookup(self, name: str) -> Optional[int]:
+        "the room's id, None if it doesn't exist"
+        room_id = self._ids.get(name)
+        if room_id is not None:
+            return room_id
+        room_id = db.session.query(Room.id).filter(Room.name == name).scalar()
+        if room_id is not None:
+            self._remember(name, room_id)
+        return room_id
+
+    def create(self, name: str, user_id: int, limit: int) -> int:
+        """make a room for user_id, returns its id
+
+        raises ValueError when the name is taken or the user has already
+        made limit rooms. two workers can each let a user past the limit
+        once at the same moment, that's as far over as it goes
+        """
+        made = db.session.query(db.func.count(Room.id)).filter(
+            Room.created_by == user_id
+        )
+        if made.scalar() >= limit:
+            raise ValueError(f"you can make at most {limit} rooms")
+        room = Room(name=name, created_by=user_id)
+        db.session.add(room)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise ValueError(f"there is already a room called {name}")
+        self._remember(name, room.id)
+        return room.id
+
+    def _remember(self, name: str, room_id: int):
+        with self._lock:
+            self._ids[name] = room_id
+
+
+class RoomMembership:
+    """the rooms each socket on this worker is in
+
+    a user with several sockets in a room counts once, join and leave say
+    when a user enters or leaves a room as far as this worker can tell
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, Set[str]] = defaultdict(set)
+        # sockets by (room, user id) and by room
+        self._sockets: Counter = Counter()
+        self._room_sockets: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def rooms(self, sid: str) -> Set[str]:
+        with self._lock:
+            return set(self._rooms.get(sid, ()))
+
+    def is_in(self, sid: str, room) -> bool:
+        "room comes straight from clients, anything but a joined name is False"
+        rooms = self._rooms.get(sid)
+        return rooms is not None and isinstance(room, str) and room in rooms
+
+    def sockets_in(self, room: str) -> int:
+        return self._room_sockets[room]
+
+    def join(self, sid: str, user_id: int, room: str) -> bool:
+        "True when this is the user's first socket in room"
+        with self._lock:
+            if room in self._rooms[sid]:
+                return False
+            self._rooms[sid].add(room)
+            self._room_sockets[room] += 1
+            self._sockets[room, user_id] += 1
+            return self._sockets[room, user_id] == 1
+
+    def leave(self, sid: str, user_id: int, room: str) -> bool:
+        "True when that was the user's last socket in room"
+        with self._lock:
+            rooms = self._rooms.get(sid)
+            if not rooms or room not in rooms:
+                return False
+            rooms.discard(room)
+            if not rooms:
+                del self._rooms[sid]
+            return self._release(room, user_id)
+
+    def drop(self, sid: str, user_id: int) -> List[str]:
+        "forget a closed socket, returns the rooms the user is no longer in"
+        with self._lock:
+            rooms = self._rooms.pop(sid, ())
+            return [room for room in rooms if self._release(room, user_id)]
+
+    def _release(self, room: str, user_id: int) -> bool:
+        self._room_sockets[room] -= 1
+        if not self._room_sockets[room]:
+            del self._room_sockets[room]
+        key = (room, user_id)
+        self._sockets[key] -= 1
+        if self._sockets[key] > 0:
+            return False
+        del self._sockets[key]
+        return True
+
+    def __len__(self):
+        "sockets in at least one room"
+        return len(self._rooms)
+
+
+class RoomPresence:
+    """who is in each room, with a PresenceLog per room for syncing clients
+
+    every worker reports when a user enters or leaves a room on it, a user
+    stays in the room until every worker they entered it on says they left.
+    a room's log is dropped once it is empty, its members start over with a
+    new snapshot if it fills up again.
+    """
+
+    def __init__(self, history: int = 256):
+        self.history = history
+        self._logs: Dict[str, PresenceLog] = dict()
+        self._workers: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def enter(
+        self, room: str, user_id: int, username: str, avatar: str
+    ) -> Optional[dict]:
+        "a worker saw the user enter room, the delta when it's news"
+        with self._lock:
+            self._workers[room, user_id] += 1
+            if self._workers[room, user_id] > 1:
+                return None
+            log = self._logs.get(room)
+            if log is None:
+                log = self._logs[room] = PresenceLog(self.history)
+            return log.join(user_id, username, avatar)
+
+    def exit(self, room: str, user_id: int) -> Optional[dict]:
+        "a worker saw the user leave room, the delta when it's news"
+        with self._lock:
+            key = (room, user_id)
+            if key not in self._workers:
+                return None
+            self._workers[key] -= 1
+            if self._workers[key] > 0:
+                return None
+            del self._workers[key]
+            return self._leave(room, user_id)
+
+    def drop_user(self, user_id: int) -> List[Tuple[str, dict]]:
+        """take a user that went offline out of every room, (room, delta) pairs
+
+        also clears rooms whose leave never arrived, from a worker that died
+        """
+        with self._lock:
+            keys = [key for key in self._workers if key[1] == user_id]
+            deltas = []
+            for room, _ in keys:
+                del self._workers[room, user_id]
+                delta = self._leave(room, user_id)
+                if delta:
+                    deltas.append((room, delta))
+            return deltas
+
+    def avatar(self, user_id: int, avatar: str) -> List[Tuple[str, dict]]:
+        "change a user's avatar in every room they're in, (room, delta) pairs"
+        with self._lock:
+            deltas = [
+                (room, log.avatar(user_id, avatar)) for room, log in self._logs.items()
+            ]
+            return [(room, delta) for room, delta in deltas if delta]
+
+    def _leave(self, room: str, user_id: int) -> Optional[dict]:
+        log = self._logs.get(room)
+        if log is None:
+            return None
+        delta = log.leave(user_id)
+        if not log:
+            del self._logs[room]
+        return delta
+
+    def snapshot(self, room: str) -> dict:
+        with self._lock:
+            log = self._logs.get(room)
+        if log is None:
+            return {"epoch": None, "version": 0, "users": []}
+        return log.snapshot()
+
+    def since(self, room: str, epoch: str, version: int) -> Optional[dict]:
+        "deltas after version, None when a snapshot is needed instead"
+        with self._lock:
+            log = self._logs.get(room)
+        return None if log is None else log.since(epoch, version)
+
+    def sizes(self) -> Dict[str, int]:
+        "members of every room with any"
+        with self._lock:
+            return Counter(room for room, _ in self._workers)
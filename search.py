@@ -0,0 +1,409 @@
+"""full text search over chat messages
+
+on sqlite messages.text is indexed by an external content fts5 table. it
+stores only the index, the text stays in messages, and triggers keep it in
+step with every insert, update and delete in the same transaction, so the
+message writer's bulk inserts need no changes. results are ranked with
+bm25 and come with a snippet of the message with the matches marked.
+
+other databases, or sqlite builds without fts5, fall back to a LIKE scan
+that finds the same messages but orders them newest first.
+
+archived messages are searched in the fts5 table each archive segment
+keeps, or with the LIKE fallback by scanning the segments' blocks, and
+merged with the matches from the messages table.
+"""
+
+import html
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from typing import List, Optional
+
+from . import message_views
+from .archive import SEARCH_TABLE as ARCHIVE_TABLE, MessageArchive
+from .sql_models import db, Message
+
+FTS_TABLE = "messages_fts"
+
+RANK = "rank"
+RECENT = "recent"
+ORDERS = (RANK, RECENT)
+
+# snippet() wraps matches in these, they become <mark> after escaping
+_OPEN, _CLOSE = "\x02", "\x03"
+SNIPPET_TOKENS = 24
+
+_FTS_DDL = (
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        text, content='messages', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, text)
+        VALUES ('delete', old.id, old.text);
+        INSERT INTO {FTS_TABLE}(rowid, text) VALUES (new.id, new.text);
+    END""",
+)
+
+_fts_table = db.table(FTS_TABLE, db.column("rowid"), db.column("rank"))
+# the hidden column named after the table is what MATCH is applied to
+_fts_column = db.literal_column(FTS_TABLE)
+
+
+@dataclass
+class SearchPage:
+    "one page of search results, best match or newest first"
+
+    results: List[dict]
+    next_offset: Optional[int]
+
+    def to_json(self):
+        return {"results": self.results, "next_offset": self.next_offset}
+
+
+def uses_fts() -> bool:
+    if db.engine.dialect.name != "sqlite":
+        return False
+    with db.engine.connect() as connection:
+        options = connection.exec_driver_sql("PRAGMA compile_options").scalars()
+        return "ENABLE_FTS5" in set(options)
+
+
+def ensure_index() -> bool:
+    """create the fts table and triggers if missing and index old messages
+
+    returns whether full text search is available. the first run on a big
+    database reads every message once.
+    """
+    if not uses_fts():
+        return False
+    with db.engine.begin() as connection:
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (FTS_TABLE,),
+        ).first()
+        if not exists:
+            for statement in _FTS_DDL:
+                connection.exec_driver_sql(statement)
+            rebuild_index(connection)
+    return True
+
+
+def rebuild_index(connection=None):
+    "reindex every message, for an index that has gone out of step"
+    statement = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+    if connection is not None:
+        connection.exec_driver_sql(statement)
+        return
+    with db.engine.begin() as connection:
+        connection.exec_driver_sql(statement)
+
+
+def match_expression(text: str) -> str:
+    """fts5 query matching messages that contain every word of text
+
+    words are quoted so fts5 operators and punctuation in user input are
+    taken literally, a trailing * on a word still makes it a prefix match
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*") and len(word) > 1
+        word = word.rstrip("*") if prefix else word
+        terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def highlight(snippet: str) -> str:
+    "escape a snippet for html and turn its match markers into <mark>"
+    escaped = html.escape(snippet, quote=False)
+    return escaped.replace(_OPEN, "<mark>").replace(_CLOSE, "</mark>")
+
+
+def _like_highlight(text: str, words: List[str]) -> str:
+    lowered = text.lower()
+    marks = [False] * len(text)
+    for word in words:
+        start = lowered.find(word)
+        while start >= 0:
+            marks[start : start + len(word)] = [True] * len(word)
+            start = lowered.find(word, start + 1)
+    pieces = []
+    for i, char in enumerate(text):
+        if marks[i] and (i == 0 or not marks[i - 1]):
+            pieces.append(_OPEN)
+        pieces.append(char)
+        if marks[i] and (i == len(text) - 1 or not marks[i + 1]):
+            pieces.append(_CLOSE)
+    return highlight("".join(pieces))
+
+
+def _id_bounds(since: Optional[datetime], until: Optional[datetime], cap: int):
+    """lowest and highest message id in the time range, (None, None) if it
+    is empty, or None when it holds more than cap messages
+
+    fts5 can skip to a rowid range but not to a time range, so without
+    these bounds a common word in a short range walks every match outside
+    it. ids aren't assigned in time order across workers, the bounds come
+    from the range itself. reading them costs a scan of the range on the
+    (datetime, id) index, hence the cap
+    """
+    in_range = db.select(Message.id)
+    if since is not None:
+        in_range = in_range.where(Message.datetime >= since)
+    if until is not None:
+        in_range = in_range.where(Message.datetime < until)
+    in_range = in_range.limit(cap + 1).subquery()
+    low, high, count = db.session.execute(
+        db.select(
+            db.func.min(in_range.c.id),
+            db.func.max(in_range.c.id),
+            db.func.count(),
+        )
+    ).one()
+    return None if count > cap else (low, high)
+
+
+def search(
+    text: str,
+    user_id: Optional[int] = None,
+    room_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    order: str = RANK,
+    limit: int = 20,
+    offset: int = 0,
+    fts: bool = True,
+    rank_window: Optional[int] = 10_000,
+    bounds_cap: int = 100_000,
+    archive: Optional[MessageArchive] = None,
+) -> SearchPage:
+    """messages containing every word of text
+
+    filtered to one author, one room and to since <= datetime < until when
+    given.
+    order RANK puts the best matches first, RECENT the newest. one extra
+    row is fetched to tell whether another page exists.
+
+    ranking has to score every match before it can return any, so unless
+    it is narrowed to one user RANK only considers the newest rank_window
+    matches. a word in half of a few million messages would otherwise take
+    seconds. None ranks them all. time ranges of up to bounds_cap messages are also
+    turned into id bounds, see _id_bounds
+
+    with an archive, archived messages that match are merged in. each
+    source is asked for everything up to the end of the page, so deep
+    pages cost more
+    """
+    if order not in ORDERS:
+        raise ValueError(f"order must be one of {ORDERS}")
+    words = text.split()
+    if not words:
+        return SearchPage(results=[], next_offset=None)
+
+    filters = []
+    if user_id is not None:
+        filters.append(Message.user_id == user_id)
+    if room_id is not None:
+        filters.append(Message.room_id == room_id)
+    if since is not None:
+        filters.append(Message.datetime >= since)
+    if until is not None:
+        filters.append(Message.datetime < until)
+
+    if fts:
+        conditions = [_fts_column.op("MATCH")(match_expression(text))]
+        if since is not None or until is not None:
+            bounds = _id_bounds(since, until, bounds_cap)
+            if bounds == (None, None):
+                return SearchPage(results=[], next_offset=None)
+            if bounds is not None:
+                conditions.append(_fts_table.c.rowid.between(*bounds))
+        conditions += filters
+        query = (
+            message_views.message_query()
+            .add_columns(
+                db.func.snippet(
+                    _fts_column, 0, _OPEN, _CLOSE, "…", SNIPPET_TOKENS
+                ).label("snippet"),
+                _fts_table.c.rank,
+            )
+            .select_from(_fts_table)
+            .join(Message, Message.id == _fts_table.c.rowid)
+            .filter(*conditions)
+        )
+        # rowid order is insertion order, which fts5 walks without sorting
+        if order == RANK:
+            if rank_window and user_id is None:
+                # fts5 takes a rowid bound into account while matching
+                newest = db.select(_fts_table.c.rowid)
+                if filters:
+                    newest = newest.join(Message, Message.id == _fts_table.c.rowid)
+                newest = (
+                    newest.where(*conditions)
+                    .order_by(_fts_table.c.rowid.desc())
+                    .limit(rank_window)
+                    .subquery()
+                )
+                oldest = db.select(db.func.min(newest.c.rowid)).scalar_subquery()
+                query = query.filter(_fts_table.c.rowid >= oldest)
+            query = query.order_by(_fts_table.c.rank, _fts_table.c.rowid.desc())
+        else:
+            query = query.order_by(_fts_table.c.rowid.desc())
+    else:
+        query = message_views.message_query().order_by(
+            Message.datetime.desc(), Message.id.desc()
+        )
+        for word in words:
+            word = word.rstrip("*") or word
+            escaped = word.replace("\\", "\\\\").replace("%", r"\%").replace("_", r"\_")
+            query = query.filter(Message.text.ilike(f"%{escaped}%", escape="\\"))
+        query = query.filter(*filters)
+
+    archived = None
+    if archive is not None:
+        search_archive = _search_archive if fts else _scan_archive
+        archived = search_archive(
+            archive, text, user_id, room_id, since, until, order, offset + limit + 1
+        )
+    if archived:
+        rows = query.limit(offset + limit + 1).all()
+    else:
+        rows = query.offset(offset).limit(limit + 1).all()
+    results = []
+    for row in rows:
+        result = message_views.to_json(row)
+        if fts:
+            result["highlight"] = highlight(row.snippet)
+            result["score"] = -row.rank
+        else:
+            lowered = [word.rstrip("*").lower() for word in words]
+            result["highlight"] = _like_highlight(row.text or "", lowered)
+            result["score"] = None
+        results.append(result)
+    if archived:
+        # the LIKE scan is always newest first
+        results = _merge(results, archived, order if fts else RECENT)[offset:]
+    next_offset = offset + limit if len(results) > limit else None
+    return SearchPage(results=results[:limit], next_offset=next_offset)
+
+
+def _merge(results: List[dict], archived: List[dict], order: str) -> List[dict]:
+    """results from the table and the archive in one order
+
+    a message whose move to the archive was interrupted is in both
+    """
+    if order == RANK:
+        key = lambda result: (-result["score"], -result["id"])
+    else:
+        key = lambda result: (-result["datetime"], -result["id"])
+    seen = set()
+    merged = []
+    for result in sorted(results + archived, key=key):
+        if result["id"] not in seen:
+            seen.add(result["id"])
+            merged.append(result)
+    return merged
+
+
+def _search_archive(
+    archive: MessageArchive,
+    text: str,
+    user_id: Optional[int],
+    room_id: Optional[int],
+    since: Optional[datetime],
+    until: Optional[datetime],
+    order: str,
+    limit: int,
+) -> List[dict]:
+    "the first limit matches from each archive segment in the time range"
+    since = since.timestamp() if since is not None else None
+    until = until.timestamp() if until is not None else None
+    watermark = archive.watermark
+    if watermark is None or (since is not None and since > watermark):
+        return []
+
+    query = (
+        f"SELECT rowid, text, datetime, user_id, room_id, "
+        f"snippet({ARCHIVE_TABLE}, 0, ?, ?, '…', ?), rank FROM {ARCHIVE_TABLE} "
+        f"WHERE {ARCHIVE_TABLE} MATCH ?"
+    )
+    params: list = [_OPEN, _CLOSE, SNIPPET_TOKENS, match_expression(text)]
+    for column, operator, value in (
+        ("user_id", "=", user_id),
+        ("room_id", "=", room_id),
+        ("datetime", ">=", since),
+        ("datetime", "<", until),
+    ):
+        if value is not None:
+            query += f" AND {column} {operator} ?"
+            params.append(value)
+    if order == RANK:
+        query += " ORDER BY rank, rowid DESC"
+    else:
+        query += " ORDER BY datetime DESC, rowid DESC"
+    query += " LIMIT ?"
+    params.append(limit)
+
+    results = []
+    for path in archive.segments(since, until):
+        connection = sqlite3.connect(path.resolve().as_uri() + "?mode=ro", uri=True)
+        try:
+            rows = connection.execute(query, params).fetchall()
+        except sqlite3.OperationalError:
+            # not indexed yet, see MessageArchive.index_segments
+            continue
+        finally:
+            connection.close()
+        for message_id, text, timestamp, author, room, snippet, rank in rows:
+            results.append(
+                {
+                    "id": message_id,
+                    "text": text,
+                    "datetime": timestamp,
+                    "user_id": author,
+                    "room_id": room,
+                    "highlight": highlight(snippet),
+                    "score": -rank,
+                }
+            )
+    return results
+
+
+def _scan_archive(
+    archive: MessageArchive,
+    text: str,
+    user_id: Optional[int],
+    room_id: Optional[int],
+    since: Optional[datetime],
+    until: Optional[datetime],
+    order: str,
+    limit: int,
+) -> List[dict]:
+    "the newest limit archived messages containing every word, like the LIKE scan"
+    since = since.timestamp() if since is not None else None
+    until = until.timestamp() if until is not None else None
+    watermark = archive.watermark
+    if watermark is None or (since is not None and since > watermark):
+        return []
+
+    words = [word.rstrip("*").lower() or word for word in text.split()]
+    rows = archive.scan(
+        lambda message: all(word in message.lower() for word in words),
+        user_id,
+        room_id,
+        since,
+        until,
+        limit,
+    )
+    for row in rows:
+        row["highlight"] = _like_highlight(row["text"] or "", words)
+        row["score"] = None
+    return rows
@@ -2,6 +2,7 @@ from colorama import Fore, Back
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
 
+from .avatars import avatar_url, avatar_urls, nearest_size
 
 db = SQLAlchemy()
 
@@ -11,18 +12,48 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(15), unique=True)
     email = db.Column(db.String(50), unique=True)
-    password = db.Column(db.String(80))
+    password = db.Column(db.String(128))
     avatar_filename = db.Column(db.String(30))
+    # maintained by user_stats alongside message inserts
+    post_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    @property
+    def avatar_urls(self):
+        "avatar url for every configured size"
+        return avatar_urls(self.avatar_filename)
+
+    def avatar_url(self, size: int) -> str:
+        "avatar url at the configured size nearest size"
+        return avatar_url(self.avatar_filename, nearest_size(size))
 
     def __repr__(self):
         return f'<User {self.id} "{self.username}">'
 
 
+class Room(db.Model):
+    __tablename__ = "rooms"
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(32), unique=True, nullable=False)
+    # None for the default room
+    created_by = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
+
+    def __repr__(self):
+        return f'<Room {self.id} "{self.name}">'
+
+
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        db.Index("ix_messages_datetime_id", "datetime", "id"),
+        db.Index("ix_messages_room_datetime_id", "room_id", "datetime", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text)
     datetime = db.Column(db.DateTime, nullable=False)
+    # 1 is the default room, see rooms.py
+    room_id = db.Column(
+        db.Integer, db.ForeignKey("rooms.id"), nullable=False, server_default="1"
+    )
 
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     user = db.relationship("User", backref="messages")
@@ -33,4 +64,5 @@ class Message(db.Model):
             "text": self.text,
             "datetime": self.datetime.timestamp(),
             "user_id": self.user_id,
+            "room_id": self.room_id,
         }
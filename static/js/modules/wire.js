@@ -0,0 +1,115 @@
+// decoding for the packed wire format, see wire.py on the server.
+// packed payloads are [version, body] with records as positional tuples,
+// lists arrive as a messagepack ArrayBuffer and single records as json
+
+export const SCHEMA_VERSION = 2;
+
+const textDecoder = new TextDecoder();
+
+class Reader {
+    constructor(buffer) {
+        this.view = new DataView(buffer);
+        this.bytes = new Uint8Array(buffer);
+        this.offset = 0;
+    }
+
+    read() {
+        const view = this.view;
+        const byte = view.getUint8(this.offset++);
+        if (byte < 0x80) return byte;
+        if (byte >= 0xe0) return byte - 0x100;
+        if (byte >= 0xa0 && byte < 0xc0) return this.string(byte & 0x1f);
+        if (byte >= 0x90 && byte < 0xa0) return this.array(byte & 0x0f);
+        if (byte >= 0x80 && byte < 0x90) return this.map(byte & 0x0f);
+        switch (byte) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return this.binary(this.uint(1));
+            case 0xc5: return this.binary(this.uint(2));
+            case 0xc6: return this.binary(this.uint(4));
+            case 0xca: return this.advance(4, view.getFloat32(this.offset));
+            case 0xcb: return this.advance(8, view.getFloat64(this.offset));
+            case 0xcc: return this.uint(1);
+            case 0xcd: return this.uint(2);
+            case 0xce: return this.uint(4);
+            case 0xcf: return this.advance(8, Number(view.getBigUint64(this.offset)));
+            case 0xd0: return this.advance(1, view.getInt8(this.offset));
+            case 0xd1: return this.advance(2, view.getInt16(this.offset));
+            case 0xd2: return this.advance(4, view.getInt32(this.offset));
+            case 0xd3: return this.advance(8, Number(view.getBigInt64(this.offset)));
+            case 0xd9: return this.string(this.uint(1));
+            case 0xda: return this.string(this.uint(2));
+            case 0xdb: return this.string(this.uint(4));
+            case 0xdc: return this.array(this.uint(2));
+            case 0xdd: return this.array(this.uint(4));
+            case 0xde: return this.map(this.uint(2));
+            case 0xdf: return this.map(this.uint(4));
+        }
+        throw new Error(`unsupported messagepack type 0x${byte.toString(16)}`);
+    }
+
+    advance(size, value) {
+        this.offset += size;
+        return value;
+    }
+
+    uint(size) {
+        const view = this.view;
+        const value = size == 1 ? view.getUint8(this.offset)
+            : size == 2 ? view.getUint16(this.offset)
+            : view.getUint32(this.offset);
+        return this.advance(size, value);
+    }
+
+    string(length) {
+        const text = textDecoder.decode(this.bytes.subarray(this.offset, this.offset + length));
+        return this.advance(length, text);
+    }
+
+    binary(length) {
+        return this.advance(length, this.bytes.slice(this.offset, this.offset + length));
+    }
+
+    array(length) {
+        const items = new Array(length);
+        for (let i = 0; i < length; i++) items[i] = this.read();
+        return items;
+    }
+
+    map(length) {
+        const result = {};
+        for (let i = 0; i < length; i++) {
+            const key = this.read();
+            result[key] = this.read();
+        }
+        return result;
+    }
+}
+
+export function decode(buffer) {
+    return new Reader(buffer).read();
+}
+
+// the body of a packed payload, from either an ArrayBuffer or a json array
+function body(payload) {
+    const [version, body] = payload instanceof ArrayBuffer ? decode(payload) : payload;
+    if (version != SCHEMA_VERSION) throw new Error(`unknown wire schema version ${version}`);
+    return body;
+}
+
+function message([id, text, datetime, user_id, room_id]) {
+    return { id, text, datetime, user_id, room_id };
+}
+
+// turn packed payloads back into the json shape handlers expect, anything
+// that isn't packed is passed through untouched
+export const unpack = {
+    'chat-message': (payload) => Array.isArray(payload) ? message(body(payload)) : payload,
+    'return-messages': (payload) => payload instanceof ArrayBuffer ? body(payload).map(message) : payload,
+    'presence-snapshot': (payload) => {
+        if (!(payload instanceof ArrayBuffer)) return payload;
+        const [epoch, version, users] = body(payload);
+        return { epoch, version, users };
+    },
+};
@@ -1,14 +1,33 @@
 // const io = require("socket.io-client");
+import { SCHEMA_VERSION, unpack } from './modules/wire.js';
 
 const baseURL = document.getElementsByTagName('base')[0].href
 const socket = io(baseURL);
 
+// the compact packed format is opt in on the server, ?wire=json turns it off
+const wireEncoding = new URLSearchParams(location.search).get('wire') || 'packed';
+
+// like socket.on, but handlers always get the json shape of the payload
+function onEvent(event, handler) {
+    const decode = unpack[event];
+    socket.on(event, decode ? (payload) => handler(decode(payload)) : handler);
+}
+
+// mirrors avatars.avatar_url on the server, processed avatars are a bare
+// content hash served in fixed sizes, older uploads keep their filename
+function avatarURL(avatar, size) {
+    if (!avatar) return '/static/avatars/default.jpg';
+    if (avatar.includes('.')) return `/static/avatars/${avatar}`;
+    return `/avatars/${avatar}_${size}.png`;
+}
+
 class User {
-    constructor(id, username, online = false, datetime = new Date()) {
+    constructor(id, username, online = false, datetime = new Date(), avatar = null) {
         this.id = id;
         this.username = username;
         this.online = online;
         this.datetime = datetime;
+        this.avatar = avatar;
         this.cardHTML = undefined;
     }
 
@@ -28,7 +47,7 @@ class User {
         const userCard = document.getElementById("user-card");
         const userCardAvatar = document.getElementById("user-card-avatar");
         const userCardTable = document.getElementById("user-card-table");
-        userCardAvatar.src = `/static/avatars/user_${this.id}_avatar.jpg`;
+        userCardAvatar.src = avatarURL(this.avatar, 256);
         let newTable = document.createElement("table");
         newTable.id = userCardTable.id;
         newTable.className = userCardTable.className;
@@ -105,7 +124,7 @@ class UserList {
         this._offline.length = 0;
 
         for (let userdata of JSON.parse(request.responseText)) {
-            let user = new User(userdata.id, userdata.username, userdata.online);
+            let user = new User(userdata.id, userdata.username, userdata.online, new Date(), userdata.avatar_filename);
             console.log(`created ${user.username} ${user.id} online: ${user.online}`)
             this._map.set(user.id, user);
             if (user.online) {
@@ -186,6 +205,29 @@ class UserList {
     }
 
     get(user_id) { return this._map.get(user_id); }
+
+    addUser(user) {
+        this._map.set(user.id, user);
+        if (user.online) this._online.push(user);
+        else this._offline.push(user);
+    }
+
+    // the server only sends the first page of the directory, fetch any
+    // other users we come across in one batched request
+    loadMissing(user_ids) {
+        const missing = [...new Set(user_ids)].filter((id) => !this._map.has(id));
+        if (missing.length == 0) return Promise.resolve();
+        return fetch(`${baseURL}api/get/userlist?ids=${missing.join(",")}`)
+            .then((response) => response.json())
+            .then((userList) => {
+                for (let userdata of userList) {
+                    if (!this._map.has(userdata.id)) {
+                        this.addUser(new User(userdata.id, userdata.username, userdata.online, new Date(), userdata.avatar_filename));
+                    }
+                }
+                this.updateHTML();
+            });
+    }
 }
 
 const users = new UserList("user-list");
@@ -200,7 +242,8 @@ class ChatMessage {
     }
 
     getHTML() {
-        const username = users.get(this.user_id).username;
+        const user = users.get(this.user_id);
+        const username = user ? user.username : `user ${this.user_id}`;
         return `<span class="timestamp">[${this.datetime.toLocaleTimeString("en-US")}]</span> `
             + `<span class="username">${username}</span> `
             + `${this.text}<br>`;
@@ -213,6 +256,8 @@ class Chat {
         this.div = document.getElementById(div_id);
         this.div.scrollTop = this.div.scrollHeight;
         this.historyChecker = undefined;
+        this.historyCursor = undefined;
+        this.historyLoading = false;
     }
 
     startHistoryChecker() {
@@ -230,10 +275,11 @@ class Chat {
     }
 
     getHistory() {
+        if (this.historyLoading || !this.historyCursor) return;
         const endpoint = baseURL + "api/get/chat/history";
-        // const request = new XMLHttpRequest;
-        const data = JSON.stringify({ "before": this.messages[0].datetime.getTime() })
+        const data = JSON.stringify({ "cursor": this.historyCursor, "direction": "before" })
 
+        this.historyLoading = true;
         fetch(endpoint, {
             method: 'POST',
             headers: {
@@ -242,26 +288,30 @@ class Chat {
             body: data,
         })
             .then(response => response.json())
-            .then(messages => {
-                if (messages.length == 0) {
-                    console.log('getHistory reveived no messages, clearing historyChecker...');
+            .then(page => {
+                // page.messages is oldest first
+                for (let msg of page.messages.reverse()) {
+                    let message = new ChatMessage(
+                        new Date(msg.datetime),
+                        msg.user_id,
+                        msg.text,
+                    )
+                    this.push_front(message);
+                }
+                this.historyCursor = page.before;
+                users.loadMissing(page.messages.map((msg) => msg.user_id)).then(() => this.updateHTML());
+                if (!page.has_more) {
+                    console.log('getHistory reached the start of the chat, clearing historyChecker...');
                     clearInterval(this.historyChecker);
-                } else {
-                    for (let msg of messages) {
-                        let message = new ChatMessage(
-                            new Date(msg.datetime),
-                            msg.user_id,
-                            msg.text,
-                        )
-                        this.push_front(message);
-                    }
                 }
+                this.updateHTML();
             })
             .catch((error) => {
                 console.error('Error:', error);
+            })
+            .finally(() => {
+                this.historyLoading = false;
             });
-
-        this.updateHTML();
     }
 
     push_front(message) {
@@ -345,53 +395,117 @@ function makeUserCardDraggable() {
 socket.on('connect', () => {
     console.log(`connection successful, socket id: ${socket.id}`);
     chatBox.scrollTop = chatBox.scrollHeight;
+    socket.emit("set-encoding", { encoding: wireEncoding, version: SCHEMA_VERSION });
     console.log("requesting messages");
     socket.emit("get-messages", { "since": null });
+    if (presence.epoch === undefined) {
+        socket.emit("get-user-list");
+    } else {
+        socket.emit("presence-sync", { epoch: presence.epoch, version: presence.version });
+    }
 });
 
-socket.on('user-joined', (data) => {
-    const datetime = new Date(data.timestamp);
-    let user = users.get(data.user_id);
-    console.log(`user ${data.user_id} has joined`)
-    console.log(`${datetime.toTimeString()}`);
-    console.log(`${user.datetime.toTimeString()}`);
-    console.log(`username is ${user.username}`);
-    if (user.datetime < datetime) {
-        console.log(`updateing user ${user.id} state`);
-        users.setUserOnlineStatus(data.user_id, true);
-        user.datetime = datetime;
+let heartbeat = undefined;
+socket.on('heartbeat-interval', (seconds) => {
+    // the server marks us offline if heartbeats stop arriving
+    clearInterval(heartbeat);
+    heartbeat = setInterval(() => socket.emit('heartbeat'), seconds * 1000);
+});
+
+// presence arrives as a snapshot followed by numbered deltas, a gap in the
+// numbers means we missed some and have to ask the server to catch us up
+const presence = { epoch: undefined, version: 0 };
+
+function applyPresenceDelta(delta) {
+    if (delta.op == 'join') {
+        const [id, username, avatar] = delta.user;
+        if (!users.get(id)) users.addUser(new User(id, username, false, new Date(), avatar));
+        users.setUserOnlineStatus(id, true, false);
+    } else if (delta.op == 'leave') {
+        if (users.get(delta.user)) users.setUserOnlineStatus(delta.user, false, false);
+    } else if (delta.op == 'avatar') {
+        const user = users.get(delta.user[0]);
+        if (user) user.avatar = delta.user[1];
+    }
+    presence.version = delta.v;
+}
+
+onEvent('presence-snapshot', (snapshot) => {
+    console.log(`presence snapshot version ${snapshot.version}, ${snapshot.users.length} online`);
+    const online = new Set(snapshot.users.map(([id]) => id));
+    for (const user of users._map.values()) {
+        if (user.online && !online.has(user.id)) users.setUserOnlineStatus(user.id, false, false);
+    }
+    for (const [id, username, avatar] of snapshot.users) {
+        applyPresenceDelta({ v: snapshot.version, op: 'join', user: [id, username] });
+        applyPresenceDelta({ v: snapshot.version, op: 'avatar', user: [id, avatar] });
+    }
+    presence.epoch = snapshot.epoch;
+    presence.version = snapshot.version;
+    users.updateHTML();
+});
+
+socket.on('presence-delta', (delta) => {
+    if (presence.epoch === undefined || delta.v <= presence.version) return;
+    if (delta.v != presence.version + 1) {
+        console.log(`missed presence deltas ${presence.version + 1}..${delta.v - 1}, resyncing`);
+        socket.emit('presence-sync', { epoch: presence.epoch, version: presence.version });
+        return;
     }
+    applyPresenceDelta(delta);
+    users.updateHTML();
 });
 
-socket.on('user-left', (data) => {
-    console.log(`user ${data.user_id} has left`);
-    let user = users.get(data.user_id);
-    const datetime = new Date(data.timestamp);
-    if (user.datetime < datetime) {
-        users.setUserOnlineStatus(user_id, false);
-        user.datetime = datetime;
+socket.on('presence-deltas', (update) => {
+    for (const delta of update.deltas) {
+        if (delta.v > presence.version) applyPresenceDelta(delta);
     }
+    users.updateHTML();
+});
+
+// broadcasts close together arrive as one frame of [event, payload] pairs,
+// handed to the same handlers as if they had been sent one by one
+socket.on('batch', (events) => {
+    for (const [event, payload] of events) {
+        for (const listener of socket.listeners(event)) listener(payload);
+    }
+});
+
+socket.on('rate-limited', (limited) => {
+    console.log(`${limited.event} rate limited, retry in ${limited.retry_after.toFixed(1)}s`);
+    if (limited.event == 'chat-message') chatBox.serverMessage('slow down, that message was not sent');
+});
+
+socket.on('encoding', (accepted) => {
+    console.log(`server sends ${accepted.encoding} events, schema version ${accepted.version}`);
 });
 
 socket.on('disconnect', (reason) => {
     console.log('disconnected', reason);
+    clearInterval(heartbeat);
 });
 
-socket.on('chat-message', (data) => {
+onEvent('chat-message', (data) => {
     const message = new ChatMessage(new Date(data.datetime), data.user_id, data.text);
     chatBox.append(message);
+    if (!users.get(data.user_id)) users.loadMissing([data.user_id]).then(() => chatBox.updateHTML());
+});
+
+socket.on('history-cursor', (cursor) => {
+    chatBox.historyCursor = cursor;
 });
 
 socket.on('message', (message) => {
     chatBox.serverMessage(message);
 });
 
-socket.on("return-messages", (messages) => {
+onEvent("return-messages", (messages) => {
     console.log(`recieved ${messages.length} messages, appending to chatBox`);
     console.log(messages);
     for (let message of messages) {
         chatBox.append(new ChatMessage(new Date(message.datetime), message.user_id, message.text));
     }
+    users.loadMissing(messages.map((message) => message.user_id)).then(() => chatBox.updateHTML());
     if (chatBox.historyChecker == undefined) chatBox.startHistoryChecker();
 });
 
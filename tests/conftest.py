@@ -0,0 +1,52 @@
+"""fixtures shared by the tests
+
+like the benchmarks the tests import the app as a package, so the
+repository directory has to be importable from its parent directory
+"""
+
+import sys
+from importlib import import_module
+from pathlib import Path
+
+import pytest
+from sqlalchemy import event
+
+REPO = Path(__file__).resolve().parents[1]
+PACKAGE = REPO.name
+
+sys.path.insert(0, str(REPO.parent))
+
+
+def package_module(name: str):
+    return import_module(f"{PACKAGE}.{name}")
+
+
+@pytest.fixture
+def app(tmp_path):
+    "a bare flask app with the models on a throwaway sqlite database"
+    from flask import Flask
+
+    sql_models = package_module("sql_models")
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'chat.db'}"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    sql_models.db.init_app(app)
+    with app.app_context():
+        sql_models.db.create_all()
+        package_module("rooms").ensure_rooms()
+        yield app
+        sql_models.db.session.remove()
+
+
+@pytest.fixture
+def statements(app):
+    "every sql statement the app's engine runs while the test does"
+    db = package_module("sql_models").db
+    seen = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        seen.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    yield seen
+    event.remove(db.engine, "before_cursor_execute", record)
@@ -0,0 +1,126 @@
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import package_module
+
+archive = package_module("archive")
+history = package_module("history")
+message_views = package_module("message_views")
+search = package_module("search")
+sql_models = package_module("sql_models")
+user_stats = package_module("user_stats")
+db, Message, User = sql_models.db, sql_models.Message, sql_models.User
+
+START = datetime(2024, 1, 1)
+CUTOFF = START + timedelta(days=60)
+
+
+@pytest.fixture
+def messages(app):
+    "a message a day for 90 days, from two users, with an fts index"
+    search.ensure_index()
+    db.session.add_all(
+        [
+            User(username=name, email=f"{name}@example.com", password="x")
+            for name in "ab"
+        ]
+    )
+    db.session.flush()
+    db.session.add_all(
+        [
+            Message(
+                id=i,
+                text=f"{'apple' if i % 2 else 'pear'} number {i}",
+                datetime=START + timedelta(days=i),
+                user_id=1 if i % 3 else 2,
+            )
+            for i in range(90)
+        ]
+    )
+    db.session.commit()
+
+
+@pytest.fixture
+def message_archive(tmp_path):
+    return archive.MessageArchive(tmp_path / "archive", block_size=8)
+
+
+def all_ids(page_archive):
+    page = history.fetch_page(None, history.BEFORE, 500, archive=page_archive)
+    return [message["id"] for message in page.messages]
+
+
+def test_archived_messages_still_page_and_search(messages, message_archive):
+    assert archive.archive_older_than(message_archive, CUTOFF) == 60
+    assert db.session.query(Message).count() == 30
+    assert all_ids(message_archive) == list(range(90))
+
+    found = search.search("apple", order=search.RECENT, limit=100)
+    assert len(found.results) == 15
+    found = search.search(
+        "apple", order=search.RECENT, limit=100, archive=message_archive
+    )
+    assert [result["id"] for result in found.results] == list(range(89, 0, -2))
+    assert "<mark>apple</mark>" in found.results[-1]["highlight"]
+
+    found = search.search("pear", limit=10, offset=40, archive=message_archive)
+    assert len(found.results) == 5
+    assert found.next_offset is None
+
+
+def test_the_like_scan_searches_the_archive_too(messages, message_archive):
+    archive.archive_older_than(message_archive, CUTOFF)
+
+    found = search.search("APPLE", limit=100, fts=False, archive=message_archive)
+    assert [result["id"] for result in found.results] == list(range(89, 0, -2))
+    assert found.results[-1]["highlight"] == "<mark>apple</mark> number 1"
+
+    # filters apply on both sides of the cutoff, pages run across it
+    found = search.search(
+        "number",
+        user_id=2,
+        since=START + timedelta(days=50),
+        until=START + timedelta(days=70),
+        limit=3,
+        offset=2,
+        fts=False,
+        archive=message_archive,
+    )
+    assert [result["id"] for result in found.results] == [63, 60, 57]
+    assert found.next_offset == 5
+
+
+def test_rerunning_an_interrupted_move_archives_once(messages, message_archive):
+    rows = message_views.to_json_list(
+        message_views.message_query().filter(Message.datetime < CUTOFF)
+    )
+    # written to the archive, then the worker died before the delete
+    assert message_archive.write(rows) == 60
+    assert archive.archive_older_than(message_archive, CUTOFF) == 60
+    assert message_archive.stats["messages"] == 60
+    assert message_archive.write(rows[:10]) == 0
+    assert all_ids(message_archive) == list(range(90))
+
+
+def test_post_counts_include_archived_messages(messages, message_archive):
+    archive.archive_older_than(message_archive, CUTOFF)
+    user_stats.rebuild_post_counts(message_archive)
+    counts = dict(db.session.query(User.id, User.post_count))
+    assert counts == {1: 60, 2: 30}
+
+
+def test_segments_from_before_the_index_are_indexed(messages, message_archive):
+    archive.archive_older_than(message_archive, CUTOFF)
+    for path in message_archive.segments():
+        connection = sqlite3.connect(path)
+        with connection:
+            connection.execute("DROP TABLE ids")
+            connection.execute(f"DROP TABLE {archive.SEARCH_TABLE}")
+        connection.close()
+
+    message_archive.index_segments()
+    assert message_archive.post_counts() == {1: 40, 2: 20}
+    found = search.search("number", limit=100, archive=message_archive)
+    assert len(found.results) == 90
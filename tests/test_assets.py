@@ -0,0 +1,111 @@
+import gzip
+import json
+
+import pytest
+
+from conftest import package_module
+
+assets = package_module("assets")
+
+
+@pytest.fixture
+def source(tmp_path):
+    "a page script importing a module that imports another"
+    source = tmp_path / "static"
+    (source / "js" / "modules").mkdir(parents=True)
+    (source / "js" / "modules" / "util.js").write_text("export const x = 1;\n")
+    (source / "js" / "modules" / "chat.js").write_text(
+        "import { x } from './util.js';\nexport const y = x;\n"
+    )
+    (source / "js" / "page.js").write_text(
+        "import { y } from './modules/chat.js';\n"
+        "const lazy = import('./modules/util.js');\n"
+        "import 'https://example.com/vendor.js';\n" + "console.log(y);\n" * 100
+    )
+    (source / "css").mkdir()
+    (source / "css" / "style.css").write_text("body { margin: 0 }\n")
+    (source / "img.png").write_bytes(b"not an asset")
+    return source
+
+
+def build(source):
+    return assets.AssetBuilder(str(source), str(source / "build")).build()
+
+
+def test_assets_get_content_hashed_names(source):
+    manifest = build(source)
+    assert sorted(manifest) == [
+        "css/style.css",
+        "js/modules/chat.js",
+        "js/modules/util.js",
+        "js/page.js",
+    ]
+    for name, hashed in manifest.items():
+        content = (source / "build" / hashed).read_bytes()
+        assert hashed == assets.hashed_name(name, content)
+    with open(source / "build" / assets.MANIFEST_NAME) as f:
+        assert json.load(f) == manifest
+
+
+def test_imports_point_at_hashed_modules(source):
+    manifest = build(source)
+    page = (source / "build" / manifest["js/page.js"]).read_text()
+    chat = manifest["js/modules/chat.js"].removeprefix("js/")
+    util = manifest["js/modules/util.js"].removeprefix("js/")
+    assert f"from './{chat}'" in page
+    assert f"import('./{util}')" in page
+    assert "'https://example.com/vendor.js'" in page
+
+    nested = (source / "build" / manifest["js/modules/chat.js"]).read_text()
+    assert f"from './{util.removeprefix('modules/')}'" in nested
+
+
+def test_changing_a_module_changes_everything_importing_it(source):
+    before = build(source)
+    (source / "js" / "modules" / "util.js").write_text("export const x = 2;\n")
+    after = build(source)
+    assert after["css/style.css"] == before["css/style.css"]
+    for name in ("js/modules/util.js", "js/modules/chat.js", "js/page.js"):
+        assert after[name] != before[name]
+
+
+def test_circular_imports_are_refused(source):
+    (source / "js" / "modules" / "util.js").write_text("import './chat.js';\n")
+    with pytest.raises(ValueError, match="circular"):
+        build(source)
+
+
+def test_compressed_copies_are_kept_when_smaller(source):
+    manifest = build(source)
+    page = source / "build" / manifest["js/page.js"]
+    compressed = page.with_name(page.name + ".gz")
+    assert gzip.decompress(compressed.read_bytes()) == page.read_bytes()
+
+    directory = str(source / "build")
+    name = manifest["js/page.js"]
+    assert assets.choose_encoding(directory, name, {"gzip": 1.0}) == (
+        name + ".gz",
+        "gzip",
+    )
+    assert assets.choose_encoding(directory, name, {"gzip": 0}) == (name, None)
+    # too small to be worth compressing
+    style = manifest["css/style.css"]
+    assert assets.choose_encoding(directory, style, {"gzip": 1.0}) == (style, None)
+
+
+def test_manifest_urls_fall_back_to_static_files(source):
+    manifest = build(source)
+    loaded = assets.AssetManifest(str(source / "build")).load()
+    assert len(loaded) == 4
+    assert loaded.url("js/page.js") == "/assets/" + manifest["js/page.js"]
+    assert loaded.is_hashed(manifest["js/page.js"])
+    assert not loaded.is_hashed("js/page.js")
+
+    unbuilt = assets.AssetManifest(str(source / "missing")).load()
+    assert len(unbuilt) == 0
+    assert unbuilt.url("js/page.js") == "/static/js/page.js"
+
+
+def test_module_scripts_are_served_as_javascript():
+    assert assets.content_type("js/page.1a2b3c4d5e6f.js") == "text/javascript"
+    assert assets.content_type("css/style.css") == "text/css"
@@ -0,0 +1,94 @@
+import pytest
+
+from conftest import package_module
+
+availability = package_module("availability")
+config = package_module("config")
+flow_control = package_module("flow_control")
+sql_models = package_module("sql_models")
+db, User = sql_models.db, sql_models.User
+
+
+def sign_up(index, start, stop):
+    "users start to stop - 1, recorded as a signup would be"
+    for i in range(start, stop):
+        db.session.add(
+            User(username=f"user{i}", email=f"user{i}@example.com", password="x")
+        )
+        db.session.commit()
+        index.add("username", f"user{i}")
+        index.add("email", f"user{i}@example.com")
+
+
+@pytest.fixture
+def index(app):
+    index = availability.AvailabilityIndex(User, ("username", "email"), capacity=50)
+    index.init_app(app)
+    return index
+
+
+def test_a_bloom_filter_has_no_false_negatives():
+    bloom = availability.BloomFilter(1000, error_rate=0.01)
+    values = [f"user{i}" for i in range(1000)]
+    for value in values:
+        bloom.add(value)
+    assert all(value in bloom for value in values)
+
+    false_positives = sum(f"other{i}" in bloom for i in range(10_000))
+    assert false_positives < 300
+
+
+def test_taken_values_are_always_found(app, index):
+    sign_up(index, 0, 20)
+    index.load()
+    sign_up(index, 20, 40)
+
+    for i in range(40):
+        assert index.is_taken("username", f"user{i}")
+        assert index.is_taken("email", f"user{i}@example.com")
+    assert not index.is_taken("username", "user40")
+    # a miss in the filter never reaches the database
+    assert index.stats["database_checks"] < index.stats["lookups"]
+
+
+def test_a_full_filter_is_rebuilt_in_the_background(app, index):
+    index.load()
+    sign_up(index, 0, 50)
+    assert index._rebuild is None
+
+    # the signup past capacity starts the rebuild, lookups don't wait for it
+    sign_up(index, 50, 51)
+    # the email filter filling may have started a second rebuild
+    index._rebuild.join(5)
+    assert index._filters["username"].capacity == 102
+    assert index._filters["username"].count == 51
+
+    sign_up(index, 51, 60)
+    for i in range(60):
+        assert index.is_taken("username", f"user{i}")
+
+
+def test_signups_during_a_rebuild_are_kept(app, index, monkeypatch):
+    sign_up(index, 0, 10)
+    add = availability.BloomFilter.add
+
+    def add_then_sign_up(bloom, value):
+        # another signup lands once load() has started reading the table
+        add(bloom, value)
+        if value == "user0":
+            index.add("username", "user10")
+
+    monkeypatch.setattr(availability.BloomFilter, "add", add_then_sign_up)
+    index.load()
+    assert index.might_be_taken("username", "user10")
+    assert index._added is None
+
+
+def test_lookups_are_rate_limited_per_address():
+    limiter = flow_control.RateLimiter(config.RATE_LIMITS)
+    rate, burst = config.RATE_LIMITS["check-availability"]
+    for _ in range(int(burst)):
+        assert limiter.allow(("ip", "10.0.0.1"), "check-availability") is None
+    retry_after = limiter.allow(("ip", "10.0.0.1"), "check-availability")
+    assert 0 < retry_after <= 1 / rate
+    assert limiter.allow(("ip", "10.0.0.2"), "check-availability") is None
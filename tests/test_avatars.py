@@ -0,0 +1,19 @@
+from conftest import package_module
+
+avatars = package_module("avatars")
+User = package_module("sql_models").User
+
+
+def test_avatar_url_falls_back_to_the_nearest_size(app):
+    app.config["AVATAR_SIZES"] = (32, 64, 256)
+    user = User(avatar_filename="0123abcd")
+    assert user.avatar_url(48) == "/avatars/0123abcd_64.png"
+    assert user.avatar_url(256) == "/avatars/0123abcd_256.png"
+    assert user.avatar_url(1024) == "/avatars/0123abcd_256.png"
+    assert list(user.avatar_urls) == [32, 64, 256]
+
+
+def test_uploads_from_before_resizing_keep_their_url(app):
+    app.config["AVATAR_SIZES"] = (32,)
+    assert User(avatar_filename="me.jpg").avatar_url(32) == "/static/avatars/me.jpg"
+    assert User().avatar_url(32) == avatars.DEFAULT_AVATAR_URL
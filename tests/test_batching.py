@@ -0,0 +1,61 @@
+import threading
+import time
+
+from conftest import package_module
+
+batching = package_module("batching")
+
+
+def test_first_event_goes_out_and_the_rest_are_batched():
+    sent = []
+    batcher = batching.BroadcastBatcher(
+        lambda event, payload, **kwargs: sent.append((event, payload)), interval=60
+    )
+    for i in range(3):
+        batcher.send("chat", "chat-message", i)
+    assert sent == [("chat-message", 0)]
+    batcher.flush(force=True)
+    assert sent[1] == (batching.BATCH_EVENT, [["chat-message", 1], ["chat-message", 2]])
+
+
+def test_background_flush_wakes_up_for_an_open_batch():
+    sent = []
+    flushed = threading.Event()
+
+    def emit(event, payload, **kwargs):
+        sent.append((event, payload))
+        if len(sent) == 2:
+            flushed.set()
+
+    sleeps = []
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        time.sleep(seconds)
+
+    batcher = batching.BroadcastBatcher(emit, interval=0.05)
+    threading.Thread(target=batcher.run_forever, args=(sleep,), daemon=True).start()
+    time.sleep(0.1)
+    # nothing was queued, so the flusher hasn't slept at all
+    assert sleeps == []
+
+    batcher.send("chat", "chat-message", 1)
+    batcher.send("chat", "chat-message", 2)
+    assert flushed.wait(1)
+    assert sent[1] == ("chat-message", 2)
+    assert len(sleeps) == 1
+
+
+def test_stats_count_every_event_sent_from_many_threads():
+    batcher = batching.BroadcastBatcher(lambda *args, **kwargs: None, interval=0)
+
+    def send():
+        for i in range(2000):
+            batcher.send("chat", "chat-message", i)
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert batcher.stats == {"events": 16000, "frames": 16000}
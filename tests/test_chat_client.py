@@ -0,0 +1,223 @@
+import json
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from conftest import REPO
+
+# the client is a script, it imports error.py from next to it
+sys.path.insert(0, str(REPO))
+chat_client = pytest.importorskip("chat_client")
+
+
+class ChatApi(BaseHTTPRequestHandler):
+    "answers the history and user list calls, noting the connection of each"
+
+    protocol_version = "HTTP/1.1"
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.server.connections.append(self.client_address)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        ids = self.path.partition("ids=")[2].split("%2C")
+        self._reply([{"id": int(id), "username": f"user{id}"} for id in ids])
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self._reply({"messages": [{"id": 1, "text": "hi"}]})
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ChatApi)
+    server.connections = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_calls_reuse_pooled_connections(server):
+    client = chat_client.ChatConnection(f"http://127.0.0.1:{server.server_port}/")
+    try:
+        for _ in range(5):
+            assert client.history(1) == [{"id": 1, "text": "hi"}]
+        client.lookup_users([3, 1, 2])
+        assert client.username(2) == "user2"
+        # already known, no request
+        client.lookup_users([1, 2])
+    finally:
+        client.close()
+
+    assert len(server.connections) == 6
+    assert len(set(server.connections)) == 1
+
+
+def test_concurrent_calls_are_limited_to_the_pool(server):
+    client = chat_client.ChatConnection(
+        f"http://127.0.0.1:{server.server_port}", pool_size=2
+    )
+    try:
+        threads = [threading.Thread(target=client.history, args=(1,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for _ in range(4):
+            client.history(1)
+    finally:
+        client.close()
+
+    # surplus connections are closed after use instead of being kept, so
+    # calls after the burst go over the two that were kept
+    assert len(server.connections) == 12
+    assert len(set(server.connections[-4:])) <= 2
+
+
+def test_the_socket_shares_the_http_session():
+    client = chat_client.ChatConnection("http://127.0.0.1:1")
+    try:
+        assert client.socket.eio.http is client.http
+    finally:
+        client.close()
+
+
+class FakeServer:
+    "takes the outbox's chat-messages batches, the test answers them"
+
+    def __init__(self):
+        self.batches = queue.Queue()
+
+    def emit(self, event, data, callback):
+        assert event == "chat-messages"
+        self.batches.put((data["messages"], callback))
+
+    def receive(self, timeout=2):
+        "the next batch's texts and ack callback"
+        messages, callback = self.batches.get(timeout=timeout)
+        return [message["text"] for message in messages], callback
+
+    def idle(self, seconds):
+        "whether nothing is sent for seconds"
+        try:
+            self.batches.get(timeout=seconds)
+        except queue.Empty:
+            return True
+        return False
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    "a connected, running outbox and the server it sends to"
+    server = FakeServer()
+    outbox = chat_client.Outbox(server.emit, tmp_path / "outbox", timeout=5)
+    outbox.connected()
+    outbox.start()
+    yield outbox, server
+    outbox.close()
+
+
+def ids(outbox):
+    return list(outbox._pending)
+
+
+def test_acked_messages_leave_the_outbox(outbox):
+    outbox, server = outbox
+    outbox.put("one")
+    texts, ack = server.receive()
+    assert texts == ["one"]
+    assert outbox.path.exists()
+
+    ack({"acked": ids(outbox), "rejected": []})
+    assert len(outbox) == 0
+    assert not outbox.path.exists()
+    assert server.idle(0.1)
+
+
+def test_rejected_messages_are_dropped_and_reported(outbox):
+    outbox, server = outbox
+    rejected = []
+    outbox.on_rejected = rejected.append
+    outbox.put("too long")
+    _, ack = server.receive()
+    ack({"acked": [], "rejected": ids(outbox)})
+    assert len(outbox) == 0
+    assert rejected == [1]
+
+
+def test_the_rest_is_resent_after_retry_after(outbox):
+    outbox, server = outbox
+    outbox._connected = False
+    for text in ("one", "two", "three"):
+        outbox.put(text)
+    outbox.connected()
+    texts, ack = server.receive()
+    assert texts == ["one", "two", "three"]
+
+    ack({"acked": ids(outbox)[:1], "rejected": [], "retry_after": 0.3})
+    start = time.monotonic()
+    texts, ack = server.receive()
+    assert time.monotonic() - start >= 0.25
+    assert texts == ["two", "three"]
+
+
+def test_an_error_reply_backs_off_instead_of_resending_at_once(outbox):
+    outbox, server = outbox
+    outbox.put("one")
+    _, ack = server.receive()
+    ack({"error": "expected a list of messages"})
+    assert len(outbox) == 1
+    # the first backoff is 0.25 to 0.5 seconds
+    assert server.idle(0.2)
+    texts, ack = server.receive()
+    assert texts == ["one"]
+    assert outbox._backoff == 0.5
+
+    ack({"acked": ids(outbox), "rejected": []})
+    assert outbox._backoff == 0.0
+
+
+def test_batches_in_flight_are_resent_after_reconnecting(outbox):
+    outbox, server = outbox
+    outbox.put("one")
+    server.receive()
+    outbox.disconnected()
+    outbox.put("two")
+    assert server.idle(0.1)
+
+    outbox.connected()
+    texts, _ = server.receive()
+    assert texts == ["one", "two"]
+
+
+def test_unsent_messages_survive_a_restart(tmp_path):
+    server = FakeServer()
+    outbox = chat_client.Outbox(server.emit, tmp_path / "outbox")
+    outbox.put("typed offline")
+    outbox.put("and this")
+    outbox.close()
+
+    outbox = chat_client.Outbox(server.emit, tmp_path / "outbox")
+    outbox.connected()
+    outbox.start()
+    try:
+        texts, ack = server.receive()
+        assert texts == ["typed offline", "and this"]
+        ack({"acked": ids(outbox), "rejected": []})
+        assert not (tmp_path / "outbox").exists()
+    finally:
+        outbox.close()
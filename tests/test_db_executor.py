@@ -0,0 +1,60 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from flask import current_app
+
+from conftest import package_module
+
+db_executor = package_module("db_executor")
+sql_models = package_module("sql_models")
+db, User = sql_models.db, sql_models.User
+
+
+def test_threading_mode_runs_work_inline(app):
+    executor = db_executor.DatabaseExecutor(app)
+    assert executor.run(threading.get_ident) == threading.get_ident()
+    assert executor.run(round, 2.675, ndigits=1) == 2.7
+    with pytest.raises(ZeroDivisionError):
+        executor.run(divmod, 1, 0)
+
+
+def test_at_most_max_workers_calls_run_at_once(app):
+    executor = db_executor.DatabaseExecutor(app, max_workers=2)
+    lock = threading.Lock()
+    running = []
+    most = []
+
+    def work():
+        with lock:
+            running.append(1)
+            most.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    with ThreadPoolExecutor(6) as pool:
+        for future in [pool.submit(executor.run, work) for _ in range(6)]:
+            future.result()
+    assert max(most) == 2
+
+
+def test_offloaded_work_gets_its_own_app_context(app):
+    # stands in for eventlet's tpool or gevent's threadpool
+    pool = ThreadPoolExecutor(1)
+    executor = db_executor.DatabaseExecutor(app)
+    executor._offload = lambda work: pool.submit(work).result()
+
+    def work(username):
+        db.session.add(User(username=username, email="a@example.com", password="x"))
+        db.session.commit()
+        return current_app.name, threading.get_ident()
+
+    try:
+        name, thread = executor.run(work, "alice")
+    finally:
+        pool.shutdown()
+    assert name == app.name
+    assert thread != threading.get_ident()
+    assert [user.username for user in User.query] == ["alice"]
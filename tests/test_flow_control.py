@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import package_module
+
+flow_control = package_module("flow_control")
+
+
+def test_bucket_allows_a_burst_then_throttles():
+    limiter = flow_control.RateLimiter({"chat-message": (5, 10)})
+    assert all(limiter.allow(1, "chat-message") is None for _ in range(10))
+    retry_after = limiter.allow(1, "chat-message")
+    assert 0 < retry_after <= 0.2
+    assert limiter.throttled["chat-message"] == 1
+    # buckets are per user
+    assert limiter.allow(2, "chat-message") is None
+
+
+def test_cost_is_charged_in_full():
+    limiter = flow_control.RateLimiter({"chat-message": (5, 10)})
+    assert limiter.allow(1, "chat-message", 8) is None
+    assert limiter.allow(1, "chat-message", 8) is not None
+    with pytest.raises(ValueError):
+        limiter.allow(1, "chat-message", 11)
+
+
+def test_events_without_a_limit_always_go_ahead():
+    limiter = flow_control.RateLimiter({})
+    assert limiter.allow(1, "anything", 1000) is None
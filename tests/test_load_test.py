@@ -0,0 +1,77 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from conftest import REPO
+
+# the benchmarks are scripts that import their helpers from their directory
+sys.path.insert(0, str(REPO / "benchmarks"))
+load_test = pytest.importorskip("load_test")
+common = pytest.importorskip("common")
+
+
+def test_percentiles_pick_from_the_sorted_samples():
+    samples = [i / 100 for i in range(100, 0, -1)]
+    assert common.percentiles(samples) == {"p50": 0.51, "p95": 0.96, "p99": 1.0}
+    assert common.percentiles([3.0]) == {"p50": 3.0, "p95": 3.0, "p99": 3.0}
+    assert common.percentiles([]) == {"p50": None, "p95": None, "p99": None}
+
+
+def test_paced_calls_keep_to_the_rate():
+    calls = []
+    load_test.paced(200, 0.25, lambda: calls.append(1), threading.Event())
+    assert 40 <= len(calls) <= 50
+
+    stop = threading.Event()
+    stop.set()
+    load_test.paced(200, 10, lambda: calls.append(1), stop)
+    load_test.paced(0, 10, lambda: calls.append(1), threading.Event())
+    assert len(calls) <= 50
+
+
+def test_clients_record_latency_of_load_test_messages_only():
+    recorder = load_test.Recorder()
+    client = load_test.LoadClient("http://localhost", "", recorder)
+    sent = time.time() - 0.5
+    message = {"text": f"{load_test.MARKER} {sent!r}"}
+
+    client._on_chat_message(message)
+    client._on_chat_message({"text": "someone else"})
+    client._on_batch(
+        [["chat-message", message], ["presence", {}], ["chat-message", message]]
+    )
+    client._on_rate_limited({"event": "chat-message"})
+
+    assert recorder.counts == {
+        "received": 3,
+        "batches": 1,
+        "rate_limited:chat-message": 1,
+    }
+    assert all(0.5 <= latency < 5 for latency in recorder.samples["message"])
+
+
+def test_compare_prints_how_headlines_moved(capsys):
+    baseline = {
+        "revision": "abc123",
+        "started": "2026-01-01",
+        "result": {
+            "messages_per_second": 100.0,
+            "message_latency": {"p50": 0.02, "p95": 0.1, "p99": 0.2},
+            "history_latency": None,
+        },
+    }
+    result = {
+        "messages_per_second": 150.0,
+        "message_latency": {"p50": 0.01, "p95": 0.1, "p99": 0.4},
+        "history_latency": {"p50": 0.05},
+    }
+    load_test.compare(baseline, result)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "compared to abc123 (2026-01-01):"
+    assert "  messages_per_second: 100 -> 150 (+50.0%)" in lines
+    assert "  message_latency.p50: 0.02 -> 0.01 (-50.0%)" in lines
+    assert "  message_latency.p99: 0.2 -> 0.4 (+100.0%)" in lines
+    assert "  history_latency.p50: None -> 0.05" in lines
+    assert "  deliveries_per_second: None -> None" in lines
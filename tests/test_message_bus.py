@@ -0,0 +1,16 @@
+import pytest
+
+from conftest import package_module
+
+message_bus = package_module("message_bus")
+
+
+def test_bus_payloads_round_trip_through_json():
+    # socket.io packets carry packed payloads as binary attachments
+    data = {"method": "emit", "data": [b"\x92\x02\x90", "text"], "room": "chat"}
+    assert message_bus.loads(message_bus.dumps(data)) == data
+
+
+def test_anything_else_is_refused():
+    with pytest.raises(TypeError):
+        message_bus.dumps({"data": object()})
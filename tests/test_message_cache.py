@@ -0,0 +1,85 @@
+import json
+
+from conftest import package_module
+
+message_cache = package_module("message_cache")
+wire = package_module("wire")
+
+
+def message(id, datetime=None, room_id=1):
+    return {
+        "id": id,
+        "text": f"message {id}",
+        "datetime": float(id if datetime is None else datetime),
+        "user_id": 1,
+        "room_id": room_id,
+    }
+
+
+def ids(messages):
+    return [data["id"] for data in messages]
+
+
+def test_the_buffer_keeps_the_newest_messages_in_order():
+    cache = message_cache.RecentMessageCache(size=3)
+    for id in (1, 2, 4, 5):
+        cache.append("chat", message(id))
+    # relayed from another worker a little late
+    cache.append("chat", message(3))
+    assert ids(cache.recent("chat", 10)) == [3, 4, 5]
+    assert ids(cache.recent("chat", 2)) == [4, 5]
+
+    # older than everything in a full buffer
+    cache.append("chat", message(0))
+    assert ids(cache.recent("chat", 10)) == [3, 4, 5]
+
+
+def test_warming_keeps_messages_appended_before_it():
+    cache = message_cache.RecentMessageCache(size=10)
+    # sent before the room was warmed, maybe not written yet
+    cache.append("chat", message(4))
+    assert not cache.is_warm("chat")
+    assert cache.warm("chat", [message(3), message(2), message(1)]) == 4
+    assert cache.is_warm("chat")
+    assert ids(cache.recent("chat", 10)) == [1, 2, 3, 4]
+
+    cache.forget("chat")
+    assert not cache.is_warm("chat")
+    assert cache.recent("chat", 10) == []
+
+
+def test_pages_before_a_key_come_from_a_complete_buffer():
+    cache = message_cache.RecentMessageCache(size=10)
+    assert cache.before("chat", (10.0, 10), 2) is None
+
+    cache.warm("chat", [message(id) for id in (5, 4, 3, 2, 1)])
+    assert ids(entry.data for entry in cache.before("chat", (4.0, 4), 2)) == [3, 2]
+    # the whole history is here, a short last page is still an answer
+    assert ids(entry.data for entry in cache.before("chat", (2.0, 2), 5)) == [1]
+    # messages sharing a second are ordered by id
+    cache.append("chat", message(7, datetime=6))
+    cache.append("chat", message(6, datetime=6))
+    assert ids(entry.data for entry in cache.before("chat", (6.0, 7), 1)) == [6]
+
+
+def test_an_incomplete_buffer_sends_short_pages_to_the_database():
+    cache = message_cache.RecentMessageCache(size=3)
+    cache.warm("chat", [message(id) for id in (5, 4, 3)])
+    assert ids(entry.data for entry in cache.before("chat", (5.0, 5), 2)) == [4, 3]
+    assert cache.before("chat", (5.0, 5), 3) is None
+
+    # a buffer that has overflowed has lost its oldest messages
+    cache = message_cache.RecentMessageCache(size=3)
+    cache.warm("chat", [message(2), message(1)])
+    cache.append("chat", message(3))
+    cache.append("chat", message(4))
+    assert cache.before("chat", (4.0, 4), 5) is None
+
+
+def test_cached_encodings_match_encoding_the_messages():
+    cache = message_cache.RecentMessageCache()
+    messages = [message(1), dict(message(2), text="héllo ✓")]
+    cache.warm("chat", reversed(messages))
+    entries = cache.recent_entries("chat", 2)
+    assert json.loads(cache.encode(entries)) == messages
+    assert wire.unpack_messages(cache.pack(entries)) == messages
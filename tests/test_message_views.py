@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import package_module
+
+history = package_module("history")
+message_views = package_module("message_views")
+message_writer = package_module("message_writer")
+sql_models = package_module("sql_models")
+db, Message, User = sql_models.db, sql_models.Message, sql_models.User
+
+
+@pytest.fixture
+def messages(app):
+    "150 messages from 15 users, a second apart"
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {"username": f"user{i}", "email": f"user{i}@example.com", "password": "x"}
+            for i in range(1, 16)
+        ],
+    )
+    start = datetime(2025, 1, 1)
+    db.session.execute(
+        Message.__table__.insert(),
+        [
+            {
+                "id": i,
+                "text": f"message {i}",
+                "datetime": start + timedelta(seconds=i),
+                "user_id": i % 15 + 1,
+            }
+            for i in range(1, 151)
+        ],
+    )
+    db.session.commit()
+
+
+def test_messages_with_authors_take_one_statement(messages, statements):
+    lines = message_views.to_chat_lines(
+        message_views.message_query(authors=True).order_by(Message.id)
+    )
+    assert len(lines) == 150
+    assert lines[0][1:] == ("user2", "message 1")
+    assert len(statements) == 1
+
+
+def test_history_page_takes_one_statement(messages, statements):
+    page = history.fetch_page(None, history.BEFORE, 50)
+    assert [m["id"] for m in page.messages] == list(range(101, 151))
+    assert page.has_more
+    assert len(statements) == 1
+
+    statements.clear()
+    key = history.decode_cursor(page.to_json()[history.BEFORE])
+    page = history.fetch_page(key, history.BEFORE, 50)
+    assert [m["id"] for m in page.messages] == list(range(51, 101))
+    assert len(statements) == 1
+
+
+def test_history_page_from_a_warm_cache_takes_none(messages, statements):
+    cache = package_module("message_cache").RecentMessageCache(100)
+    rows = message_views.to_json_list(
+        message_views.message_query().order_by(Message.datetime, Message.id)
+    )
+    cache.warm("chat", rows, complete=True)
+    statements.clear()
+    page = history.fetch_page(None, history.BEFORE, 50, cache=cache)
+    assert [m["id"] for m in page.messages] == list(range(101, 151))
+    assert statements == []
+
+
+def test_flushing_sends_is_one_insert_per_batch(app, tmp_path, statements):
+    writer = message_writer.MessageWriter(app, str(tmp_path / "messages.journal"))
+    writer.start()
+    try:
+        for i in range(20):
+            writer.submit(f"message {i}", 1)
+        statements.clear()
+        writer.flush()
+    finally:
+        writer.stop()
+    inserts = [s for s in statements if s.lstrip().upper().startswith("INSERT")]
+    assert len(inserts) == 1
+    # the insert, the check for rows a replay already wrote and the commit's
+    # bookkeeping stay constant however many messages were sent
+    assert len(statements) <= 3
+    assert db.session.query(Message).count() == 20
@@ -0,0 +1,104 @@
+import json
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+from conftest import package_module
+
+message_writer = package_module("message_writer")
+sql_models = package_module("sql_models")
+db, Message = sql_models.db, sql_models.Message
+
+
+@pytest.fixture
+def writer(app, tmp_path):
+    writer = message_writer.MessageWriter(app, str(tmp_path / "messages.journal"))
+    writer.start()
+    yield writer
+    writer.stop()
+
+
+def test_a_bad_row_is_dead_lettered_and_the_rest_written(writer):
+    writer.submit("first", 1)
+    writer.submit("broken", 1)
+    writer.submit("last", 1)
+    # something the database can't bind, as unchecked client data once was
+    writer._pending[1]["text"] = {"not": "text"}
+    writer.flush()
+
+    texts = [text for (text,) in db.session.query(Message.text).order_by(Message.id)]
+    assert texts == ["first", "last"]
+    assert writer.queue_depth == 0
+    assert writer.pending_count(1) == 0
+    assert writer.stats.written == 2
+    assert writer.stats.dead_letters == 1
+    with open(writer.dead_letter_path, encoding="utf-8") as dead:
+        (line,) = dead.readlines()
+    assert json.loads(line)["row"]["text"] == {"not": "text"}
+
+
+def test_journal_is_replayed_on_start(app, tmp_path):
+    # left behind by a worker that crashed before flushing
+    path = tmp_path / "messages.journal"
+    row = {"id": 7, "text": "survives", "datetime": 1735689600.0, "user_id": 1}
+    path.write_text(json.dumps(row) + "\n" + '{"id": 8, "te')
+
+    writer = message_writer.MessageWriter(app, str(path))
+    writer.start()
+    try:
+        assert writer.stats.replayed == 1
+        assert db.session.query(Message.id, Message.text).all() == [(7, "survives")]
+        # new ids carry on after the replayed ones
+        assert writer.submit("next", 1).id == 8
+    finally:
+        writer.stop()
+
+
+def test_a_journal_longer_than_the_variable_limit_is_replayed(app, tmp_path):
+    # sqlite's default limit, builds that raise it would hide the problem
+    def limit_variables(connection, record):
+        connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+
+    event.listen(db.engine, "connect", limit_variables)
+    db.session.remove()
+    db.engine.dispose()
+
+    path = tmp_path / "messages.journal"
+    with open(path, "w", encoding="utf-8") as journal:
+        for message_id in range(1, 2501):
+            row = {
+                "id": message_id,
+                "text": "backlog",
+                "datetime": 1735689600.0,
+                "user_id": 1,
+            }
+            journal.write(json.dumps(row) + "\n")
+
+    writer = message_writer.MessageWriter(app, str(path))
+    try:
+        writer.start()
+        assert writer.stats.replayed == 2500
+        assert db.session.query(db.func.count(Message.id)).scalar() == 2500
+        assert path.read_text() == ""
+    finally:
+        writer.stop()
+        event.remove(db.engine, "connect", limit_variables)
+
+
+def test_committed_messages_leave_the_journal_while_others_are_pending(writer):
+    for text in ("one", "two", "three"):
+        writer.submit(text, 1)
+    with writer._lock:
+        batch = writer._take_batch(2)
+    writer._write_batch(batch)
+
+    with open(writer._journal_path, encoding="utf-8") as journal:
+        rows = [json.loads(line) for line in journal]
+    assert [row["text"] for row in rows] == ["three"]
+
+    # new messages are still journaled after the rotation
+    writer.submit("four", 1)
+    with open(writer._journal_path, encoding="utf-8") as journal:
+        rows = [json.loads(line) for line in journal]
+    assert [row["text"] for row in rows] == ["three", "four"]
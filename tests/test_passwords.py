@@ -0,0 +1,64 @@
+import threading
+
+import pytest
+
+from conftest import package_module
+
+passwords = package_module("passwords")
+
+# cheap cost factors keep the tests fast, the config's is much higher
+OLD = "pbkdf2:sha256:1000"
+NEW = "pbkdf2:sha256:2000"
+
+
+def test_an_outdated_hash_is_replaced_on_login():
+    hashed = passwords.hash_password("hunter2", OLD)
+    assert passwords.needs_rehash(hashed, NEW)
+
+    matched, rehashed = passwords.verify_password(hashed, "hunter2", NEW)
+    assert matched
+    assert rehashed.startswith(NEW + "$")
+    assert not passwords.needs_rehash(rehashed, NEW)
+
+    # the new hash still checks, and isn't replaced again
+    assert passwords.verify_password(rehashed, "hunter2", NEW) == (True, None)
+
+
+def test_a_wrong_password_is_never_rehashed():
+    hashed = passwords.hash_password("hunter2", OLD)
+    assert passwords.verify_password(hashed, "hunter3", NEW) == (False, None)
+
+
+def test_the_pool_rehashes_in_worker_processes():
+    hasher = passwords.PasswordHasher(NEW, workers=1)
+    try:
+        hashed = hasher.hash("hunter2")
+        assert hasher.verify(hashed, "hunter2") == (True, None)
+        matched, rehashed = hasher.verify(
+            passwords.hash_password("hunter2", OLD), "hunter2"
+        )
+        assert matched and rehashed.startswith(NEW + "$")
+    finally:
+        hasher.shutdown()
+
+
+def test_callers_past_max_pending_are_turned_away():
+    hasher = passwords.PasswordHasher(NEW, workers=0, max_pending=1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow(password, method):
+        started.set()
+        release.wait(5)
+        return "hashed"
+
+    thread = threading.Thread(target=hasher._call, args=(slow, "a", NEW))
+    thread.start()
+    try:
+        started.wait(5)
+        with pytest.raises(passwords.HasherBusy):
+            hasher.hash("b")
+        assert hasher.rejected == 1
+    finally:
+        release.set()
+        thread.join()
+    assert hasher.hash("b").startswith(NEW + "$")
@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from conftest import package_module
+
+presence = package_module("presence")
+
+
+def test_client_catches_up_from_its_version():
+    log = presence.PresenceLog(history=4)
+    log.join(1, "a", "a.png")
+    snapshot = log.snapshot()
+    log.join(2, "b", "b.png")
+    log.leave(1)
+
+    synced = log.since(snapshot["epoch"], snapshot["version"])
+    assert [delta["op"] for delta in synced["deltas"]] == ["join", "leave"]
+    assert synced["version"] == 3
+
+
+def test_snapshot_needed_once_deltas_are_gone():
+    log = presence.PresenceLog(history=2)
+    for user_id in range(1, 5):
+        log.join(user_id, str(user_id), "")
+    assert log.since(log.epoch, 1) is None
+    assert log.since("another worker", log.version) is None
+    assert log.since(log.epoch, log.version + 1) is None
+
+
+def test_timer_wheel_expires_connections():
+    now = time.time()
+    backend = presence.MemoryPresenceBackend(tick=1, ttl=10)
+    assert backend.connect(1, "sid", expires=now + 5)
+    assert backend.heartbeat(1, "sid", expires=now + 8)
+    assert backend.expire(now + 6) == []
+    assert backend.expire(now + 9) == [1]
+    assert not backend.is_online(1)
+
+
+def test_several_workers_need_a_shared_backend(tmp_path):
+    config = {"PRESENCE_BACKEND": "memory", "PRESENCE_TICK": 1, "PRESENCE_TTL": 45}
+    assert isinstance(
+        presence.backend_from_config(dict(config, WORKER_COUNT=1)),
+        presence.MemoryPresenceBackend,
+    )
+    with pytest.raises(ValueError, match="between workers"):
+        presence.backend_from_config(dict(config, WORKER_COUNT=2))
+
+    shared = dict(config, PRESENCE_BACKEND=f"sqlite:///{tmp_path / 'presence.db'}")
+    assert isinstance(
+        presence.backend_from_config(dict(shared, WORKER_COUNT=2)),
+        presence.SQLitePresenceBackend,
+    )
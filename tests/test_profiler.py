@@ -0,0 +1,32 @@
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from conftest import package_module
+
+profiler = package_module("profiler")
+sql_models = package_module("sql_models")
+db, User = sql_models.db, sql_models.User
+
+
+def test_slow_traces_leave_out_bound_values(app):
+    log = profiler.SlowHandlerLog(threshold=0.001)
+    event.listen(Engine, "before_cursor_execute", log._before_query)
+    event.listen(Engine, "after_cursor_execute", log._after_query)
+    try:
+        # built at runtime, stacks sampled by the watchdog quote source lines
+        password = "".join(("hunter", "2"))
+        trace = log.begin("POST /login")
+        User.query.filter(User.password == password).first()
+        time.sleep(0.002)
+        log.end(trace)
+    finally:
+        event.remove(Engine, "before_cursor_execute", log._before_query)
+        event.remove(Engine, "after_cursor_execute", log._after_query)
+
+    (slow,) = log.traces
+    assert slow["name"] == "POST /login"
+    (query,) = slow["queries"]
+    assert "users.password = ?" in query[0]
+    assert "hunter2" not in repr(slow)
@@ -0,0 +1,36 @@
+import pytest
+
+from conftest import package_module
+
+rooms = package_module("rooms")
+
+
+def test_lookup_never_makes_a_room(app):
+    directory = rooms.RoomDirectory()
+    assert directory.lookup(rooms.DEFAULT_ROOM) == rooms.DEFAULT_ROOM_ID
+    assert directory.lookup("games") is None
+    assert directory.lookup("games") is None
+
+
+def test_users_make_a_limited_number_of_rooms(app):
+    directory = rooms.RoomDirectory()
+    games = directory.create("games", 1, limit=2)
+    assert rooms.RoomDirectory().lookup("games") == games
+    directory.create("music", 1, limit=2)
+    with pytest.raises(ValueError, match="at most 2"):
+        directory.create("films", 1, limit=2)
+    # someone else can still make it
+    directory.create("films", 2, limit=2)
+    with pytest.raises(ValueError, match="already"):
+        directory.create("games", 2, limit=2)
+
+
+def test_membership_counts_users_once_per_room():
+    membership = rooms.RoomMembership()
+    assert membership.join("a", 1, "chat")
+    assert not membership.join("b", 1, "chat")
+    assert membership.is_in("a", "chat")
+    assert not membership.is_in("a", ["chat"])
+    assert not membership.leave("a", 1, "chat")
+    assert membership.drop("b", 1) == ["chat"]
+    assert len(membership) == 0
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import package_module
+
+rooms = package_module("rooms")
+search = package_module("search")
+sql_models = package_module("sql_models")
+db, Message = sql_models.db, sql_models.Message
+
+START = datetime(2025, 1, 1)
+
+TEXTS = {
+    1: "the cat sat on the mat",
+    2: "cat cat cat",
+    3: "a dog chased the cat across a very long and winding road",
+    4: "no felines here",
+    5: "Catalogue of <b>cats</b>",
+    6: "café & crème",
+}
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "like"])
+def fts(app, request):
+    "messages 1 to 6, from users 1 and 2, in the default room and games"
+    if request.param and not search.ensure_index():
+        pytest.skip("sqlite without fts5")
+    games = rooms.RoomDirectory().create("games", 1, limit=5)
+    db.session.execute(
+        Message.__table__.insert(),
+        [
+            {
+                "id": id,
+                "text": text,
+                "datetime": START + timedelta(days=id),
+                "user_id": 1 if id % 2 else 2,
+                "room_id": games if id == 3 else rooms.DEFAULT_ROOM_ID,
+            }
+            for id, text in TEXTS.items()
+        ],
+    )
+    db.session.commit()
+    return request.param
+
+
+def ids(page):
+    return [result["id"] for result in page.results]
+
+
+def test_every_word_has_to_match(fts):
+    assert sorted(ids(search.search("cat", fts=fts))) == [1, 2, 3] + (
+        [] if fts else [5]
+    )
+    assert ids(search.search("the mat cat", fts=fts)) == [1]
+    assert ids(search.search("cat*", order=search.RECENT, fts=fts)) == [5, 3, 2, 1]
+    assert search.search("   ", fts=fts).results == []
+    # fts5 operators are taken literally
+    assert ids(search.search('cat" OR "dog', fts=fts)) == []
+
+
+def test_the_best_matches_come_first(fts):
+    if not fts:
+        pytest.skip("the LIKE scan orders newest first")
+    page = search.search("cat", fts=fts)
+    assert ids(page) == [2, 1, 3]
+    scores = [result["score"] for result in page.results]
+    assert scores == sorted(scores, reverse=True)
+    # ranking only the newest matches
+    assert ids(search.search("cat", rank_window=2, fts=fts)) == [2, 3]
+
+
+def test_newest_first_on_request(fts):
+    assert ids(search.search("cat", order=search.RECENT, fts=fts)) == (
+        [3, 2, 1] if fts else [5, 3, 2, 1]
+    )
+    with pytest.raises(ValueError):
+        search.search("cat", order="oldest", fts=fts)
+
+
+def test_filters_by_user_room_and_time(fts):
+    order = search.RECENT
+    assert ids(search.search("cat", user_id=2, order=order, fts=fts)) == [2]
+    games = rooms.RoomDirectory().lookup("games")
+    assert ids(search.search("cat", room_id=games, order=order, fts=fts)) == [3]
+    within = search.search(
+        "cat",
+        since=START + timedelta(days=2),
+        until=START + timedelta(days=3),
+        order=order,
+        fts=fts,
+    )
+    assert ids(within) == [2]
+    empty = search.search("cat", since=START + timedelta(days=10), order=order, fts=fts)
+    assert ids(empty) == []
+
+
+def test_pages_follow_on(fts):
+    first = search.search("cat*", order=search.RECENT, limit=3, fts=fts)
+    assert ids(first) == [5, 3, 2]
+    assert first.next_offset == 3
+    last = search.search(
+        "cat*", order=search.RECENT, limit=3, offset=first.next_offset, fts=fts
+    )
+    assert ids(last) == [1]
+    assert last.next_offset is None
+
+
+def test_matches_are_marked_in_escaped_text(fts):
+    (result,) = search.search("cats", fts=fts).results
+    assert result["highlight"] == "Catalogue of &lt;b&gt;<mark>cats</mark>&lt;/b&gt;"
+    (result,) = search.search("creme" if fts else "crème", fts=fts).results
+    assert "<mark>crème</mark>" in result["highlight"]
+    assert "&amp;" in result["highlight"]
+
+
+def test_match_expression_quotes_every_word():
+    assert search.match_expression('cat* "dog" -x') == '"cat"* """dog""" "-x"'
+    assert search.match_expression("*") == '"*"'
@@ -0,0 +1,82 @@
+import pytest
+
+from conftest import package_module
+
+user_directory = package_module("user_directory")
+sql_models = package_module("sql_models")
+db, User = sql_models.db, sql_models.User
+
+
+@pytest.fixture
+def users(app):
+    "30 users, user1 to user30"
+    db.session.execute(
+        User.__table__.insert(),
+        [
+            {
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "password": "x",
+                "avatar_filename": f"{i}.png",
+            }
+            for i in range(1, 31)
+        ],
+    )
+    db.session.commit()
+
+
+@pytest.fixture
+def directory(app):
+    directory = user_directory.PublicUserManager(capacity=5)
+    directory.load_from_db(app)
+    return directory
+
+
+def test_users_are_loaded_on_first_lookup(users, directory, statements):
+    assert len(directory) == 0
+    assert directory.lookup_user(3).username == "user3"
+    assert directory.lookup_user("user4").id == 4
+    assert directory.lookup_user(99) is None
+    assert directory.lookup_user("nobody") is None
+    assert len(statements) == 4
+
+    # cached by id and by name
+    assert directory.lookup_user("user3") is directory.lookup_user(3)
+    assert directory.lookup_user(4).username == "user4"
+    assert len(statements) == 4
+
+
+def test_the_cache_evicts_offline_users_first(users, directory):
+    online = directory.lookup_user(1)
+    online.online = True
+    for user_id in range(2, 10):
+        directory.lookup_user(user_id)
+
+    assert len(directory) == 5
+    assert sorted(directory.user_dict) == [1, 6, 7, 8, 9]
+    names = {user.username for user in directory.get_users_by_name()}
+    assert names == {"user1", "user6", "user7", "user8", "user9"}
+
+
+def test_pages_load_missing_users_in_one_query(users, directory, statements):
+    directory.capacity = 100
+    directory.lookup_user(12)
+    statements.clear()
+
+    page = directory.page(10, 5)
+    assert [user.id for user in page] == [11, 12, 13, 14, 15]
+    # the page's ids, then the users not already cached
+    assert len(statements) == 2
+    assert directory.page(30, 5) == []
+
+
+def test_lookup_many_keeps_the_order_asked_for(users, directory):
+    directory.capacity = 100
+    users = directory.lookup_many([7, 3, 99, 7, 1])
+    assert [user.id for user in users] == [7, 3, 1]
+
+
+def test_nothing_is_looked_up_without_a_database():
+    directory = user_directory.PublicUserManager()
+    assert directory.lookup_user(1) is None
+    assert directory.page(0, 10) == []
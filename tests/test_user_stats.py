@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from conftest import package_module
+
+sql_models = package_module("sql_models")
+user_stats = package_module("user_stats")
+db, Message, User = sql_models.db, sql_models.Message, sql_models.User
+
+
+def test_adding_the_column_counts_existing_posts(app):
+    db.session.add_all(
+        [
+            User(username=name, email=f"{name}@example.com", password="x")
+            for name in "ab"
+        ]
+    )
+    db.session.flush()
+    db.session.add_all(
+        [Message(text="hi", datetime=datetime(2025, 1, 1), user_id=1) for _ in range(3)]
+    )
+    db.session.commit()
+    # a database from before the column existed
+    with db.engine.begin() as connection:
+        connection.execute(db.text("ALTER TABLE users DROP COLUMN post_count"))
+
+    user_stats.ensure_post_count_column()
+    counts = db.session.query(User.username, User.post_count).order_by(User.id)
+    assert counts.all() == [("a", 3), ("b", 0)]
@@ -0,0 +1,125 @@
+import pytest
+
+from conftest import package_module
+
+wire = package_module("wire")
+presence = package_module("presence")
+
+# the fallback encoder, and msgpack's when it's installed
+CODECS = [pytest.param((wire._packb, wire._unpackb), id="fallback")]
+if wire.packb is not wire._packb:
+    CODECS.append(pytest.param((wire.packb, wire.unpackb), id="msgpack"))
+
+
+def message(id, text="hello"):
+    return {
+        "id": id,
+        "text": text,
+        "datetime": 1735689600.123456,
+        "user_id": id % 7 + 1,
+        "room_id": 1,
+    }
+
+
+MESSAGES = [
+    message(1),
+    message(2**31, "héllo wörld ✓"),
+    message(2**53 + 1, "絵文字 🎉 " * 40),
+    message(2**64 - 1, "x" * 70_000),
+]
+
+
+@pytest.fixture(params=CODECS)
+def codec(request):
+    return request.param
+
+
+def test_values_round_trip(codec):
+    packb, unpackb = codec
+    values = [
+        None,
+        True,
+        False,
+        0,
+        -1,
+        -32,
+        -33,
+        127,
+        128,
+        255,
+        256,
+        2**16,
+        2**32,
+        2**64 - 1,
+        -(2**7),
+        -(2**15) - 1,
+        -(2**31) - 1,
+        -(2**63),
+        1.5,
+        "",
+        "ü" * 16,
+        "ü" * 200,
+        "ü" * 40_000,
+        b"\x00\xff" * 200,
+        list(range(20)),
+        {str(i): i for i in range(20)},
+    ]
+    for value in values:
+        assert unpackb(packb(value)) == value
+    with pytest.raises(OverflowError):
+        wire._packb(2**64)
+
+
+def test_a_chat_message_round_trips(codec):
+    packb, unpackb = codec
+    for data in MESSAGES:
+        version, record = unpackb(packb(wire.pack_message(data)))
+        assert version == wire.SCHEMA_VERSION
+        assert dict(zip(wire.MESSAGE_FIELDS, record)) == data
+
+
+def test_a_batch_of_messages_round_trips():
+    packed = wire.pack_messages(
+        wire.packb(wire.message_tuple(data)) for data in MESSAGES
+    )
+    assert wire.unpack_messages(packed) == MESSAGES
+    assert wire._unpackb(packed) == wire.unpackb(packed)
+
+    twenty = [message(i) for i in range(20)]
+    packed = wire.pack_messages(wire.packb(wire.message_tuple(m)) for m in twenty)
+    assert wire.unpack_messages(packed) == twenty
+
+    # a batched broadcast frame, see batching.py
+    frame = [["chat-message", wire.pack_message(data)] for data in MESSAGES]
+    assert wire._unpackb(wire._packb(frame)) == frame
+
+    with pytest.raises(ValueError, match="schema version"):
+        wire.unpack_messages(wire.packb([wire.SCHEMA_VERSION + 1, []]))
+
+
+def test_presence_deltas_and_snapshots_round_trip(codec):
+    packb, unpackb = codec
+    log = presence.PresenceLog()
+    log.join(1, "ålice", "1.png")
+    log.join(2**40, "ボブ", "")
+    log.leave(1)
+    update = log.since(log.epoch, 0)
+    assert unpackb(packb(update)) == update
+
+    snapshot = log.snapshot()
+    version, (epoch, at, users) = unpackb(wire.pack_snapshot(snapshot))
+    assert version == wire.SCHEMA_VERSION
+    assert (epoch, at, users) == (
+        snapshot["epoch"],
+        snapshot["version"],
+        snapshot["users"],
+    )
+
+
+def test_malformed_data_is_refused():
+    packed = wire._packb(wire.pack_message(MESSAGES[1]))
+    with pytest.raises(ValueError, match="extra data"):
+        wire._unpackb(packed + b"\x00")
+    # 0xc1 is never used by messagepack
+    with pytest.raises(ValueError, match="unsupported"):
+        wire._unpackb(packed[:-1] + b"\xc1")
@@ -0,0 +1,226 @@
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from functools import singledispatchmethod
+from typing import Dict, Iterable, List, Optional
+
+from flask import has_app_context
+
+from .avatars import avatar_url, avatar_urls, nearest_size
+from .sql_models import db, User
+
+
+@dataclass
+class PublicUser:
+    "front facing user class which doesn't expose private info"
+
+    id: int
+    username: str
+    avatar_filename: str
+    online: bool = False
+
+    @property
+    def avatar_urls(self) -> Dict[int, str]:
+        "avatar url for every configured size"
+        return avatar_urls(self.avatar_filename)
+
+    def avatar_url(self, size: int) -> str:
+        "avatar url at the configured size nearest size"
+        return avatar_url(self.avatar_filename, nearest_size(size))
+
+    def to_json(self) -> dict:
+        return dict(self.__dict__, avatar_urls=self.avatar_urls)
+
+    @classmethod
+    def from_db(cls, db_user):
+        return cls(
+            id=db_user.id,
+            username=db_user.username,
+            avatar_filename=db_user.avatar_filename,
+        )
+
+
+PUBLIC_COLUMNS = (User.id, User.username, User.avatar_filename)
+
+
+class PublicUserManager:
+    """manages user state such as online status
+
+    users are loaded from the database the first time they're looked up and
+    kept in a bounded LRU, so startup and memory don't grow with the number
+    of accounts. online users are never evicted.
+    """
+
+    def __init__(self, capacity: int = 10_000):
+        self.capacity = capacity
+        self._app = None
+        self._users_by_name: Dict[str, PublicUser] = dict()
+        self._users_by_id: "OrderedDict[int, PublicUser]" = OrderedDict()
+        self._last_request_time = dict()
+        self._lock = threading.RLock()
+
+    def load_from_db(self, app):
+        "look users up through app's database from now on"
+        self._app = app
+
+    def _with_db(self, query):
+        if self._app is None:
+            return []
+        # presence sweeps and cluster events look users up from background
+        # tasks, which have no app context of their own
+        if has_app_context():
+            return query()
+        with self._app.app_context():
+            return query()
+
+    def _query(self, *filters) -> List[PublicUser]:
+        return self._with_db(
+            lambda: [
+                PublicUser(
+                    id=row.id,
+                    username=row.username,
+                    avatar_filename=row.avatar_filename,
+                )
+                for row in db.session.query(*PUBLIC_COLUMNS).filter(*filters)
+            ]
+        )
+
+    def _cache(self, user: PublicUser) -> PublicUser:
+        with self._lock:
+            cached = self._users_by_id.get(user.id)
+            if cached is not None:
+                self._users_by_id.move_to_end(user.id)
+                return cached
+
+            self._users_by_id[user.id] = user
+            self._users_by_name[user.username] = user
+            self._last_request_time.setdefault(user.id, datetime.utcnow())
+            self._evict()
+            return user
+
+    def _evict(self):
+        # oldest first, online users go back to the newest end
+        for _ in range(len(self._users_by_id)):
+            if len(self._users_by_id) <= self.capacity:
+                return
+            user_id, user = self._users_by_id.popitem(last=False)
+            if user.online:
+                self._users_by_id[user_id] = user
+                continue
+            del self._users_by_name[user.username]
+            self._last_request_time.pop(user_id, None)
+
+    @singledispatchmethod
+    def add_user(self, user):
+        raise TypeError(user)
+
+    @add_user.register
+    def _(self, user: User):
+        self._cache(PublicUser.from_db(user))
+
+    @add_user.register
+    def _(self, user: PublicUser):
+        self._cache(user)
+
+    @singledispatchmethod
+    def remove_user(self, user):
+        raise TypeError(user)
+
+    @remove_user.register
+    def _(self, user: User):
+        with self._lock:
+            self._users_by_id.pop(user.id, None)
+            self._users_by_name.pop(user.username, None)
+            self._last_request_time.pop(user.id, None)
+
+    def __len__(self):
+        return len(self._users_by_id)
+
+    @property
+    def user_dict(self) -> Dict[int, PublicUser]:
+        "users currently loaded, not every registered user"
+        return self._users_by_id
+
+    @singledispatchmethod
+    def lookup_user(self, user) -> Optional[PublicUser]:
+        raise TypeError(user)
+
+    @lookup_user.register(int)
+    def _(self, user_id: int) -> Optional[PublicUser]:
+        with self._lock:
+            user = self._users_by_id.get(user_id, None)
+            if user is not None:
+                self._users_by_id.move_to_end(user_id)
+                return user
+        for user in self._query(User.id == user_id):
+            return self._cache(user)
+        return None
+
+    @lookup_user.register(str)
+    def _(self, username: str) -> Optional[PublicUser]:
+        with self._lock:
+            user = self._users_by_name.get(username, None)
+            if user is not None:
+                self._users_by_id.move_to_end(user.id)
+                return user
+        for user in self._query(User.username == username):
+            return self._cache(user)
+        return None
+
+    def lookup_many(self, user_ids: Iterable[int]) -> List[PublicUser]:
+        "users for user_ids, loading every one that isn't cached in one query"
+        user_ids = list(dict.fromkeys(user_ids))
+        with self._lock:
+            missing = [i for i in user_ids if i not in self._users_by_id]
+        # chunked to stay under sqlite's bound parameter limit
+        for start in range(0, len(missing), 500):
+            for user in self._query(User.id.in_(missing[start : start + 500])):
+                self._cache(user)
+        with self._lock:
+            return [
+                self._users_by_id[user_id]
+                for user_id in user_ids
+                if user_id in self._users_by_id
+            ]
+
+    def page(self, offset: int, limit: int) -> List[PublicUser]:
+        "one page of the whole directory ordered by id"
+        rows = self._with_db(
+            lambda: db.session.query(User.id)
+            .order_by(User.id)
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+        return self.lookup_many(row.id for row in rows)
+
+    @singledispatchmethod
+    def update_request_time(self, user, time=datetime.utcnow()) -> None:
+        raise TypeError(user)
+
+    @update_request_time.register
+    def _(self, user_id: int, time=datetime.utcnow()) -> None:
+        self._last_request_time[user_id] = time
+
+    @update_request_time.register
+    def _(self, username: str, time=datetime.utcnow()) -> None:
+        user_id = self.lookup_user(username).id
+        self._last_request_time[user_id] = time
+
+    @singledispatchmethod
+    def get_last_request_time(self, user) -> datetime:
+        raise TypeError(user)
+
+    @get_last_request_time.register
+    def _(self, user: int) -> datetime:
+        self.lookup_user(user)
+        return self._last_request_time[user]
+
+    @get_last_request_time.register
+    def _(self, user: str) -> datetime:
+        user_id = self.lookup_user(user).id
+        return self._last_request_time[user_id]
+
+    def get_users_by_name(self) -> List[PublicUser]:
+        return self._users_by_name.values()
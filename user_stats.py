@@ -0,0 +1,51 @@
+from collections import Counter
+from typing import Iterable, Optional
+
+from .archive import MessageArchive
+from .sql_models import db, Message, User
+
+
+def increment_post_counts(user_ids: Iterable[int]):
+    """add one post per occurence of each user id
+
+    runs in the caller's transaction so counts commit together with the
+    messages they count
+    """
+    for user_id, count in Counter(user_ids).items():
+        db.session.execute(
+            User.__table__.update()
+            .where(User.id == user_id)
+            .values(post_count=User.post_count + count)
+        )
+
+
+def ensure_post_count_column(archive: Optional[MessageArchive] = None):
+    """add users.post_count to databases created before it existed
+
+    and count the posts already there, the column starts at 0 for everyone
+    """
+    columns = {column["name"] for column in db.inspect(db.engine).get_columns("users")}
+    if "post_count" not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.text(
+                    "ALTER TABLE users ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+        rebuild_post_counts(archive)
+
+
+def rebuild_post_counts(archive: Optional[MessageArchive] = None) -> int:
+    """recount every user's posts from the messages table and the archive,
+    returns users updated"""
+    query = db.session.query(Message.user_id, db.func.count(Message.id))
+    counts = Counter(dict(query.group_by(Message.user_id)))
+    if archive is not None:
+        counts.update(archive.post_counts())
+    db.session.execute(User.__table__.update().values(post_count=0))
+    for user_id, count in counts.items():
+        db.session.execute(
+            User.__table__.update().where(User.id == user_id).values(post_count=count)
+        )
+    db.session.commit()
+    return len(counts)
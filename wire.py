@@ -0,0 +1,254 @@
+"""compact encoding of socket events for clients that ask for it
+
+clients send "set-encoding" with "packed" to opt in, everyone else keeps
+getting json dicts. packed payloads are [SCHEMA_VERSION, body] where
+records are positional tuples instead of dicts with repeated keys:
+
+    message   [id, text, datetime, user_id, room_id]
+    snapshot  [epoch, version, [[id, username, avatar_filename], ...]]
+
+lists of records are sent as a messagepack binary attachment. a single
+record goes as a json array instead, socket.io sends an attachment as an
+extra frame with a placeholder packet that costs more than it saves on
+one small message.
+"""
+
+import struct
+from typing import Iterable, List, Tuple
+
+JSON = "json"
+PACKED = "packed"
+ENCODINGS = (JSON, PACKED)
+
+SCHEMA_VERSION = 2
+
+MESSAGE_FIELDS = ("id", "text", "datetime", "user_id", "room_id")
+
+
+def room_for(room: str, encoding: str) -> str:
+    "every room has one sub-room per encoding that broadcasts are sent to"
+    return f"{room}/{encoding}"
+
+
+def message_tuple(message: dict) -> list:
+    return [message[field] for field in MESSAGE_FIELDS]
+
+
+def pack_message(message: dict) -> list:
+    "a single message for a packed client"
+    return [SCHEMA_VERSION, message_tuple(message)]
+
+
+def pack_messages(packed_messages: Iterable[bytes]) -> bytes:
+    """a list of messages for a packed client
+
+    takes each message already encoded with packb(message_tuple(...)), as
+    kept by the recent message cache, and only adds the framing around them
+    """
+    packed_messages = list(packed_messages)
+    return b"".join(
+        (
+            array_header(2),
+            packb(SCHEMA_VERSION),
+            array_header(len(packed_messages)),
+            *packed_messages,
+        )
+    )
+
+
+def pack_snapshot(snapshot: dict) -> bytes:
+    "a presence snapshot from PresenceLog.snapshot for a packed client"
+    return packb(
+        [SCHEMA_VERSION, [snapshot["epoch"], snapshot["version"], snapshot["users"]]]
+    )
+
+
+# messagepack, the subset needed here: nil, bool, int, float, str, bin,
+# array and map. the msgpack package is used when it's installed
+
+
+def array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+
+# smallest encoding that fits, by (marker, struct format, bound)
+_UINTS = (
+    (b"\xcc", ">B", 0xFF),
+    (b"\xcd", ">H", 0xFFFF),
+    (b"\xce", ">I", 0xFFFFFFFF),
+    (b"\xcf", ">Q", 0xFFFFFFFFFFFFFFFF),
+)
+_INTS = (
+    (b"\xd0", ">b", -0x80),
+    (b"\xd1", ">h", -0x8000),
+    (b"\xd2", ">i", -0x80000000),
+    (b"\xd3", ">q", -0x8000000000000000),
+)
+
+
+def _pack(obj, out: bytearray):
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif obj >= 0:
+            for marker, fmt, limit in _UINTS:
+                if obj <= limit:
+                    out += marker + struct.pack(fmt, obj)
+                    break
+            else:
+                raise OverflowError("int too large for messagepack")
+        else:
+            for marker, fmt, limit in _INTS:
+                if obj >= limit:
+                    out += marker + struct.pack(fmt, obj)
+                    break
+            else:
+                raise OverflowError("int too small for messagepack")
+    elif isinstance(obj, float):
+        out += b"\xcb" + struct.pack(">d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        if len(data) < 32:
+            out.append(0xA0 | len(data))
+        elif len(data) < 0x100:
+            out += bytes((0xD9, len(data)))
+        elif len(data) < 0x10000:
+            out += b"\xda" + struct.pack(">H", len(data))
+        else:
+            out += b"\xdb" + struct.pack(">I", len(data))
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        if len(obj) < 0x100:
+            out += bytes((0xC4, len(obj)))
+        elif len(obj) < 0x10000:
+            out += b"\xc5" + struct.pack(">H", len(obj))
+        else:
+            out += b"\xc6" + struct.pack(">I", len(obj))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        out += array_header(len(obj))
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        if len(obj) < 16:
+            out.append(0x80 | len(obj))
+        elif len(obj) < 0x10000:
+            out += b"\xde" + struct.pack(">H", len(obj))
+        else:
+            out += b"\xdf" + struct.pack(">I", len(obj))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"can't pack {type(obj).__name__}")
+
+
+_FIXED = {
+    0xCC: ">B", 0xCD: ">H", 0xCE: ">I", 0xCF: ">Q",
+    0xD0: ">b", 0xD1: ">h", 0xD2: ">i", 0xD3: ">q",
+    0xCA: ">f", 0xCB: ">d",
+}  # fmt: skip
+# str8/16/32 and bin8/16/32, followed by that many bytes
+_LENGTHS = {0xD9: ">B", 0xDA: ">H", 0xDB: ">I", 0xC4: ">B", 0xC5: ">H", 0xC6: ">I"}
+
+
+def _unpack(data: bytes, offset: int) -> Tuple[object, int]:
+    byte = data[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    if byte >= 0xE0:
+        return byte - 0x100, offset
+    if 0xA0 <= byte < 0xC0:
+        end = offset + (byte & 0x1F)
+        return data[offset:end].decode("utf-8"), end
+    if 0x90 <= byte < 0xA0:
+        return _unpack_array(data, offset, byte & 0x0F)
+    if 0x80 <= byte < 0x90:
+        return _unpack_map(data, offset, byte & 0x0F)
+    if byte == 0xC0:
+        return None, offset
+    if byte in (0xC2, 0xC3):
+        return byte == 0xC3, offset
+    if byte in _FIXED:
+        fmt = _FIXED[byte]
+        return struct.unpack_from(fmt, data, offset)[0], offset + struct.calcsize(fmt)
+    if byte in _LENGTHS:
+        fmt = _LENGTHS[byte]
+        (length,) = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+        value = data[offset : offset + length]
+        if byte in (0xD9, 0xDA, 0xDB):
+            value = value.decode("utf-8")
+        return value, offset + length
+    if byte in (0xDC, 0xDD):
+        fmt = ">H" if byte == 0xDC else ">I"
+        (length,) = struct.unpack_from(fmt, data, offset)
+        return _unpack_array(data, offset + struct.calcsize(fmt), length)
+    if byte in (0xDE, 0xDF):
+        fmt = ">H" if byte == 0xDE else ">I"
+        (length,) = struct.unpack_from(fmt, data, offset)
+        return _unpack_map(data, offset + struct.calcsize(fmt), length)
+    raise ValueError(f"unsupported messagepack type 0x{byte:02x}")
+
+
+def _unpack_array(data: bytes, offset: int, length: int) -> Tuple[list, int]:
+    items = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data: bytes, offset: int, length: int) -> Tuple[dict, int]:
+    result = dict()
+    for _ in range(length):
+        key, offset = _unpack(data, offset)
+        result[key], offset = _unpack(data, offset)
+    return result, offset
+
+
+def _packb(obj) -> bytes:
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _unpackb(data: bytes):
+    obj, offset = _unpack(data, 0)
+    if offset != len(data):
+        raise ValueError("extra data after messagepack object")
+    return obj
+
+
+try:
+    import msgpack
+except ImportError:
+    packb, unpackb = _packb, _unpackb
+else:
+
+    def packb(obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def unpackb(data: bytes):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+
+def unpack_messages(data: bytes) -> List[dict]:
+    "inverse of pack_messages, as the client decodes it"
+    version, body = unpackb(data)
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"unknown schema version {version}")
+    return [dict(zip(MESSAGE_FIELDS, record)) for record in body]